@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Compares time needed to encode ids of a long list of entities (e.g. contents of a big storage)
+one by one (`main.encode`) and in a batch (`main.encode_many`).
+It doesn't need the database. Run from the backend directory: python3 -m benchmarks.encode_ids
+"""
+import timeit
+
+from exeris.core import main
+
+ENTITIES_COUNT = 500
+REPEATS = 20
+
+
+def run():
+    main.create_app()
+    entity_ids = list(range(1000, 1000 + ENTITIES_COUNT))
+    observer_id = 123
+
+    def encode_one_by_one():
+        return [main.encode(entity_id, character_id=observer_id) for entity_id in entity_ids]
+
+    def encode_in_batch():
+        return main.encode_many(entity_ids, character_id=observer_id)
+
+    assert encode_one_by_one() == encode_in_batch()
+
+    def without_cipher_cache():  # how it worked before the cipher cache was introduced
+        encoded_ids = []
+        for entity_id in entity_ids:
+            main._cipher_for_key.cache_clear()
+            encoded_ids.append(main.encode(entity_id, character_id=observer_id))
+        return encoded_ids
+
+    for name, function in [("one by one, no cipher cache", without_cipher_cache),
+                           ("one by one", encode_one_by_one),
+                           ("encode_many", encode_in_batch)]:
+        total_time = timeit.timeit(function, number=REPEATS)
+        print("{:30} {:8.3f} msec per {} ids".format(name, total_time / REPEATS * 1000, ENTITIES_COUNT))
+
+
+if __name__ == "__main__":
+    run()
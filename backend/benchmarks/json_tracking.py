@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Measures the overhead of nested change tracking of sqlalchemy_json_mutable compared to plain dicts
+for the typical operations on entity states and property data: loading (coercion of the value read from the db),
+nested set, update and deep copy.
+It doesn't need the database. Run from the backend directory: python3 -m benchmarks.json_tracking
+"""
+import copy
+import timeit
+
+from sqlalchemy_json_mutable.mutable_types import NestedMutableDict
+
+REPEATS = 2000
+
+
+def example_data():
+    return {
+        "damage": 0.0,
+        "hunger": 0.3,
+        "satiation": 0.1,
+        "modifiers": {"starvation": 1000, "wounds": {"arm": 1200, "leg": 1300}},
+        "eating_queue": {"strength": 0.1, "durability": 0.05},
+        "resources": {"egg": 2.5, "feather": 1.0, "milk": {"amount": 3, "quality": [0.5, 0.7]}},
+        "type_resources": {name: {"initial": 1, "max": 10} for name in ("egg", "feather", "pork", "bone", "hide")},
+    }
+
+
+def load(dict_class):
+    return dict_class(example_data())
+
+
+def nested_set(data):
+    for i in range(10):
+        data["resources"]["milk"]["amount"] = i
+        data["modifiers"]["wounds"]["arm"] = i
+
+
+def update(data):
+    data.update({"hunger": 0.4, "satiation": 0.2, "damage": 0.1})
+    data["eating_queue"].update({"strength": 0.2, "durability": 0.1})
+
+
+def run():
+    for name, dict_class in [("plain dict", dict), ("NestedMutableDict", NestedMutableDict)]:
+        print(name)
+        benchmarks = [("load", lambda: load(dict_class)),
+                      ("load and read nested", lambda: load(dict_class)["resources"]["milk"]["amount"]),
+                      ("nested set", lambda: nested_set(load(dict_class))),
+                      ("update", lambda: update(load(dict_class))),
+                      ("deepcopy", lambda: copy.deepcopy(load(dict_class)))]
+        for benchmark_name, function in benchmarks:
+            total_time = timeit.timeit(function, number=REPEATS)
+            print("    {:25} {:8.2f} usec".format(benchmark_name, total_time / REPEATS * 1000000))
+
+
+if __name__ == "__main__":
+    run()
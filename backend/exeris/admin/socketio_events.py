@@ -1,5 +1,6 @@
 import json
 
+import exeris
 from exeris.app import socketio_player_event
 from exeris.core import models
 from exeris.core.models import ENTITY_ITEM, ENTITY_LOCATION, ENTITY_PASSAGE
@@ -82,3 +83,8 @@ def create_entity_type(entity_type_data):
 @socketio_player_event("admin.get_all_property_names")
 def get_all_property_names():
     return sorted([val.value for val in P]),
+
+
+@socketio_player_event("admin.get_combat_round_timings")
+def get_combat_round_timings():
+    return exeris.app.combat_round_timings.stats(),
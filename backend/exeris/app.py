@@ -1,4 +1,5 @@
 import datetime
+import hashlib
 import logging
 import os
 import time
@@ -6,7 +7,6 @@ import traceback
 from functools import wraps
 
 import flask_socketio as client_socket
-import psycopg2
 import redis
 from flask import g, request
 from flask_bootstrap import Bootstrap
@@ -16,13 +16,12 @@ from flask_mail import Mail
 from flask_redis import FlaskRedis
 from flask_socketio import SocketIO
 from geoalchemy2.shape import from_shape
-from pyslate.backends import postgres_backend
 from shapely.geometry import Point, Polygon
 
 # noinspection PyUnresolvedReferences
 from exeris.core import achievements
 from exeris.core import cache
-from exeris.core import models, main, general
+from exeris.core import models, main, general, i18n, migrations
 from exeris.core.i18n import create_pyslate
 from exeris.core.main import create_app, db, Types
 from exeris.core.properties_base import P
@@ -45,6 +44,58 @@ login_manager = LoginManager(app)
 
 redis_db = FlaskRedis.from_custom_provider(redis.StrictRedis, app)
 
+translations_pool = i18n.TranslationConnectionPool(app.config["SQLALCHEMY_DATABASE_URI"],
+                                                   app.config["TRANSLATIONS_POOL_SIZE"])
+TRANSLATIONS_VERSION_KEY = "translations_version"
+
+
+def compute_translations_version():
+    """
+    Version of the translations, made of a hash of their contents,
+    so it changes only when they are changed, no matter how many times it's computed.
+    """
+    version_hash = hashlib.sha1()
+    with translations_pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT md5(coalesce(string_agg(concat_ws(chr(31), name, language, content, form), chr(30) "
+                        "ORDER BY name, language), '')) FROM translations")
+            version_hash.update(cur.fetchone()[0].encode("utf-8"))
+    return version_hash.hexdigest()
+
+
+def get_translations_version():
+    version = redis_db.get(TRANSLATIONS_VERSION_KEY)
+    if version is None:  # e.g. redis was flushed, the version of the current translations is restored
+        version = compute_translations_version()
+        redis_db.set(TRANSLATIONS_VERSION_KEY, version)
+        return version
+    return version.decode("utf-8")
+
+
+def bump_translations_version():
+    """
+    Makes all the processes reload translations into their translation_backend if they were changed.
+    It must be called every time the translations table is changed.
+    """
+    redis_db.set(TRANSLATIONS_VERSION_KEY, compute_translations_version())
+
+
+translation_backend = i18n.InMemoryTranslationBackend(translations_pool, "translations",
+                                                      get_version=get_translations_version,
+                                                      version_check_interval=app.config[
+                                                          "TRANSLATIONS_VERSION_CHECK_INTERVAL"])
+
+
+def get_rendered_event_version(language):
+    """
+    :return: version of translations and of the code used to render event texts stored in EventObserver.rendered_text
+             or None if it's unknown, so the rendered texts can't be stored
+    """
+    translations_version = translation_backend.version
+    if translations_version is None:
+        return None
+    return "{}:{}:{}".format(language, translations_version, i18n.EVENT_RENDERING_VERSION)
+
 
 def socketio_outer_event(*args, **kwargs):
     socketio_handler = socketio.on(*args, **kwargs)
@@ -53,8 +104,7 @@ def socketio_outer_event(*args, **kwargs):
         @wraps(f)
         def fg(*a, **k):
             g.language = request.args.get("language")
-            conn = psycopg2.connect(app.config["SQLALCHEMY_DATABASE_URI"])
-            g.pyslate = create_pyslate(g.language, backend=postgres_backend.PostgresBackend(conn, "translations"))
+            g.pyslate = create_pyslate(g.language, backend=translation_backend)
             result = f(*a, **k)  # argument list (the first and only positional arg) is expanded
             return (True,) + (result if result else ())
 
@@ -80,8 +130,7 @@ def socketio_player_event(*args, **kwargs):
                 g.character = models.Character.by_id(character_id)
                 g.language = g.character.language
 
-            conn = psycopg2.connect(app.config["SQLALCHEMY_DATABASE_URI"])
-            g.pyslate = create_pyslate(g.language, backend=postgres_backend.PostgresBackend(conn, "translations"))
+            g.pyslate = create_pyslate(g.language, backend=translation_backend)
             result = f(*a, **k)  # argument list (the first and only positional arg) is expanded
             return (True,) + (result if result else ())
 
@@ -104,9 +153,7 @@ def socketio_character_event(*args, **kwargs):
             g.player = current_user
             g.character = models.Character.by_id(character_id)
             g.language = g.character.language
-            conn = psycopg2.connect(app.config["SQLALCHEMY_DATABASE_URI"])
-            g.pyslate = create_pyslate(g.language, backend=postgres_backend.PostgresBackend(conn, "translations"),
-                                       character=g.character)
+            g.pyslate = create_pyslate(g.language, backend=translation_backend, character=g.character)
 
             if not g.character.is_alive:
                 raise main.CharacterDeadException(character=g.character)
@@ -124,8 +171,11 @@ def socketio_character_event(*args, **kwargs):
 
 app.encode = main.encode
 app.decode = main.decode
+app.encode_many = main.encode_many
+app.decode_many = main.decode_many
 
 main.property_cache = cache.PropertyCache()
+main.use_effective_properties = app.config["USE_EFFECTIVE_PROPERTIES"]
 
 from exeris.outer import outer_bp
 from exeris.player import player_bp
@@ -138,6 +188,7 @@ import logging
 def create_database():
     logging.warning("@@@@@@@@@@@@@@ before_first_request")
     db.create_all()
+    migrations.apply_migrations()
 
     redis_db.flushdb()  # clear pub/sub queue for events
 
@@ -687,7 +738,10 @@ def create_database():
     for tag_key in data:
         for language in data[tag_key]:
             db.session.merge(models.TranslatedText(tag_key, language, data[tag_key][language]))
+
+    models.prepare_effective_properties()
     db.session.commit()
+    bump_translations_version()
 
 
 @outer_bp.url_defaults
@@ -698,8 +752,7 @@ def add_language_code(endpoint, values):
 @outer_bp.url_value_preprocessor
 def outer_preprocessor(endpoint, values):
     g.language = values.pop('language', "en")
-    conn = psycopg2.connect(app.config["SQLALCHEMY_DATABASE_URI"])
-    g.pyslate = create_pyslate(g.language, backend=postgres_backend.PostgresBackend(conn, "translations"))
+    g.pyslate = create_pyslate(g.language, backend=translation_backend)
 
 
 def player_before_request():
@@ -707,8 +760,7 @@ def player_before_request():
         return app.login_manager.unauthorized()
     g.player = current_user
     g.language = g.player.language
-    conn = psycopg2.connect(app.config["SQLALCHEMY_DATABASE_URI"])
-    g.pyslate = create_pyslate(g.language, backend=postgres_backend.PostgresBackend(conn, "translations"))
+    g.pyslate = create_pyslate(g.language, backend=translation_backend)
 
 
 player_bp.before_request(player_before_request)
@@ -723,9 +775,7 @@ def character_preprocessor(endpoint, values):
     g.player = current_user
     g.character = models.Character.by_id(character_id)
     g.language = g.character.language
-    conn = psycopg2.connect(app.config["SQLALCHEMY_DATABASE_URI"])
-    g.pyslate = create_pyslate(g.language, backend=postgres_backend.PostgresBackend(conn, "translations"),
-                               character=g.character)
+    g.pyslate = create_pyslate(g.language, backend=translation_backend, character=g.character)
 
 
 @login_manager.user_loader
@@ -734,27 +784,106 @@ def load_user(player_id):
 
 
 class SocketioUsers:
-    def __init__(self):
-        # redis_db.flushdb()
-        pass
+    """
+    Registry of socketio sessions of the players stored in redis.
+    Sids of a player are kept in a sorted set scored by the time of the last heartbeat,
+    so sids of sessions which were never properly disconnected are ignored after `ttl` seconds
+    (and then removed on the next heartbeat of the player). There's also a reverse mapping from sid to player id,
+    so removing a single sid doesn't need to look into sets of all the players.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    @staticmethod
+    def _sids_key(player_id):
+        return "sids_by_player_id:" + str(player_id)
+
+    @staticmethod
+    def _player_key(sid):
+        return "player_by_sid:" + sid
 
     def get_all_by_player_id(self, player_id):
-        result_from_redis = redis_db.smembers("sid_by_player_id:" + str(player_id))
-        return [result.decode('utf-8') for result in result_from_redis]
+        return self.get_all_by_player_ids([player_id])[player_id]
+
+    def get_all_by_player_ids(self, player_ids):
+        """
+        Gets sids of many players in a single round trip to redis.
+        :return: dict where key is player id and value is a list of its sids
+        """
+        player_ids = list(player_ids)
+        oldest_alive_heartbeat = time.time() - self.ttl
+        pipeline = redis_db.pipeline(transaction=False)
+        for player_id in player_ids:
+            pipeline.zrangebyscore(self._sids_key(player_id), oldest_alive_heartbeat, "+inf")
+        results_from_redis = pipeline.execute()
+        return {player_id: [result.decode('utf-8') for result in sids]
+                for player_id, sids in zip(player_ids, results_from_redis)}
 
     def add_for_player_id(self, sid, player_id):
-        redis_db.sadd("sid_by_player_id:" + str(player_id), sid)
+        """
+        Registers a sid or refreshes its expiration time if it's already registered.
+        """
+        now = time.time()
+        sids_key = self._sids_key(player_id)
+        pipeline = redis_db.pipeline(transaction=False)
+        pipeline.zadd(sids_key, {sid: now})
+        pipeline.zremrangebyscore(sids_key, "-inf", now - self.ttl)
+        pipeline.expire(sids_key, self.ttl)
+        pipeline.set(self._player_key(sid), player_id, ex=self.ttl)
+        pipeline.execute()
 
     def remove_sid(self, sid):
-        player_id_sets = redis_db.keys("sid_by_player_id:*")
-        for player_id_set_name in player_id_sets:
-            redis_db.srem(player_id_set_name, sid)
+        player_id = redis_db.get(self._player_key(sid))
+        pipeline = redis_db.pipeline(transaction=False)
+        if player_id is not None:
+            pipeline.zrem(self._sids_key(player_id.decode('utf-8')), sid)
+        pipeline.delete(self._player_key(sid))
+        pipeline.execute()
 
     def remove_for_player_id(self, player_id):
-        redis_db.delete("sid_by_player_id:" + str(player_id))
+        sids = redis_db.zrange(self._sids_key(player_id), 0, -1)
+        redis_db.delete(self._sids_key(player_id), *[self._player_key(sid.decode('utf-8')) for sid in sids])
+
+
+socketio_users = SocketioUsers(app.config["SOCKETIO_SID_TTL"])
+
+
+class CombatRoundTimingsStats:
+    """
+    Durations of combat rounds resolved by all the scheduler processes, aggregated in redis,
+    so they can be read by any process. Rounds are also counted by the upper bound of their duration.
+    """
+    KEY = "combat_round_timings"
+    DURATION_BOUNDS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # in seconds
+
+    def record(self, duration):
+        pipeline = redis_db.pipeline(transaction=False)
+        pipeline.hincrby(self.KEY, "rounds", 1)
+        pipeline.hincrbyfloat(self.KEY, "total_time", duration)
+        pipeline.hincrby(self.KEY, self._duration_bucket(duration), 1)
+        pipeline.execute()
+
+    def stats(self):
+        values = {key.decode("utf-8"): value for key, value in redis_db.hgetall(self.KEY).items()}
+        rounds = int(values.get("rounds", 0))
+        total_time = float(values.get("total_time", 0))
+        return {
+            "rounds": rounds,
+            "total_time": total_time,
+            "average_time": total_time / rounds if rounds else None,
+            "rounds_by_duration": {bucket: int(values.get(bucket, 0)) for bucket in self._duration_buckets()},
+        }
 
+    def _duration_bucket(self, duration):
+        bound = next((bound for bound in self.DURATION_BOUNDS if duration <= bound), None)
+        return "up_to_{}s".format(bound) if bound is not None else "longer"
 
-socketio_users = SocketioUsers()
+    def _duration_buckets(self):
+        return [self._duration_bucket(bound) for bound in self.DURATION_BOUNDS] + ["longer"]
+
+
+combat_round_timings = CombatRoundTimingsStats()
 
 
 @socketio.on("connect")
@@ -763,6 +892,12 @@ def on_connect():
         socketio_users.add_for_player_id(request.sid, current_user.id)
 
 
+@socketio.on("heartbeat")
+def on_heartbeat():
+    if current_user.is_authenticated:
+        socketio_users.add_for_player_id(request.sid, current_user.id)
+
+
 @socketio.on("disconnect")
 def on_disconnect():
     socketio_users.remove_sid(request.sid)
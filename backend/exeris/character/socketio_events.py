@@ -7,10 +7,11 @@ import math
 from flask import g, render_template
 import sqlalchemy as sql
 
-from exeris.app import socketio_character_event
+from exeris.app import socketio_character_event, get_rendered_event_version
 from exeris.core import models, actions, accessible_actions, recipes, deferred, general, main, combat
 from exeris.core import properties
 from exeris.core import util
+from exeris.core.i18n import render_event_text
 from exeris.core.main import db, app
 from exeris.core.properties_base import P
 
@@ -18,7 +19,7 @@ logger = logging.getLogger(__name__)
 
 
 def decode_and_load_entities(enc_entities_ids):
-    entities_ids = [app.decode(entity_id) for entity_id in enc_entities_ids]
+    entities_ids = app.decode_many(enc_entities_ids)
     return models.Entity.query.filter(models.Entity.id.in_(entities_ids)).all()
 
 
@@ -64,7 +65,8 @@ def update_top_bar(endpoint_name):
     # queue is not supported, so max 1 allowed TODO #72
     assert len([intent for intent in intents if intent.type == main.Intents.WORK]) <= 1
 
-    pyslatized_intents = [deferred.call(intent.serialized_action).pyslatize() for intent in intents]
+    models.Intent.preload_actions(intents)
+    pyslatized_intents = [intent.get_action().pyslatize() for intent in intents]
 
     rendered = render_template("character_top_bar.html", intents=pyslatized_intents, endpoint_name=endpoint_name)
     return rendered,
@@ -129,17 +131,15 @@ def join_activity(enc_activity_id):
 @socketio_character_event("character.get_all_events")
 def get_all_events():
     start = time.time()
-    events = db.session.query(models.Event).join(models.EventObserver).filter_by(observer=g.character) \
-        .order_by(models.Event.id.asc()).all()
+    event_observers = models.EventObserver.query.filter_by(observer=g.character) \
+        .options(sql.orm.joinedload(models.EventObserver.event)) \
+        .order_by(models.EventObserver.event_id.asc()).all()
 
     queried = time.time()
     logger.debug("Initial pull of events on events page")
     logger.debug("query time: %s", queried - start)
 
-    events = [{"id": event.id,
-               "text": g.pyslate.t("game_date", game_date=event.date) + ": " +
-                       g.pyslate.t(event.type_name, html=True, **event.params)
-               } for event in events]
+    events = _render_events(event_observers)
 
     tran = time.time()
     logger.debug("translations: %s", tran - queried)
@@ -148,6 +148,56 @@ def get_all_events():
     return events,
 
 
+EVENTS_PAGE_SIZE = 50
+MAX_EVENTS_PAGE_SIZE = 500
+
+
+@socketio_character_event("character.get_events")
+def get_events(after_id=None, before_id=None, limit=EVENTS_PAGE_SIZE):
+    """
+    Keyset-paginated list of events seen by the character, always sorted by ascending id.
+    When after_id is specified, then the oldest events newer than after_id are returned
+    (so the client can fetch only events it hasn't seen yet).
+    Otherwise the newest events (older than before_id, if it's specified) are returned.
+    It uses the primary key index on event_observers (observer_id, event_id), so it doesn't depend on history size.
+    """
+    limit = max(1, min(int(limit), MAX_EVENTS_PAGE_SIZE))
+    after_id = int(after_id) if after_id is not None else None
+    before_id = int(before_id) if before_id is not None else None
+
+    event_observers_query = models.EventObserver.query.filter_by(observer=g.character) \
+        .options(sql.orm.joinedload(models.EventObserver.event))
+    if after_id is not None:
+        event_observers_query = event_observers_query.filter(models.EventObserver.event_id > after_id)
+    if before_id is not None:
+        event_observers_query = event_observers_query.filter(models.EventObserver.event_id < before_id)
+
+    if after_id is not None:
+        event_observers = event_observers_query.order_by(models.EventObserver.event_id.asc()).limit(limit).all()
+    else:
+        event_observers = event_observers_query.order_by(models.EventObserver.event_id.desc()).limit(limit).all()
+        event_observers.reverse()
+
+    events = _render_events(event_observers)
+
+    db.session.commit()
+    return events,
+
+
+def _render_events(event_observers):
+    rendered_version = get_rendered_event_version(g.language)
+    rendered_texts = [event_observer.get_rendered_text(rendered_version) for event_observer in event_observers]
+    models.Event.resolve_params_of_events([event_observer.event for event_observer, event_text
+                                           in zip(event_observers, rendered_texts) if event_text is None])
+    events = []
+    for event_observer, event_text in zip(event_observers, rendered_texts):
+        if event_text is None:  # never rendered or outdated
+            event_text = render_event_text(g.pyslate, event_observer.event)
+            event_observer.set_rendered_text(event_text, rendered_version)
+        events.append({"id": event_observer.event_id, "text": event_text})
+    return events
+
+
 @socketio_character_event("character.get_all_characters_around")
 def get_all_characters_around():
     visibility_range = general.VisibilityBasedRange(10)
@@ -261,7 +311,7 @@ def get_moving_entity_info():
 
         moving_entity_intent = models.Intent.query \
             .filter_by(target=moving_entity) \
-            .filter(models.Intent.serialized_action[0] == control_movement_class_name).first()
+            .filter(models.Intent.action_type == control_movement_class_name).first()
 
         if moving_entity_intent:
             movement_info = {
@@ -332,7 +382,7 @@ def bind_to_vehicle(entity_id, entity_to_bind_to_id):
 
     db.session.commit()
     client_socket.emit("character.bind_to_vehicle_after",
-                       (str(g.character.id), [app.encode(entity_id) for entity_id in entities_in_union]))
+                       (str(g.character.id), app.encode_many(entities_in_union)))
 
 
 @socketio_character_event("character.unbind_from_vehicle")
@@ -348,7 +398,7 @@ def unbind_from_vehicle(entity_id):
 
     db.session.commit()
     client_socket.emit("character.unbind_from_vehicle_after",
-                       (str(g.character.id), [app.encode(union_member) for union_member in members_of_union]))
+                       (str(g.character.id), app.encode_many(members_of_union)))
     return ()
 
 
@@ -889,7 +939,7 @@ def get_intent_info(intent):
 
 
 def get_intent_name(intent):
-    return g.pyslate.t("action_info", **deferred.call(intent.serialized_action).pyslatize())
+    return g.pyslate.t("action_info", **intent.get_action().pyslatize())
 
 
 def _get_directed_passage_in_correct_direction(char_location, entity):
@@ -20,8 +20,13 @@ class Config:
     SQLALCHEMY_DATABASE_NAME = "exeris1"
     SQLALCHEMY_DATABASE_URI = SQLALCHEMY_DATABASE_URI_BASE + SQLALCHEMY_DATABASE_NAME
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    TRANSLATIONS_POOL_SIZE = 10
+    TRANSLATIONS_VERSION_CHECK_INTERVAL = 5  # in seconds
     SOCKETIO_REDIS_DATABASE_URI = "redis://localhost:6379/1"
     SOCKETIO_CORS_ALLOWED_ORIGINS = "*"
+    SOCKETIO_SID_TTL = 120  # in seconds, refreshed by heartbeats sent by the client
+    USE_EFFECTIVE_PROPERTIES = False  # read entity properties from Entity.effective_properties
+    SCHEDULER_COMBAT_WORKERS = 4  # number of processes running combat rounds, 0 to run them in the main scheduler
     REDIS_URL = "redis://localhost:6379/1"
     SECRET_KEY = "I LIKE POTATOES"
     STATIC_PATH = os.path.join('.', os.path.dirname(__file__))
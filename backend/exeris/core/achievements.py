@@ -1,6 +1,6 @@
+import collections
+
 import sqlalchemy as sql
-import sqlalchemy.dialects.postgresql as psql
-from sqlalchemy import func
 
 from exeris.core.main import hook
 from exeris.core import main, models
@@ -16,95 +16,247 @@ class AchievementEntries:
 
 
 class CheckHelper:
+    """
+    Checks of the progress details of a single AchievementCharacterProgress entry.
+    """
+
     @staticmethod
-    def check_list_min_length(name, character, min_length):
-        return ACProgress.query.filter_by(name=name, character=character).filter(
-            func.jsonb_array_length(ACProgress.details) >= min_length).first()
+    def check_list_min_length(min_length):
+        return lambda details: len(details) >= min_length
 
     @staticmethod
-    def check_min_number(name, character, min_length):
-        return ACProgress.query.filter_by(name=name, character=character).filter(
-            ACProgress.details >= sql.cast(min_length, psql.JSONB)).first()
+    def check_min_number(min_number):
+        return lambda details: details >= min_number
 
 
+# name, description, name of the progress entry it depends on, check of the details of this entry
 achievements = [
     ("superhero", "enter 5 different buildings",
-     lambda ch: CheckHelper.check_list_min_length(AchievementEntries.ENTERED_LOCATIONS, ch, 5)),
+     AchievementEntries.ENTERED_LOCATIONS, CheckHelper.check_list_min_length(5)),
     ("speaker", "speak 10 times",
-     lambda ch: CheckHelper.check_min_number(AchievementEntries.TEXTS_SPOKEN, ch, 10)),
+     AchievementEntries.TEXTS_SPOKEN, CheckHelper.check_min_number(10)),
     ("whisperer", "whisper to 3 people",
-     lambda ch: CheckHelper.check_list_min_length(AchievementEntries.WHISPERS, ch, 3)),
+     AchievementEntries.WHISPERS, CheckHelper.check_list_min_length(3)),
     ("potato_eater", "eat 2 potatoes",
-     lambda ch: CheckHelper.check_min_number(AchievementEntries.EATEN_POTATOES, ch, 2)),
+     AchievementEntries.EATEN_POTATOES, CheckHelper.check_min_number(2)),
 ]
 
+achievements_by_progress_name = collections.defaultdict(list)
+for _achievement in achievements:
+    achievements_by_progress_name[_achievement[2]].append(_achievement)
 
-def check_achievement_progress(player):
-    for achievement in achievements:
-        for character in player.alive_characters:
-            if achievement[2](character):
-                if not models.Achievement.query.filter_by(achiever=player, achievement=achievement[0]).first():
-                    db.session.add(models.Achievement(player, achievement[0]))
-                    notification = models.Notification("achievement_unlocked", {"name": achievement[0]}, "well_done",
-                                                       {}, player=player)
-                    db.session.add(notification)
-                    notification.add_close_option()
-                    main.call_hook(main.Hooks.NEW_CHARACTER_NOTIFICATION, character=character, notification=notification)
 
+class UnlockedAchievementsCache:
+    """
+    Names of achievements known to be unlocked by every player, loaded once per player.
+    Achievements unlocked in a transaction are added only after the root transaction is committed.
+    It can miss achievements unlocked by other processes, so the database is checked before unlocking.
+    Achievements loaded in a transaction which is rolled back can be uncommitted, so they are forgotten.
+    Only MAX_CACHED_PLAYERS players are kept, the ones unused for the longest time are forgotten first.
+    """
+    UNLOCKED_IN_TRANSACTION_KEY = "achievements_unlocked_in_transaction"
+    LOADED_IN_TRANSACTION_KEY = "achievements_loaded_in_transaction"
+    MAX_CACHED_PLAYERS = 1000
 
-class ProgressHelper:
-    @staticmethod
-    def add_to_set(name, character, element_to_add):
-        existing = ACProgress.query.filter_by(name=name, character=character).first()
-        if not existing:
-            new_entry = ACProgress(name, character, [element_to_add])
-            db.session.add(new_entry)
+    def __init__(self):
+        self._achievements_by_player_id = collections.OrderedDict()
+
+    def is_unlocked(self, session, player, achievement_name):
+        if player.id in self._achievements_by_player_id:
+            self._achievements_by_player_id.move_to_end(player.id)
+        else:
+            session.info.setdefault(self.LOADED_IN_TRANSACTION_KEY, set()).add(player.id)
+            self._achievements_by_player_id[player.id] = {
+                achievement.achievement for achievement in models.Achievement.query.filter_by(achiever=player).all()}
+            if len(self._achievements_by_player_id) > self.MAX_CACHED_PLAYERS:
+                self._achievements_by_player_id.popitem(last=False)
+        if achievement_name in self._achievements_by_player_id[player.id]:
             return True
 
-        elements_set = set(existing.details)
-        old_len = len(elements_set)
-        elements_set.add(element_to_add)
-        existing.details = list(elements_set)
+        unlocked = models.Achievement.query.filter_by(achiever=player, achievement=achievement_name).first()
+        if unlocked:
+            self._achievements_by_player_id[player.id].add(achievement_name)
+        return bool(unlocked)
+
+    def add_unlocked_in_transaction(self, session, player, achievement_name):
+        session.info.setdefault(self.UNLOCKED_IN_TRANSACTION_KEY, []).append((player.id, achievement_name))
+
+    def is_unlocked_in_transaction(self, session, player, achievement_name):
+        return (player.id, achievement_name) in session.info.get(self.UNLOCKED_IN_TRANSACTION_KEY, [])
+
+    def commit(self, session):
+        session.info.pop(self.LOADED_IN_TRANSACTION_KEY, None)
+        for player_id, achievement_name in session.info.pop(self.UNLOCKED_IN_TRANSACTION_KEY, []):
+            if player_id in self._achievements_by_player_id:
+                self._achievements_by_player_id[player_id].add(achievement_name)
+
+    def rollback(self, session):
+        session.info.pop(self.UNLOCKED_IN_TRANSACTION_KEY, None)
+        for player_id in session.info.pop(self.LOADED_IN_TRANSACTION_KEY, set()):
+            self._achievements_by_player_id.pop(player_id, None)
+
+
+unlocked_achievements = UnlockedAchievementsCache()
+
+NEW_NOTIFICATIONS_KEY = "achievements_new_notifications"
+
+
+class ProgressBuffer:
+    """
+    Progress of characters gathered since the last flush. It's saved and the affected achievements are checked
+    just before the flush, so a single query loads all the progress entries changed in the meantime.
+    """
+    SESSION_KEY = "achievements_progress_buffer"
+
+    def __init__(self):
+        self.counter_increments = collections.OrderedDict()  # (character, progress name) -> increment
+        self.added_set_elements = collections.OrderedDict()  # (character, progress name) -> list of new elements
+
+    @classmethod
+    def for_session(cls, session=None):
+        session = session if session is not None else db.session()
+        return session.info.setdefault(cls.SESSION_KEY, cls())
+
+    def increment_counter(self, name, character, by_value=1):
+        key = character, name
+        self.counter_increments[key] = self.counter_increments.get(key, 0) + by_value
+
+    def add_to_set(self, name, character, element_to_add):
+        elements = self.added_set_elements.setdefault((character, name), [])
+        if element_to_add not in elements:
+            elements.append(element_to_add)
+
+    def save(self, session):
+        """
+        Saves the buffered progress and returns a list of progress entries which have really changed.
+        """
+        keys = list(self.counter_increments.keys()) + [key for key in self.added_set_elements
+                                                       if key not in self.counter_increments]
+        existing_progress_by_key = self._load_existing_progress(keys)
+
+        changed_progress = []
+        for (character, name), increment in self.counter_increments.items():
+            progress = existing_progress_by_key.get((character.id, name))
+            if not progress:
+                progress = ACProgress(name, character, increment)
+                session.add(progress)
+            else:
+                progress.details += increment
+            changed_progress.append(progress)
+
+        for (character, name), elements_to_add in self.added_set_elements.items():
+            progress = existing_progress_by_key.get((character.id, name))
+            if not progress:
+                progress = ACProgress(name, character, elements_to_add)
+                session.add(progress)
+                changed_progress.append(progress)
+                continue
 
-        return old_len == len(elements_set)  # check if set was really changed
+            new_elements = [element for element in elements_to_add if element not in progress.details]
+            if new_elements:  # check if set was really changed
+                progress.details = progress.details + new_elements
+                changed_progress.append(progress)
+
+        return changed_progress
 
     @staticmethod
-    def increment_counter(name, character, by_value=1):
-        existing = ACProgress.query.filter_by(name=name, character=character).first()
-        if not existing:
-            new_entry = ACProgress(name, character, by_value)
-            db.session.add(new_entry)
-            return True
+    def _load_existing_progress(keys):
+        persistent_keys = [(character.id, name) for character, name in keys if character.id is not None]
+        if not persistent_keys:
+            return {}
+        existing_progress = ACProgress.query.filter(
+            sql.tuple_(ACProgress.character_id, ACProgress.name).in_(persistent_keys)).all()
+        return {(progress.character_id, progress.name): progress for progress in existing_progress}
+
+
+def check_achievement_progress(session, changed_progress):
+    """
+    Unlocks achievements depending on the changed progress entries, if they are not unlocked yet.
+    Returns a list of pairs (character, notification) for the unlocked achievements.
+    """
+    new_notifications = []
+    for progress in changed_progress:
+        character = progress.character
+        player = character.player
+        for achievement in achievements_by_progress_name[progress.name]:
+            if not achievement[3](progress.details):
+                continue
+            if unlocked_achievements.is_unlocked_in_transaction(session, player, achievement[0]) \
+                    or unlocked_achievements.is_unlocked(session, player, achievement[0]):
+                continue
+
+            session.add(models.Achievement(player, achievement[0]))
+            unlocked_achievements.add_unlocked_in_transaction(session, player, achievement[0])
+            notification = models.Notification("achievement_unlocked", {"name": achievement[0]}, "well_done",
+                                               {}, player=player)
+            session.add(notification)
+            new_notifications.append((character, notification))
+    return new_notifications
+
+
+def save_buffered_progress(session):
+    progress_buffer = session.info.pop(ProgressBuffer.SESSION_KEY, None)
+    if progress_buffer:
+        changed_progress = progress_buffer.save(session)
+        new_notifications = check_achievement_progress(session, changed_progress)
+        session.info.setdefault(NEW_NOTIFICATIONS_KEY, []).extend(new_notifications)
+
+
+@sql.event.listens_for(sql.orm.Session, "before_flush")
+def save_progress_and_check_achievements(session, flush_context, instances):
+    save_buffered_progress(session)
+
 
-        existing.details += by_value
-        return True  # always changed
+# the hooks are usually called after the events are flushed, and a flush of a clean session doesn't call before_flush,
+# so the progress is also saved before a commit and before a query (which then autoflushes it)
+@sql.event.listens_for(sql.orm.Session, "before_commit")
+def save_progress_before_commit(session):
+    save_buffered_progress(session)
+
+
+@sql.event.listens_for(sql.orm.Query, "before_compile", bake_ok=True)  # the query itself is not changed
+def save_progress_before_query(query):
+    if query.session is not None:
+        save_buffered_progress(query.session)
+
+
+@sql.event.listens_for(sql.orm.Session, "after_flush_postexec")
+def announce_unlocked_achievements(session, flush_context):
+    # notifications have ids only after the flush, the close options are saved by the next flush
+    for character, notification in session.info.pop(NEW_NOTIFICATIONS_KEY, []):
+        notification.add_close_option()
+        main.call_hook(main.Hooks.NEW_CHARACTER_NOTIFICATION, character=character, notification=notification)
+
+
+@sql.event.listens_for(sql.orm.Session, "after_commit")
+def remember_unlocked_achievements(session):
+    if not session.transaction.nested:  # releasing a savepoint doesn't commit anything yet
+        unlocked_achievements.commit(session)
+
+
+@sql.event.listens_for(sql.orm.Session, "after_soft_rollback")
+def forget_progress_and_unlocked_achievements(session, previous_transaction):
+    session.info.pop(ProgressBuffer.SESSION_KEY, None)
+    session.info.pop(NEW_NOTIFICATIONS_KEY, None)
+    unlocked_achievements.rollback(session)
 
 
 @hook(main.Hooks.LOCATION_ENTERED)
 def on_location_entered(*, character, from_loc, to_loc):
-    changed = ProgressHelper.add_to_set(AchievementEntries.ENTERED_LOCATIONS, character, to_loc.id)
-    if changed:
-        check_achievement_progress(character.player)
+    ProgressBuffer.for_session().add_to_set(AchievementEntries.ENTERED_LOCATIONS, character, to_loc.id)
 
 
 @hook(main.Hooks.SPOKEN_ALOUD)
 def on_spoken_aloud(*, character):
-    changed = ProgressHelper.increment_counter(AchievementEntries.TEXTS_SPOKEN, character)
-    if changed:
-        check_achievement_progress(character.player)
+    ProgressBuffer.for_session().increment_counter(AchievementEntries.TEXTS_SPOKEN, character)
 
 
 @hook(main.Hooks.WHISPERED)
 def on_whispered(*, character, to_character):
-    changed = ProgressHelper.add_to_set(AchievementEntries.WHISPERS, character, to_character.id)
-    if changed:
-        check_achievement_progress(character.player)
+    ProgressBuffer.for_session().add_to_set(AchievementEntries.WHISPERS, character, to_character.id)
 
 
 @hook(main.Hooks.EATEN)
 def on_eaten(*, character, item, amount):
     if item.type_name == "potatoes":
-        changed = ProgressHelper.increment_counter(AchievementEntries.EATEN_POTATOES, character, amount)
-        if changed:
-            check_achievement_progress(character.player)
-
+        ProgressBuffer.for_session().increment_counter(AchievementEntries.EATEN_POTATOES, character, amount)
@@ -1,8 +1,11 @@
+import collections
 import math
 import sys
 from statistics import mean
 
 import random
+import time
+
 import sqlalchemy as sql
 from shapely.geometry import Point, LineString
 
@@ -510,13 +513,14 @@ class WorkProcess(ProcessAction):
     def perform_action(self):
         work_intents = models.Intent.query.filter_by(type=main.Intents.WORK).order_by(
             models.Intent.priority.desc()).all()
+        models.Intent.preload_actions(work_intents)
 
         activities_to_progress = {}
         for work_intent in work_intents:
             # in fact it shouldn't move anything, it should store intermediate data about direction and speed for each
             # RootLocation, because there can be multi-location vehicles.
             # But there can also be 2 separate veh in one RootLocation
-            action_to_perform = deferred.call(work_intent.serialized_action)
+            action_to_perform = work_intent.get_action()
 
             if isinstance(action_to_perform, WorkOnActivityAction):
                 # activities are handled differently, because all participants must be converted at once
@@ -533,7 +537,7 @@ class WorkProcess(ProcessAction):
                     logger.info("Intent %s of %s finished successfully. Removing it",
                                 str(action_to_perform), str(work_intent.executor))
                     db.session.delete(work_intent)
-                work_intent.serialized_action = deferred.serialize(action_to_perform)
+                work_intent.set_action(action_to_perform)
                 db.session.commit()
             except main.TurningIntoIntentExceptionMixin:
                 db.session.rollback()  # for actions that need to be tried every tick
@@ -588,11 +592,6 @@ class WorkProcess(ProcessAction):
         else:
             entities = []
 
-        # caching
-        # entity_ids = [entity.id for entity in entities]
-        # cached_union_members = models.EntityProperty.query.filter_by(name=P.MEMBER_OF_UNION) \
-        #     .filter(models.EntityProperty.entity_id.in_(entity_ids)).all()
-
         union_representatives = {}
         travel_credits_by_representative = {}
         mobile_entities_count_by_representative = {}
@@ -602,6 +601,7 @@ class WorkProcess(ProcessAction):
         # when in union then one entity becomes union's representative, otherwise it's its own representative
         self.select_representatives_for_entities(entities, mobile_entities_count_by_representative,
                                                  travel_credits_by_representative, union_representatives)
+        union_members_by_representative = self.get_union_members_of_representatives(union_representatives)
 
         for entity in entities:
             self.calculate_movement_contribution_from_entities(entity, mobile_entities_count_by_representative,
@@ -614,7 +614,9 @@ class WorkProcess(ProcessAction):
                                                              mobile_entities_count_by_representative[representative],
                                                              travel_credits_by_representative[representative],
                                                              targets_by_representative[representative],
-                                                             allowed_terrains_by_representative[representative])
+                                                             allowed_terrains_by_representative[representative],
+                                                             union_members_by_representative.get(representative,
+                                                                                                 [representative]))
 
     def select_representatives_for_entities(self, entities, number_of_mobile_entities,
                                             travel_credits_in_union_by_entity, union_representatives):
@@ -627,6 +629,13 @@ class WorkProcess(ProcessAction):
                 if union_id is not None:
                     union_representatives[union_id] = entity
 
+    @staticmethod
+    def get_union_members_of_representatives(union_representatives):
+        entity_properties_by_union_id = properties.OptionalMemberOfUnionProperty.get_entity_properties_of_unions(
+            union_representatives.keys())
+        return {representative: [entity_property.entity for entity_property in entity_properties_by_union_id[union_id]]
+                for union_id, representative in union_representatives.items()}
+
     def calculate_movement_contribution_from_entities(self, entity, mobile_entities_count_by_representative,
                                                       travel_credits_by_representative, union_representatives,
                                                       targets_by_representative, allowed_terrains_by_representative):
@@ -663,7 +672,8 @@ class WorkProcess(ProcessAction):
                 entity_being_moved_property.set_inertia(rho, phi)
 
     def move_entity_based_on_movement_contributions(self, representative, mobile_entities_in_union_count,
-                                                    travel_credits_in_union, travel_targets, allowed_terrains):
+                                                    travel_credits_in_union, travel_targets, allowed_terrains,
+                                                    union_members):
         travel_credits, direction = util.cart_to_pol(
             Point(travel_credits_in_union.x / mobile_entities_in_union_count,
                   travel_credits_in_union.y / mobile_entities_in_union_count))
@@ -678,8 +688,8 @@ class WorkProcess(ProcessAction):
                 destination_pos, representative, initial_pos, travel_targets[0]):
             return
         else:
-            move_entity_to_position(representative, direction, destination_pos)
-        for union_member in _get_union_members_or_itself(representative):
+            move_entity_to_position(representative, direction, destination_pos, union_members=union_members)
+        for union_member in union_members:
             if isinstance(union_member, models.Character):
                 characters_to_call = [union_member]
             else:
@@ -725,7 +735,7 @@ def _get_union_members_or_itself(entity):
         return [entity]
 
 
-def move_entity_to_position(entity, direction, target_position):
+def move_entity_to_position(entity, direction, target_position, union_members=None):
     if isinstance(entity, models.RootLocation):
         raise ValueError("One shall not move a sole RootLocation {}".format(entity))
     old_root = entity.get_root()
@@ -733,14 +743,17 @@ def move_entity_to_position(entity, direction, target_position):
     if old_root.position != target_position:
         root_location = models.RootLocation.query.filter_by(position=target_position.wkt).first()
         if not root_location:
-            union_members = _get_union_members_or_itself(entity)
+            if union_members is None:
+                union_members = _get_union_members_or_itself(entity)
             if old_root.is_empty(excluding=union_members):
                 # there's nothing else, so we can move this RootLocation
                 old_root.position = target_position
                 old_root.direction = direction
 
                 # remove to avoid situations like moving a city with observed name
-                models.ObservedName.query.filter_by(target=old_root).delete()
+                observed_names = models.ObservedName.query.filter_by(target=old_root)
+                models.EventObserver.invalidate_rendered_texts([name.observer_id for name in observed_names])
+                observed_names.delete()
             else:
                 root_location = models.RootLocation(target_position, direction)
                 db.session.add(root_location)
@@ -760,13 +773,22 @@ class FightInCombatAction(Action):
         self.stance = stance
 
     def perform_action(self):
-        foe_combat_actions = combat.get_combat_actions_of_visible_foes(self.executor, self.combat_entity)
-        combat_action_of_target = combat.get_hit_target(self, foe_combat_actions)
+        return self.perform_in_round(combat.CombatRound.load(self.combat_entity))
+
+    def perform_in_round(self, combat_round):
+        """
+        Performs the action using the state of the combat round shared by all the fighters.
+        :param combat_round: :class:`exeris.core.combat.CombatRound` of the combat
+        :return: pair of the hit target's combat action (or None) and a list of combat actions of all potential targets
+        """
+        foe_combat_actions = combat.get_combat_actions_of_visible_foes(self.executor, self.combat_entity,
+                                                                       combat_round)
+        combat_action_of_target = combat.get_hit_target(self, foe_combat_actions, combat_round)
 
         if combat_action_of_target:
             self.execute_hit(combat_action_of_target)
 
-        self.perform_first_auxiliary_action()
+        self.perform_first_auxiliary_action(combat_round)
 
         return combat_action_of_target, foe_combat_actions
 
@@ -791,9 +813,8 @@ class FightInCombatAction(Action):
             hit_damage /= 2
         return hit_damage
 
-    def perform_first_auxiliary_action(self):
-        auxiliary_action_to_perform = models.Intent.query.filter_by(type=main.Intents.COMBAT_AUXILIARY_ACTION,
-                                                                    executor=self.executor).first()
+    def perform_first_auxiliary_action(self, combat_round):
+        auxiliary_action_to_perform = combat_round.get_auxiliary_intent(self.executor)
         if auxiliary_action_to_perform:
             logger.debug("Performing auxiliary combat action: %s", auxiliary_action_to_perform)
             auxiliary_action_to_perform.perform()
@@ -1203,7 +1224,10 @@ class EatingProcess(ProcessAction):
         return 1 + max(0, (sum(vals) / EatingProcess.FOOD_BASED_ATTR_MAX_POSSIBLE_INCREASE - 1) * 0.3)
 
     def perform_action(self):
-        characters = models.Character.query.all()
+        # states of characters are also changed by combat rounds run concurrently by other schedulers,
+        # so they are locked the same way, in the order of ids, till the end of the transaction
+        characters = models.Character.query.order_by(models.Character.id) \
+            .with_for_update().populate_existing().all()
 
         for character in characters:
             character.states[main.States.HUNGER] += EatingProcess.HUNGER_INCREASE
@@ -1228,8 +1252,7 @@ class EatingProcess(ProcessAction):
                 character.states[attribute] += increase * EatingProcess.bonus_mult(attributes_to_increase.values())
             character.eating_queue = eating_queue
 
-        hungry_characters = models.Character.query \
-            .filter(models.Character.states[main.States.HUNGER].astext.cast(sql.Float) == 1.0).all()
+        hungry_characters = models.Character.query.filter(models.Character.hunger == 1.0).all()
         for character in hungry_characters:
             character.damage += EatingProcess.STARVATION_DAMAGE
 
@@ -1253,11 +1276,13 @@ class DecayProcess(ProcessAction):
         self.decay_abandoned_activities()
 
     def degrade_items(self):
+        # items (e.g. animals) can be fighters too, so they are locked like in combat rounds
         items_and_props = db.session.query(models.Item, models.EntityTypeProperty) \
             .join(models.ItemType, models.Item.type_name == models.ItemType.name).filter(
             sql.and_(models.ItemType.name == models.EntityTypeProperty.type_name,  # ON clause
                      models.Item.role == models.Item.ROLE_BEING_IN,
-                     models.EntityTypeProperty.name == P.DEGRADABLE)).all()  # handle all items
+                     models.EntityTypeProperty.name == P.DEGRADABLE)) \
+            .order_by(models.Item.id).with_for_update(of=models.Item).populate_existing().all()  # handle all items
         for item, degradable_prop in items_and_props:
             item_lifetime = degradable_prop.data["lifetime"]
             damage_fraction_to_add_since_last_tick = DecayProcess.SCHEDULER_RUNNING_INTERVAL / item_lifetime
@@ -1292,7 +1317,9 @@ class DecayProcess(ProcessAction):
                 .join(models.ItemType, models.Item.type_name == models.ItemType.name).filter(
                 sql.and_(models.ItemType.name == models.EntityTypeProperty.type_name,  # ON clause
                          models.Item.is_used_for(activity),
-                         models.EntityTypeProperty.name == P.DEGRADABLE)).all()  # handle all normal stackables
+                         models.EntityTypeProperty.name == P.DEGRADABLE)) \
+                .order_by(models.Item.id).with_for_update(of=models.Item).populate_existing() \
+                .all()  # handle all normal stackables
             for item, degradable_prop in items_and_props:
                 item_lifetime = degradable_prop.data["lifetime"]
                 damage_fraction_to_add_since_last_tick = DecayProcess.SCHEDULER_RUNNING_INTERVAL / item_lifetime
@@ -1325,6 +1352,59 @@ class DecayProcess(ProcessAction):
                     del requirement_params["used_type"]  # allow any type to fulfill the group
 
 
+class EventsRetentionProcess(ProcessAction):
+    """
+    Moves events older than RETENTION_PERIOD to the archived_events table,
+    so events table contains only the recent history.
+    Their EventObservers are removed by the database (ON DELETE CASCADE), observer ids are kept in the archive.
+    It's done in batches to avoid keeping a lock on a huge part of the table.
+    """
+    SCHEDULER_RUNNING_INTERVAL = general.GameDate.SEC_IN_DAY
+    RETENTION_PERIOD = 3 * general.GameDate.SEC_IN_MOON
+    BATCH_SIZE = 1000
+
+    def __init__(self, task):
+        super().__init__(task)
+
+    def perform_action(self):
+        oldest_retained_date = general.GameDate.now().game_timestamp - EventsRetentionProcess.RETENTION_PERIOD
+
+        archived_snapshot_hashes = set()
+        while True:
+            old_events = models.Event.query.filter(models.Event.date < oldest_retained_date) \
+                .order_by(models.Event.id).limit(EventsRetentionProcess.BATCH_SIZE).all()
+            if not old_events:
+                break
+            archived_snapshot_hashes.update(self.archive_events(old_events))
+            logger.info("Archived %s events older than %s", len(old_events), oldest_retained_date)
+            if len(old_events) < EventsRetentionProcess.BATCH_SIZE:
+                break
+
+        # snapshots referenced by the archived events can also be referenced by the retained ones
+        models.EntitySnapshot.remove_unreferenced(archived_snapshot_hashes)
+
+    @staticmethod
+    def archive_events(events):
+        """
+        :return: hashes of entity snapshots which were referenced by the archived events
+        """
+        event_ids = [event.id for event in events]
+        observer_ids_by_event_id = collections.defaultdict(list)
+        for event_id, observer_id in db.session.query(models.EventObserver.event_id, models.EventObserver.observer_id) \
+                .filter(models.EventObserver.event_id.in_(event_ids)).all():
+            observer_ids_by_event_id[event_id].append(observer_id)
+
+        models.Event.resolve_params_of_events(events)
+        db.session.bulk_save_objects([models.ArchivedEvent(event, observer_ids_by_event_id[event.id])
+                                      for event in events])
+        models.Event.query.filter(models.Event.id.in_(event_ids)).delete(synchronize_session=False)
+        referenced_snapshot_hashes = {snapshot_hash for event in events
+                                      for snapshot_hash in event.referenced_snapshots}
+        for event in events:
+            db.session.expunge(event)
+        return referenced_snapshot_hashes
+
+
 class CombatProcess(ProcessAction):
     SCHEDULER_RUNNING_INTERVAL = 30  # 3 * general.GameDate.SEC_IN_HOUR
     INITIAL_RUN_DELAY = 3  # 6 * general.GameDate.SEC_IN_HOUR
@@ -1339,18 +1419,42 @@ class CombatProcess(ProcessAction):
         self.combat_entity = combat_entity
 
     def deserialized_action(self, intent):
-        return deferred.call(intent.serialized_action)
+        return intent.get_action()
 
     def perform_action(self):
+        round_start_time = time.monotonic()
 
         fighter_intents = self.combat_entity.fighters_intents()
+        self._lock_combat_and_fighters(fighter_intents)
+        combat_round = combat.CombatRound(self.combat_entity, fighter_intents)
+
+        self._resolve_round(combat_round, fighter_intents)
 
+        round_duration = time.monotonic() - round_start_time
+        combat.round_timings.record(round_duration)
+        logger.info("Round of %s with %s fighters resolved in %.3f s", self.combat_entity, len(fighter_intents),
+                    round_duration)
+        main.call_hook(main.Hooks.COMBAT_ROUND_RESOLVED, combat_entity=self.combat_entity,
+                       fighters_count=len(fighter_intents), duration=round_duration)
+
+    def _lock_combat_and_fighters(self, fighter_intents):
+        """
+        Combats can be run concurrently by many schedulers, so the combat entity and all the fighters are locked
+        till the end of the transaction. A fighter who is in range of a few combats is then updated
+        by only one round at once. Rows are always locked in the order of ids, so two rounds can't deadlock.
+        Locked rows are reloaded to get changes committed by the other rounds.
+        """
+        entity_ids = sorted({self.combat_entity.id} | {intent.executor_id for intent in fighter_intents})
+        models.Entity.query.filter(models.Entity.id.in_(entity_ids)).order_by(models.Entity.id) \
+            .with_for_update().populate_existing().all()
+
+    def _resolve_round(self, combat_round, fighter_intents):
         all_potential_targets = set()  # participants who are or could have been a target of hit
         retreated_fighters_intents = set()
         for fighter_intent in fighter_intents:
             fighter_combat_action = self.deserialized_action(fighter_intent)
-            if self.combat_entity.is_able_to_fight(fighter_intent.executor):
-                target_action, potential_targets_actions = fighter_combat_action.perform()
+            if combat_round.is_able_to_fight(fighter_intent.executor):
+                target_action, potential_targets_actions = fighter_combat_action.perform_in_round(combat_round)
             else:
                 target_action, potential_targets_actions = None, []
 
@@ -1366,11 +1470,12 @@ class CombatProcess(ProcessAction):
                 if self.try_to_retreat(fighter_intent):
                     logger.debug("Retreat successful")
                     retreated_fighters_intents.add(fighter_intent)
+                    combat_round.remove_fighter(fighter_intent.executor)
 
         logger.debug("All potential targets are: %s", all_potential_targets)
         active_fighter_intents = [intent for intent in fighter_intents
                                   if intent.executor in all_potential_targets
-                                  and self.combat_entity.is_able_to_fight(intent.executor)
+                                  and combat_round.is_able_to_fight(intent.executor)
                                   and intent not in retreated_fighters_intents]  # fighters which will stay in combat
         fighter_intents_to_remove = [intent for intent in fighter_intents if intent not in active_fighter_intents]
 
@@ -1378,7 +1483,7 @@ class CombatProcess(ProcessAction):
             self.withdraw_from_combat(intent_to_remove)
 
         fighters_able_to_fight = [intent for intent in active_fighter_intents if
-                                  self.combat_entity.is_able_to_fight(intent.executor)]
+                                  combat_round.is_able_to_fight(intent.executor)]
         number_of_combat_sides_participating = set([self.deserialized_action(i).side for i in fighters_able_to_fight])
         there_are_fighters_on_both_sides = len(number_of_combat_sides_participating) == 2
 
@@ -1681,6 +1786,113 @@ class EatAction(ActionOnItem):
         main.call_hook(main.Hooks.EATEN, character=self.executor, item=self.item, amount=self.amount)
 
 
+class AnimalsBatch:
+    """
+    Data needed to simulate many animals at once, shared by all the animal actions performed by AnimalsProcess.
+    Animal-related properties of all the animals are loaded using a single query per table and everything shared
+    by animals standing in the same place (food on the ground and in storages, terrain, nests)
+    is queried only once for that place.
+    """
+    LOADED_PROPERTIES = [P.ANIMAL, P.DOMESTICATED]
+
+    def __init__(self, animals):
+        self.animals = animals
+
+        self._entity_property_by_key = {}
+        self._type_property_by_key = {}
+        if animals:
+            entity_properties = models.EntityProperty.query \
+                .filter(models.EntityProperty.entity_id.in_(models.ids(animals))) \
+                .filter(models.EntityProperty.name.in_(self.LOADED_PROPERTIES)).all()
+            self._entity_property_by_key = {(prop.entity_id, prop.name): prop for prop in entity_properties}
+            type_properties = models.EntityTypeProperty.query \
+                .filter(models.EntityTypeProperty.type_name.in_({animal.type.name for animal in animals})) \
+                .filter(models.EntityTypeProperty.name.in_(self.LOADED_PROPERTIES)).all()
+            self._type_property_by_key = {(prop.type_name, prop.name): prop for prop in type_properties}
+
+        self._is_root_location_near_by_location = {}
+        self._edible_resource_areas_by_position = {}
+        self._terrain_existence_by_position_and_types = {}
+        self._foods_in_storages_by_location = {}
+        self._nest_by_location = {}
+        self._edibility_by_eater_types_and_type = {}
+        self._edible_by_animal_property_by_food = {}
+
+    def get_property(self, animal, name):
+        if name not in self.LOADED_PROPERTIES:
+            return animal.get_property(name)
+
+        type_property = self._type_property_by_key.get((animal.type.name, name))
+        entity_property = self._entity_property_by_key.get((animal.id, name))
+        if not type_property and not entity_property:
+            return None
+        props = {}
+        if type_property:
+            props.update(type_property.data)
+        if entity_property:
+            props.update(entity_property.data)
+        return props
+
+    def get_entity_property(self, animal, name):
+        if name not in self.LOADED_PROPERTIES:
+            return animal.get_entity_property(name)
+        return self._entity_property_by_key.get((animal.id, name))
+
+    def is_any_root_location_near(self, animal):
+        location = animal if isinstance(animal, models.Location) else animal.being_in
+        if location not in self._is_root_location_near_by_location:
+            neighbouring_locations = general.NeighbouringLocationsRange(only_through_unlimited=True)
+            self._is_root_location_near_by_location[location] = \
+                bool(neighbouring_locations.root_locations_near(animal))
+        return self._is_root_location_near_by_location[location]
+
+    def get_edible_resource_areas(self, position):
+        if position.wkt not in self._edible_resource_areas_by_position:
+            self._edible_resource_areas_by_position[position.wkt] = models.ResourceArea.query \
+                .filter(models.ResourceArea.in_area(position)) \
+                .filter(models.ItemType.has_property(P.EDIBLE_BY_ANIMAL)).all()
+        return self._edible_resource_areas_by_position[position.wkt]
+
+    def is_terrain_of_types(self, position, terrain_types):
+        key = position.wkt, tuple(sorted(terrain_types))
+        if key not in self._terrain_existence_by_position_and_types:
+            terrain = models.TerrainArea.query.filter(models.TerrainArea.terrain.ST_Intersects(position.wkt)) \
+                .filter(models.TerrainArea.type_name.in_(terrain_types)).first()
+            self._terrain_existence_by_position_and_types[key] = terrain is not None
+        return self._terrain_existence_by_position_and_types[key]
+
+    def get_foods_in_storages(self, location):
+        """
+        Returns a list of pairs (storage, food) for all the food edible by animals which is in storages in the location.
+        """
+        if location not in self._foods_in_storages_by_location:
+            storages = models.Item.query.filter(models.Item.is_in(location)) \
+                .filter(models.Item.has_property(P.STORAGE)).all()
+            foods = models.Item.query.filter(models.Item.is_in(storages)) \
+                .filter(models.Item.has_property(P.EDIBLE_BY_ANIMAL)).all() if storages else []
+            self._foods_in_storages_by_location[location] = [(storage, food) for storage in storages
+                                                             for food in foods if food.being_in == storage]
+        return self._foods_in_storages_by_location[location]
+
+    def get_edible_by_animal_property(self, food):
+        if food not in self._edible_by_animal_property_by_food:
+            self._edible_by_animal_property_by_food[food] = food.get_property(P.EDIBLE_BY_ANIMAL)
+        return self._edible_by_animal_property_by_food[food]
+
+    def is_edible_by(self, eater_types, animal):
+        key = tuple(eater_types), animal.type.name
+        if key not in self._edibility_by_eater_types_and_type:
+            self._edibility_by_eater_types_and_type[key] = any(
+                models.EntityType.by_name(eater_type).contains(animal.type) for eater_type in eater_types)
+        return self._edibility_by_eater_types_and_type[key]
+
+    def get_nest(self, location):
+        if location not in self._nest_by_location:
+            self._nest_by_location[location] = models.Item.query.filter(models.Item.has_property(P.BIRD_NEST)) \
+                .filter(models.Item.is_in(location)).first()
+        return self._nest_by_location[location]
+
+
 class AnimalEatingAction(Action):
     HUNGER_INCREASE = 0.1
     DAMAGE_WHEN_STARVING = 0.1
@@ -1689,15 +1901,17 @@ class AnimalEatingAction(Action):
         super().__init__(executor)
 
     def perform_action(self):
-        animal_prop = self.executor.get_property(P.ANIMAL)
+        return self.perform_in_batch(AnimalsBatch([self.executor]))
+
+    def perform_in_batch(self, animals_batch):
+        self.animals_batch = animals_batch
+        animal_prop = animals_batch.get_property(self.executor, P.ANIMAL)
         if animal_prop is None:
             raise ValueError("{} is not an animal".format(self.executor))
 
         self.executor.states[main.States.HUNGER] += AnimalEatingAction.HUNGER_INCREASE
 
-        neighbouring_locations = general.NeighbouringLocationsRange(only_through_unlimited=True)
-        any_root_location_near = neighbouring_locations.root_locations_near(self.executor)
-        if any_root_location_near:
+        if animals_batch.is_any_root_location_near(self.executor):
             self.eat_from_ground()
 
         if self.executor.states[main.States.HUNGER] > 0:  # need to eat more from storages
@@ -1708,9 +1922,7 @@ class AnimalEatingAction(Action):
 
     def eat_from_ground(self):
         logger.debug("Eat from the ground")
-        resource_areas = models.ResourceArea.query \
-            .filter(models.ResourceArea.in_area(self.executor.get_position())) \
-            .filter(models.ItemType.has_property(P.EDIBLE_BY_ANIMAL)).all()
+        resource_areas = self.animals_batch.get_edible_resource_areas(self.executor.get_position())
         for resource_area in resource_areas:  # eat from the ground
             logger.debug("Trying to eat from %s", resource_area)
             resource_type = resource_area.resource_type
@@ -1731,21 +1943,14 @@ class AnimalEatingAction(Action):
 
     def try_to_eat_from_storages(self):
         logger.debug("Eat from the storages")
-        storages = models.Item.query.filter(models.Item.is_in(self.executor.being_in)) \
-            .filter(models.Item.has_property(P.STORAGE)).all()
-        for storage in storages:
-            foods_in_storage = models.Item.query \
-                .filter(models.Item.is_in(storage)) \
-                .filter(models.Item.has_property(P.EDIBLE_BY_ANIMAL)) \
-                .all()
-
-            for food in foods_in_storage:
-                if self.executor.states[main.States.HUNGER] > 0:
-                    logger.debug("Eating %s from %s", food, storage)
-                    self.try_to_eat_food_from_storage(food)
+        for storage, food in self.animals_batch.get_foods_in_storages(self.executor.being_in):
+            # food could have been entirely eaten by another animal
+            if self.executor.states[main.States.HUNGER] > 0 and food.being_in == storage:
+                logger.debug("Eating %s from %s", food, storage)
+                self.try_to_eat_food_from_storage(food)
 
     def try_to_eat_food_from_storage(self, food):
-        edible_by_animal_prop = food.get_property(P.EDIBLE_BY_ANIMAL)
+        edible_by_animal_prop = self.animals_batch.get_edible_by_animal_property(food)
         if self.is_edible_by_animal(edible_by_animal_prop["eater_types"]):
             hunger_decrease_per_piece = edible_by_animal_prop["states"][main.States.HUNGER]
             pieces_eaten = min(math.ceil(self.executor.states[main.States.HUNGER] / -hunger_decrease_per_piece),
@@ -1755,19 +1960,13 @@ class AnimalEatingAction(Action):
             self.executor.states[main.States.HUNGER] += pieces_eaten * hunger_decrease_per_piece
 
     def is_edible_by_animal(self, eater_types):
-        for eater_type in eater_types:
-            if models.EntityType.by_name(eater_type).contains(self.executor.type):
-                return True
-        return False
+        return self.animals_batch.is_edible_by(eater_types, self.executor)
 
     def can_eat_from_terrain_type(self, terrain_types):
         if not terrain_types:
             return True
 
-        position = self.executor.get_position()
-        terrain = models.TerrainArea.query.filter(models.TerrainArea.terrain.ST_Intersects(position.wkt)) \
-            .filter(models.TerrainArea.type_name.in_(terrain_types)).first()
-        return terrain is not None
+        return self.animals_batch.is_terrain_of_types(self.executor.get_position(), terrain_types)
 
 
 class AnimalStateProgressAction(Action):
@@ -1775,9 +1974,12 @@ class AnimalStateProgressAction(Action):
         super().__init__(executor)
 
     def perform_action(self):
-        animal_prop = self.executor.get_property(P.ANIMAL)
-        animal_entity_prop = self.executor.get_entity_property(P.ANIMAL)
-        domesticated_prop = self.executor.get_property(P.DOMESTICATED)
+        return self.perform_in_batch(AnimalsBatch([self.executor]))
+
+    def perform_in_batch(self, animals_batch):
+        animal_prop = animals_batch.get_property(self.executor, P.ANIMAL)
+        animal_entity_prop = animals_batch.get_entity_property(self.executor, P.ANIMAL)
+        domesticated_prop = animals_batch.get_property(self.executor, P.DOMESTICATED)
         if animal_prop is None or domesticated_prop is None:
             raise ValueError("{} is not domesticated".format(self.executor))
 
@@ -1794,9 +1996,12 @@ class LayEggsAction(Action):
         super().__init__(executor)
 
     def perform_action(self):
-        animal_entity_prop = self.executor.get_entity_property(P.ANIMAL)
-        animal_prop = self.executor.get_property(P.ANIMAL)
-        domesticated_prop = self.executor.get_property(P.DOMESTICATED)
+        return self.perform_in_batch(AnimalsBatch([self.executor]))
+
+    def perform_in_batch(self, animals_batch):
+        animal_entity_prop = animals_batch.get_entity_property(self.executor, P.ANIMAL)
+        animal_prop = animals_batch.get_property(self.executor, P.ANIMAL)
+        domesticated_prop = animals_batch.get_property(self.executor, P.DOMESTICATED)
         if domesticated_prop is None or animal_prop is None:
             raise ValueError("{} is not domesticated".format(self.executor))
 
@@ -1808,8 +2013,7 @@ class LayEggsAction(Action):
                 egg_type = models.ItemType.by_name(egg_type_name)
                 amount_of_eggs = int(math.floor(animal_resources[egg_type_name]))
 
-                preferred_goal = models.Item.query.filter(models.Item.has_property(P.BIRD_NEST)) \
-                    .filter(models.Item.is_in(self.executor.being_in)).first()
+                preferred_goal = animals_batch.get_nest(self.executor.being_in)
                 # todo consider nest capacity after introducing storage capacity in #140
                 if not preferred_goal:  # if no nest then eggs are laid on ground
                     preferred_goal = self.executor.being_in
@@ -1829,17 +2033,19 @@ class AnimalsProcess(ProcessAction):
                   + models.Location.query.filter(models.Location.has_property(P.DOMESTICATED)).all()
         # todo till #130 when it'll be possible to use Entity.has_property
 
+        animals_batch = AnimalsBatch(animals)
         for animal in animals:
             eat_food_action = AnimalEatingAction(animal)
-            eat_food_action.perform()
+            eat_food_action.perform_in_batch(animals_batch)
 
             animal_state_progress_action = AnimalStateProgressAction(animal)
-            animal_state_progress_action.perform()
+            animal_state_progress_action.perform_in_batch(animals_batch)
 
-            has_eggs = animal.has_property(P.ANIMAL, can_lay_eggs=True)
+            animal_prop = animals_batch.get_property(animal, P.ANIMAL)
+            has_eggs = animal_prop is not None and animal_prop.get("can_lay_eggs") is True
             if has_eggs:
                 lay_eggs_action = LayEggsAction(animal)
-                lay_eggs_action.perform()
+                lay_eggs_action.perform_in_batch(animals_batch)
 
 
 class SayAloudAction(ActionOnSelf):
@@ -2252,7 +2458,7 @@ class StartControllingMovementAction(Action):
 
         qualified_class_name = deferred.get_qualified_class_name(ControlMovementAction)
         already_existing_controlling_intent = models.Intent.query.filter_by(target=moving_entity) \
-            .filter(models.Intent.serialized_action[0].astext == qualified_class_name).first()
+            .filter(models.Intent.action_type == qualified_class_name).first()
         if already_existing_controlling_intent:
             if already_existing_controlling_intent.executor == self.executor:  # executor already controls movement
                 return already_existing_controlling_intent
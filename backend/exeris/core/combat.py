@@ -1,6 +1,7 @@
+import collections
 import random
 
-from exeris.core import deferred, models, general, main, properties
+from exeris.core import models, general, main, properties
 from exeris.core.properties_base import P
 
 SIDE_ATTACKER = 0
@@ -11,39 +12,167 @@ STANCE_DEFENSIVE = "stance_defensive"
 STANCE_RETREAT = "stance_retreat"
 
 
-def get_combat_actions_of_visible_foes_and_allies(participant, combat_entity):
-    attackers, defenders = get_combat_actions_of_attackers_and_defenders(participant, combat_entity)
+class CombatRoundTimings:
+    """
+    Durations of combat rounds resolved by the current process.
+    Timings of all the processes are aggregated by the COMBAT_ROUND_RESOLVED hook.
+    """
 
-    participant_combatable_property = properties.CombatableProperty(participant)
-    own_combat_action = participant_combatable_property.combat_action
-    if own_combat_action.side == SIDE_ATTACKER:
-        foes, allies = defenders, attackers
-    else:
-        foes, allies = attackers, defenders
-    return foes, allies
+    def __init__(self):
+        self.rounds = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_time = None
 
+    def record(self, duration):
+        self.rounds += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.last_time = duration
 
-def get_combat_actions_of_attackers_and_defenders(participant, combat_entity):
-    combatant_intents = models.Intent.query.filter_by(target=combat_entity).all()
+    def stats(self):
+        return {
+            "rounds": self.rounds,
+            "total_time": self.total_time,
+            "max_time": self.max_time,
+            "last_time": self.last_time,
+            "average_time": self.total_time / self.rounds if self.rounds else None,
+        }
 
-    combat_actions_of_both_sides = [deferred.call(intent.serialized_action) for intent in combatant_intents]
 
-    attacker_combat_actions = [action for action in combat_actions_of_both_sides if
-                               action.side == SIDE_ATTACKER]
-    defender_combat_actions = [action for action in combat_actions_of_both_sides if
-                               action.side == SIDE_DEFENDER]
+round_timings = CombatRoundTimings()
 
-    combat_range = general.VisibilityBasedRange(10)
 
-    return (filter_visible_combatants(attacker_combat_actions, participant, combat_range),
-            filter_visible_combatants(defender_combat_actions, participant, combat_range))
+class CombatRound:
+    """
+    State of a single round of a combat, which is loaded once and then shared by all the fighters,
+    so hits can be resolved without querying the same data again and again.
+    Visibility and melee reachability are checked at most once for each pair of fighters' positions,
+    so all the fighters standing in the same location share the results. Weapons are checked once per fighter.
+    """
+
+    def __init__(self, combat_entity, fighter_intents):
+        self.combat_entity = combat_entity
+
+        models.Intent.preload_actions(fighter_intents)
+        self.combat_action_by_fighter = collections.OrderedDict(
+            (intent.executor, intent.get_action()) for intent in fighter_intents)
+
+        self.visibility_range = general.VisibilityBasedRange(10)
+        self.melee_range = general.TraversabilityBasedRange(50, allowed_terrain_types=[main.Types.LAND_TERRAIN])
+        self._visibility_by_positions = {}
+        self._melee_reachability_by_positions = {}
+        self._has_ranged_weapon_by_fighter = {}
+        self._is_combatable_by_fighter = {}
+        self._auxiliary_intent_by_fighter = None
+
+    @classmethod
+    def load(cls, combat_entity):
+        return cls(combat_entity, models.Intent.query.filter_by(target=combat_entity).all())
+
+    @property
+    def combat_actions(self):
+        return list(self.combat_action_by_fighter.values())
+
+    def get_combat_action(self, fighter):
+        if fighter in self.combat_action_by_fighter:
+            return self.combat_action_by_fighter[fighter]
+        return properties.CombatableProperty(fighter).combat_action
+
+    def remove_fighter(self, fighter):
+        self.combat_action_by_fighter.pop(fighter, None)
+
+    def is_visible(self, fighter, other_fighter):
+        return self._is_near_memoized(self.visibility_range, self._visibility_by_positions, fighter, other_fighter)
+
+    def is_reachable_in_melee(self, fighter, other_fighter):
+        return self._is_near_memoized(self.melee_range, self._melee_reachability_by_positions,
+                                      fighter, other_fighter)
+
+    def _is_near_memoized(self, rng, results_by_positions, fighter, other_fighter):
+        positions = self._get_position(fighter), self._get_position(other_fighter)
+        if positions not in results_by_positions:
+            results_by_positions[positions] = rng.is_near(fighter, other_fighter)
+        return results_by_positions[positions]
+
+    @staticmethod
+    def _get_position(fighter):
+        # ranges depend only on the location, so it's shared by everyone being directly in the same location
+        if not isinstance(fighter, models.Location) and isinstance(fighter.being_in, models.Location):
+            return fighter.being_in
+        return fighter
+
+    def has_ranged_weapon(self, fighter):
+        if fighter not in self._has_ranged_weapon_by_fighter:
+            self._has_ranged_weapon_by_fighter[fighter] = has_ranged_weapon(fighter)
+        return self._has_ranged_weapon_by_fighter[fighter]
+
+    def is_able_to_fight(self, fighter):
+        from exeris.core import actions
+        if fighter not in self._is_combatable_by_fighter:
+            self._is_combatable_by_fighter[fighter] = fighter.has_property(P.COMBATABLE)
+        # damage changes during the round, so it's always checked
+        return self._is_combatable_by_fighter[fighter] and fighter.damage < 1.0 \
+               and self.combat_entity.get_recorded_damage(fighter) <= actions.CombatProcess.DAMAGE_TO_DEFEAT
+
+    def get_auxiliary_intent(self, fighter):
+        if self._auxiliary_intent_by_fighter is None:  # loaded for all the fighters at once
+            self._auxiliary_intent_by_fighter = {}
+            fighter_ids = [fighter.id for fighter in self.combat_action_by_fighter]
+            if fighter_ids:
+                auxiliary_intents = models.Intent.query.filter_by(type=main.Intents.COMBAT_AUXILIARY_ACTION) \
+                    .filter(models.Intent.executor_id.in_(fighter_ids)).all()
+                for auxiliary_intent in auxiliary_intents:
+                    self._auxiliary_intent_by_fighter.setdefault(auxiliary_intent.executor, auxiliary_intent)
+        return self._auxiliary_intent_by_fighter.get(fighter)
+
+    def get_visible_attackers_and_defenders(self, participant):
+        combat_actions = self.combat_actions
+        attacker_combat_actions = [action for action in combat_actions if action.side == SIDE_ATTACKER]
+        defender_combat_actions = [action for action in combat_actions if action.side == SIDE_DEFENDER]
+
+        return ([action for action in attacker_combat_actions if self.is_visible(participant, action.executor)],
+                [action for action in defender_combat_actions if self.is_visible(participant, action.executor)])
+
+    def get_hit_target(self, attacker_combat_action, foe_combat_actions):
+        foe_combat_actions = [action for action in foe_combat_actions if self.is_able_to_fight(action.executor)]
+
+        attacker = attacker_combat_action.executor
+        if not self.has_ranged_weapon(attacker):
+            # we can attack melee only traversably-accessible targets
+            foe_combat_actions = [foe_action for foe_action in foe_combat_actions if
+                                  self.is_reachable_in_melee(attacker, foe_action.executor)]
+
+            # we are melee, so we can hit only melee foes, unless only ranged foes are there
+            melee_fighters = [foe_action for foe_action in foe_combat_actions
+                              if not self.has_ranged_weapon(foe_action.executor)]
+            if melee_fighters:  # melee fighters protect ranged fighters, so they are ignored
+                foe_combat_actions = melee_fighters
 
+        if not foe_combat_actions:
+            return None
 
-def filter_visible_combatants(combat_actions, participant, combat_range):
-    return [combat for combat in combat_actions if combat_range.is_near(participant, combat.executor)]
+        return _get_random(foe_combat_actions)
 
 
-def get_combat_actions_of_visible_foes(participant, combat_entity):
+def get_combat_actions_of_visible_foes_and_allies(participant, combat_entity, combat_round=None):
+    combat_round = combat_round or CombatRound.load(combat_entity)
+    attackers, defenders = combat_round.get_visible_attackers_and_defenders(participant)
+
+    own_combat_action = combat_round.get_combat_action(participant)
+    if own_combat_action.side == SIDE_ATTACKER:
+        foes, allies = defenders, attackers
+    else:
+        foes, allies = attackers, defenders
+    return foes, allies
+
+
+def get_combat_actions_of_attackers_and_defenders(participant, combat_entity, combat_round=None):
+    combat_round = combat_round or CombatRound.load(combat_entity)
+    return combat_round.get_visible_attackers_and_defenders(participant)
+
+
+def get_combat_actions_of_visible_foes(participant, combat_entity, combat_round=None):
     """
     Returns list of :class:`exeris.core.actions.FightInCombatAction` for fighters
     that can be a potential target of an attack by the `participant` (A). For each other participant (B) it means:
@@ -53,40 +182,23 @@ def get_combat_actions_of_visible_foes(participant, combat_entity):
     It can be interpreted as: "Each of listed participants can be attacked in some specific circumstances".
     :param participant: participant in proximity of whom combatants need to be
     :param combat_entity: entity of combat in which `participant` is
+    :param combat_round: state of the current combat round, loaded if not specified
     :return: list of combat actions of all potential targets
     """
-    return get_combat_actions_of_visible_foes_and_allies(participant, combat_entity)[0]
+    return get_combat_actions_of_visible_foes_and_allies(participant, combat_entity, combat_round)[0]
 
 
-def get_hit_target(attacker_combat_action, foe_combat_actions):
+def get_hit_target(attacker_combat_action, foe_combat_actions, combat_round=None):
     """
     Returns a combat action for a fighter which is selected as target for the hit.
     It takes into the consideration
     :param attacker_combat_action: action of a fighter who needs a target to hit
     :param foe_combat_actions: list of combat actions of all potential targets being in visibility range
+    :param combat_round: state of the current combat round, nothing is cached between the calls if not specified
     :return: hit target's combat action or None when nobody can be hit
     """
-
-    combat_entity = attacker_combat_action.combat_entity
-    foe_combat_actions = [action for action in foe_combat_actions if combat_entity.is_able_to_fight(action.executor)]
-
-    if not has_ranged_weapon(attacker_combat_action.executor):
-        attacker = attacker_combat_action.executor
-
-        # we can attack melee only traversably-accessible targets
-        range_to_fight_melee = general.TraversabilityBasedRange(50, allowed_terrain_types=[main.Types.LAND_TERRAIN])
-        foe_combat_actions = [foe_action for foe_action in foe_combat_actions if
-                              range_to_fight_melee.is_near(attacker, foe_action.executor)]
-
-        # we are melee, so we can hit only melee foes, unless only ranged foes are there
-        melee_fighters = [foe_action for foe_action in foe_combat_actions if not has_ranged_weapon(foe_action.executor)]
-        if melee_fighters:  # melee fighters protect ranged fighters, so they are ignored
-            foe_combat_actions = melee_fighters
-
-    if not foe_combat_actions:
-        return None
-
-    return _get_random(foe_combat_actions)
+    combat_round = combat_round or CombatRound(attacker_combat_action.combat_entity, [])
+    return combat_round.get_hit_target(attacker_combat_action, foe_combat_actions)
 
 
 def has_ranged_weapon(participant):
@@ -1,7 +1,9 @@
+import collections
 import inspect
 
 import copy
 import project_root
+import sqlalchemy as sql
 import wrapt
 from exeris.core import main, models
 from exeris.core.main import db
@@ -16,6 +18,34 @@ def object_import(name):
     return m
 
 
+class CompiledCallable:
+    """
+    Everything needed to deserialize a callable which is known by its qualified name,
+    resolved only once for every qualified name and then kept in the registry.
+    """
+
+    def __init__(self, qualified_name):
+        self.qualified_name = qualified_name
+        self.callable = object_import(qualified_name)
+        init_function = self.callable.__init__ if inspect.isclass(self.callable) else self.callable
+        # types of arguments converted by 'convert' decorator
+        self.argument_types = getattr(init_function, "converted_argument_types", {})
+
+
+_compiled_callables = {}
+
+
+def get_compiled(qualified_name):
+    if qualified_name not in _compiled_callables:
+        _compiled_callables[qualified_name] = CompiledCallable(qualified_name)
+    return _compiled_callables[qualified_name]
+
+
+def _copy_mutable_values(kwargs):
+    # only the containers can be changed by the constructed object, so there's no need to copy everything
+    return {key: copy.deepcopy(value) if isinstance(value, (dict, list)) else value for key, value in kwargs.items()}
+
+
 def call(json_to_call, **injected_args):
     """
     Call the list which is the class-arguments pair.
@@ -28,13 +58,44 @@ def call(json_to_call, **injected_args):
 
     function_id, kwargs = json_to_call[0], json_to_call[1]
 
-    func = object_import(function_id)
-    kwargs = copy.deepcopy(kwargs)
+    func = get_compiled(function_id).callable
+    kwargs = _copy_mutable_values(kwargs)
     kwargs.update(injected_args)
 
     return func(**kwargs)
 
 
+def _collect_referenced_ids(json_to_call, ids_by_model):
+    compiled_callable = get_compiled(json_to_call[0])
+    for arg_name, arg_value in json_to_call[1].items():
+        arg_type = compiled_callable.argument_types.get(arg_name)
+        if arg_type is None:
+            continue
+        if issubclass(arg_type, db.Model) and type(arg_value) in (int, str):
+            ids_by_model[arg_type].add(arg_value)
+        elif isinstance(arg_value, list) and arg_value and isinstance(arg_value[0], str):
+            _collect_referenced_ids(arg_value, ids_by_model)  # nested serialized action
+
+
+def preload_entities(serialized_actions):
+    """
+    Load all the entities referenced by the serialized actions (also the nested ones) using a single query per model.
+    The loaded instances are kept in the session's identity map,
+    so the conversions done when the actions are deserialized don't need to query the database again.
+    :param serialized_actions: list of serialized actions which are going to be called
+    :return: list of the loaded instances
+    """
+    ids_by_model = collections.defaultdict(set)
+    for serialized_action in serialized_actions:
+        _collect_referenced_ids(serialized_action, ids_by_model)
+
+    loaded_instances = []
+    for model, ids in ids_by_model.items():
+        primary_key_column = sql.inspect(model).primary_key[0]
+        loaded_instances += model.query.filter(primary_key_column.in_(ids)).all()
+    return loaded_instances
+
+
 def get_qualified_class_name(cls):
     class_module = inspect.getfile(cls)
     path_in_project = project_root.relative_to_project_root(class_module)
@@ -54,18 +115,26 @@ def get_qualified_name(obj):
     return full_qualified_name
 
 
-def serialize(obj):
-    full_qualified_name = get_qualified_name(obj)
+_serialization_info_by_class = {}
+
 
-    inspected_init_args = inspect.getfullargspec(obj.__class__.__init__).args
+def _get_serialization_info(obj):
+    cls = obj.__class__
+    if cls not in _serialization_info_by_class:
+        inspected_init_args = inspect.getfullargspec(cls.__init__).args
+        inspected_init_args.pop(0)  # remove 'self'
+        _serialization_info_by_class[cls] = get_qualified_name(obj), tuple(inspected_init_args)
+    return _serialization_info_by_class[cls]
 
-    inspected_init_args.pop(0)  # remove 'self'
 
+def serialize(obj):
+    full_qualified_name, init_args = _get_serialization_info(obj)
+
+    from exeris.core import actions
     args_to_serialize = {}
-    for arg_name in inspected_init_args:
+    for arg_name in init_args:
         arg_value_to_serialize = getattr(obj, arg_name)
 
-        from exeris.core import actions
         # need to be subject of argument type conversion as specified by 'convert' decorator
         if isinstance(arg_value_to_serialize, models.Entity):
             arg_value_to_serialize = arg_value_to_serialize.id
@@ -80,28 +149,31 @@ def serialize(obj):
 
 
 def convert(**argument_types):
+    model_argument_types = {arg_name: arg_type for arg_name, arg_type in argument_types.items()
+                            if arg_type is not None and issubclass(arg_type, db.Model)}
+    other_argument_types = {arg_name: arg_type for arg_name, arg_type in argument_types.items()
+                            if arg_type is not None and arg_name not in model_argument_types}
+
     @wrapt.decorator
     def wrapper(wrapped, instance, args, kwargs):
         converted_args = {}
 
         for arg_name, arg_value in kwargs.items():
-
-            def arg_exists(arg_name):
-                return arg_name in argument_types and argument_types[arg_name] is not None
-
-            from exeris.core import actions
-            if arg_exists(arg_name) and issubclass(argument_types[arg_name], db.Model) \
-                    and type(arg_value) in (int, str):
-                converted_args[arg_name] = argument_types[arg_name].query.get(arg_value)
-            elif arg_exists(arg_name) and issubclass(argument_types[arg_name], actions.AbstractAction) \
-                    and isinstance(arg_value, list):
+            if arg_name in model_argument_types and type(arg_value) in (int, str):
+                # it's a lookup in the identity map if the entity was loaded before (e.g. by 'preload_entities')
+                converted_args[arg_name] = model_argument_types[arg_name].query.get(arg_value)
+            elif arg_name in other_argument_types and isinstance(arg_value, list):
                 converted_args[arg_name] = call(arg_value)  # recursively deserialize JSON into python Action object
             else:
                 converted_args[arg_name] = arg_value
 
         return wrapped(*args, **converted_args)
 
-    return wrapper
+    def decorator(function):
+        function.converted_argument_types = argument_types
+        return wrapper(function)
+
+    return decorator
 
 
 def perform_or_turn_into_intent(executor, action, priority=1):
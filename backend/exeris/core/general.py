@@ -1,8 +1,9 @@
 import collections
 import copy
+import functools
+import hashlib
 import logging
 import math
-import random
 import string
 import time
 from collections import deque
@@ -16,6 +17,7 @@ from shapely.geometry import LineString, MultiLineString, Point, Polygon
 
 from exeris.core import models, main, util, map_data
 from exeris.core.main import db
+from exeris.core.properties_base import P
 
 logger = logging.getLogger(__name__)
 
@@ -274,6 +276,121 @@ def visit_subgraph(node, only_through_unlimited=False):
     return {loc for loc in visited_locations if number_of_door_passed[loc] <= 2}
 
 
+class LocationGraph:
+    """
+    Graph of locations connected by passages, built lazily and kept in the session until the end of the transaction,
+    so neighbours of the same location are not queried again. Passages of many locations (together with the locations
+    on both sides and the CLOSEABLE properties needed to tell whether they are open) are loaded in a single batch.
+    The graph is discarded when any passage or property is changed in the session (also by a bulk update or delete),
+    when such changes are flushed and at the end of the transaction.
+    """
+    SESSION_KEY = "location_graph"
+    INVALIDATING_CLASSES = (models.Passage, models.EntityProperty, models.EntityTypeProperty)
+
+    def __init__(self):
+        self._passages_to_neighbours_by_location = {}
+        self._is_open_by_passage = {}
+
+    @classmethod
+    def for_session(cls, session=None):
+        session = session if session is not None else db.session()
+        cls.discard_if_changed(session)
+        return session.info.setdefault(cls.SESSION_KEY, cls())
+
+    @classmethod
+    def discard_if_changed(cls, session):
+        if any(isinstance(obj, cls.INVALIDATING_CLASSES)
+               for obj in itertools.chain(session.new, session.dirty, session.deleted)):
+            session.info.pop(cls.SESSION_KEY, None)
+
+    def load(self, locations):
+        locations_to_load = {loc for loc in locations if loc not in self._passages_to_neighbours_by_location}
+        if not locations_to_load:
+            return
+
+        location_ids = models.ids(locations_to_load)
+        passages = models.Passage.query \
+            .filter(sql.or_(models.Passage.left_location_id.in_(location_ids),
+                            models.Passage.right_location_id.in_(location_ids))) \
+            .options(sql.orm.joinedload(models.Passage.left_location),
+                     sql.orm.joinedload(models.Passage.right_location)) \
+            .order_by(models.Passage.id).all()
+
+        for loc in locations_to_load:
+            self._passages_to_neighbours_by_location[loc] = []
+        for passage in passages:
+            if passage.right_location in locations_to_load:
+                self._passages_to_neighbours_by_location[passage.right_location].append(
+                    models.PassageToNeighbour(passage, passage.left_location))
+        for passage in passages:
+            if passage.left_location in locations_to_load:
+                self._passages_to_neighbours_by_location[passage.left_location].append(
+                    models.PassageToNeighbour(passage, passage.right_location))
+
+        self._load_open_states([passage for passage in passages if passage not in self._is_open_by_passage])
+
+    def _load_open_states(self, passages):
+        passages = [passage for passage in passages if not passage.type.unlimited]
+        if not passages:
+            return
+
+        entity_properties = models.EntityProperty.query \
+            .filter(models.EntityProperty.entity_id.in_(models.ids(passages))) \
+            .filter_by(name=P.CLOSEABLE).all()
+        entity_property_by_id = {prop.entity_id: prop for prop in entity_properties}
+        type_properties = models.EntityTypeProperty.query \
+            .filter(models.EntityTypeProperty.type_name.in_({passage.type_name for passage in passages})) \
+            .filter_by(name=P.CLOSEABLE).all()
+        type_property_by_name = {prop.type_name: prop for prop in type_properties}
+
+        for passage in passages:
+            closeable_data = {}
+            if passage.type_name in type_property_by_name:
+                closeable_data.update(type_property_by_name[passage.type_name].data)
+            if passage.id in entity_property_by_id:
+                closeable_data.update(entity_property_by_id[passage.id].data)
+            self._is_open_by_passage[passage] = closeable_data.get("closed") is not True
+
+    def get_passages_to_neighbours(self, location):
+        self.load([location])
+        return self._passages_to_neighbours_by_location[location]
+
+    def is_accessible(self, passage, only_through_unlimited=False):
+        """
+        Equivalent of Passage.is_accessible using the already loaded CLOSEABLE properties.
+        """
+        if passage.type.unlimited:
+            return True
+        if only_through_unlimited:
+            return False
+        if passage not in self._is_open_by_passage:
+            self._load_open_states([passage])
+        return self._is_open_by_passage[passage]
+
+    def get_accessible_passages_to_neighbours(self, location, only_through_unlimited=False):
+        return [directed_passage for directed_passage in self.get_passages_to_neighbours(location)
+                if self.is_accessible(directed_passage.passage, only_through_unlimited)]
+
+
+@sql.event.listens_for(sql.orm.Session, "before_flush")
+def discard_changed_location_graph(session, flush_context, instances):
+    LocationGraph.discard_if_changed(session)  # changes are no longer pending after the flush
+
+
+@sql.event.listens_for(sql.orm.Session, "after_commit")
+@sql.event.listens_for(sql.orm.Session, "after_soft_rollback")
+def discard_location_graph(session, *args):
+    session.info.pop(LocationGraph.SESSION_KEY, None)
+
+
+@sql.event.listens_for(sql.orm.Session, "after_bulk_update")
+@sql.event.listens_for(sql.orm.Session, "after_bulk_delete")
+def discard_location_graph_after_bulk_change(bulk_context):
+    # rows changed by a bulk query never appear in session.dirty
+    if bulk_context.mapper is not None and issubclass(bulk_context.mapper.class_, LocationGraph.INVALIDATING_CLASSES):
+        bulk_context.session.info.pop(LocationGraph.SESSION_KEY, None)
+
+
 class AreaRangeSpec(RangeSpec):
     def __init__(self, travel_credits, only_through_unlimited=False, allowed_terrain_types=None):
         """
@@ -668,46 +785,59 @@ class EventCreator:
 
         base_params = replace_dict_values(params)
 
-        if tag_doer and cls.can_receive_action(doer):
+        event_for_doer_needed = tag_doer and cls.can_receive_action(doer)
+        event_for_target_needed = tag_target and cls.can_receive_action(target)
+        event_for_observers_needed = (rng or locations) and tag_observer
+
+        # the same snapshot of doer and target is referenced by all the events, it's saved only if any of them needs it
+        entities_to_snapshot = []
+        if doer and (event_for_target_needed or event_for_observers_needed):
+            entities_to_snapshot.append(doer)
+        if target and (event_for_doer_needed or event_for_observers_needed):
+            entities_to_snapshot.append(target)
+        snapshots = dict(zip(entities_to_snapshot, models.EntitySnapshot.save_many(
+            [entity.pyslatize() for entity in entities_to_snapshot])))
+
+        new_events = []
+        new_event_observers = []
+
+        if event_for_doer_needed:
             doer_params = copy.deepcopy(base_params)
             if target:
-                doer_params.setdefault("groups", {})["target"] = target.pyslatize()
+                doer_params.setdefault("groups", {})["target"] = snapshots[target]
 
             event_for_doer = models.Event(tag_doer, doer_params)
-            event_obs_doer = models.EventObserver(event_for_doer, doer)
-
-            db.session.add_all([event_for_doer, event_obs_doer])
-            main.call_hook(main.Hooks.NEW_EVENT, event_observer=event_obs_doer)
+            new_events.append(event_for_doer)
+            new_event_observers.append(models.EventObserver(event_for_doer, doer))
 
-        if tag_target and cls.can_receive_action(target):
+        if event_for_target_needed:
             target_params = copy.deepcopy(base_params)
             if doer:
-                target_params.setdefault("groups", {})["doer"] = doer.pyslatize()
+                target_params.setdefault("groups", {})["doer"] = snapshots[doer]
 
             event_for_target = models.Event(tag_target, target_params)
-            event_obs_target = models.EventObserver(event_for_target, target)
+            new_events.append(event_for_target)
+            new_event_observers.append(models.EventObserver(event_for_target, target))
 
-            db.session.add_all([event_for_target, event_obs_target])
-            main.call_hook(main.Hooks.NEW_EVENT, event_observer=event_obs_target)
-
-        if (rng or locations) and tag_observer:
+        if event_for_observers_needed:
             obs_params = copy.deepcopy(base_params)
             if doer:
-                obs_params.setdefault("groups", {})["doer"] = doer.pyslatize()
+                obs_params.setdefault("groups", {})["doer"] = snapshots[doer]
             if target:
-                obs_params.setdefault("groups", {})["target"] = target.pyslatize()
+                obs_params.setdefault("groups", {})["target"] = snapshots[target]
 
             event_for_observer = models.Event(tag_observer, obs_params)
-            db.session.add(event_for_observer)
+            new_events.append(event_for_observer)
             character_obs = cls.get_observers(rng, doer, target, locations)
 
-            event_obs = [models.EventObserver(event_for_observer, char) for char in character_obs
-                         if char not in (doer, target)]
-
-            db.session.add_all(event_obs)
+            new_event_observers += [models.EventObserver(event_for_observer, char) for char in character_obs
+                                    if char not in (doer, target)]
 
-            for obs in event_obs:
-                main.call_hook(main.Hooks.NEW_EVENT, event_observer=obs)
+        # all observers are flushed together, so they end up in a single multi-row INSERT
+        db.session.add_all(new_events + new_event_observers)
+        if new_event_observers:
+            db.session.flush()
+            main.call_hook(main.Hooks.NEW_EVENTS, event_observers=new_event_observers)
 
     @classmethod
     def can_receive_action(cls, entity):
@@ -729,33 +859,80 @@ class EventCreator:
 
 
 class Identifiers:
+    """
+    Allocates unique identifiers made of uppercase letters. Every identifier is an encoded value of a db sequence:
+    the first 26^MIN_LENGTH values are encoded as identifiers of length MIN_LENGTH, the next 26^(MIN_LENGTH + 1)
+    as identifiers one letter longer and so on. Values of each length are shuffled by a permutation keyed
+    with SECRET_KEY, so consecutive identifiers don't look alike.
+    """
     MIN_LENGTH = 3
+    ALPHABET = string.ascii_uppercase
+    PERMUTATION_ROUNDS = 6
 
     @classmethod
     def generate_unique_identifier(cls):
         """
-        Generates an (yet unused) unique identifier. It does so by generating 1000 candidates for a new id of length
-        MIN_LENGTH and checking whether all of these are already used.
-        If so, then it tries again with the length increased by 1.
+        Generates an (yet unused) unique identifier from the next value of the identifier sequence.
+        Values encoded to identifiers which are already used (e.g. ones generated randomly in the past) are skipped.
         :return: the first id that is not used
         """
+        while True:
+            sequence_value = db.session.execute(models.Sequences.unique_identifier_sequence.next_value()).scalar()
+            generated_identifier = cls.encode(sequence_value - 1)
+            if not models.UniqueIdentifier.query.get(generated_identifier):
+                return generated_identifier
+
+    @classmethod
+    def encode(cls, number):
         length = cls.MIN_LENGTH
-        generated_identifier = None
-        while generated_identifier is None:
-            generated_identifier = cls._try_to_generate_unique_identifier_for_length(length)
+        while number >= len(cls.ALPHABET) ** length:
+            number -= len(cls.ALPHABET) ** length
             length += 1
-        return generated_identifier
+
+        permuted_number = cls._permute(number, length)
+        return "".join(cls.ALPHABET[digit] for digit in cls._to_digits(permuted_number, length))
 
     @classmethod
-    def _try_to_generate_unique_identifier_for_length(cls, length):
-        generated_identifiers = [cls._generate_identifier(length) for _ in range(1000)]  # 1000 candidates for id
-        already_used_identifiers = db.session.query(models.UniqueIdentifier.value) \
-            .filter(models.UniqueIdentifier.value.in_(generated_identifiers)).all()
-        already_used_identifiers = {columns[0] for columns in already_used_identifiers}
-        for generated_identifier in generated_identifiers:
-            if generated_identifier not in already_used_identifiers:
-                return generated_identifier
+    def _permute(cls, number, length):
+        """
+        Bijection of numbers in range [0, 26^length) made of a few rounds of an affine function
+        and reversal of the order of digits.
+        """
+        modulus = len(cls.ALPHABET) ** length
+        for multiplier, increment in _identifier_permutation_keys(main.app.config["SECRET_KEY"], length,
+                                                                  cls.PERMUTATION_ROUNDS, len(cls.ALPHABET)):
+            number = (number * multiplier + increment) % modulus
+            number = cls._from_digits(reversed(cls._to_digits(number, length)))
+        return number
+
+    @classmethod
+    def _to_digits(cls, number, length):
+        digits = []
+        for _ in range(length):
+            number, digit = divmod(number, len(cls.ALPHABET))
+            digits.append(digit)
+        return digits[::-1]
 
     @classmethod
-    def _generate_identifier(cls, length):
-        return ''.join(random.SystemRandom().choice(string.ascii_uppercase) for _ in range(length))
+    def _from_digits(cls, digits):
+        number = 0
+        for digit in digits:
+            number = number * len(cls.ALPHABET) + digit
+        return number
+
+
+@functools.lru_cache(maxsize=64)
+def _identifier_permutation_keys(secret_key, length, rounds, base):
+    modulus = base ** length
+    keys = []
+    for round_number in range(rounds):
+        h = hashlib.sha256()
+        h.update(secret_key.encode())
+        h.update("{}:{}".format(length, round_number).encode())
+        key_value = int.from_bytes(h.digest(), "big")
+        multiplier = key_value % modulus
+        while math.gcd(multiplier, modulus) != 1:  # the affine function needs to be a bijection
+            multiplier += 1
+        increment = (key_value // modulus) % modulus
+        keys.append((multiplier, increment))
+    return keys
@@ -1,12 +1,263 @@
+import contextlib
 import html
 import json
+import logging
 import os
+import re
+import threading
+import time
 
 import collections
+from psycopg2 import pool
+from pyslate.backends import postgres_backend
 from pyslate.pyslate import Pyslate
 
 from exeris.core import main, models, general
 
+logger = logging.getLogger(__name__)
+
+# version of the code rendering event texts, it needs to be bumped when a change of the code changes the rendered texts
+EVENT_RENDERING_VERSION = 1
+
+
+class TranslationConnectionPool:
+    """
+    A bounded pool of psycopg2 connections used only for reading translations.
+    Connections are opened lazily, so the pool can be safely created before the process forks.
+    When all the connections are in use, the caller waits until one of them is returned.
+    Time spent on waiting is recorded to make it possible to tune the pool size.
+    """
+
+    def __init__(self, dsn, size):
+        self.dsn = dsn
+        self.size = size
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._available = threading.BoundedSemaphore(size)
+        self.borrows = 0
+        self.waits = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = pool.ThreadedConnectionPool(0, self.size, self.dsn)
+            return self._pool
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Borrows a connection which is always returned to the pool when leaving the `with` block,
+        even if an exception was raised.
+        """
+        start = time.perf_counter()
+        if not self._available.acquire(blocking=False):
+            self.waits += 1
+            self._available.acquire()
+            logger.info("Waited %s msec for a translation connection", (time.perf_counter() - start) * 1000)
+        wait_time = time.perf_counter() - start
+        self.borrows += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        try:
+            conn = self._get_pool().getconn()
+        except Exception:
+            self._available.release()
+            raise
+        try:
+            if not conn.autocommit:
+                conn.autocommit = True  # translations are read-only, there's no reason to keep transactions open
+            yield conn
+        finally:
+            self._get_pool().putconn(conn, close=bool(conn.closed))
+            self._available.release()
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "borrows": self.borrows,
+            "waits": self.waits,
+            "total_wait_time": self.total_wait_time,
+            "max_wait_time": self.max_wait_time,
+        }
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+
+class PooledPostgresBackend(postgres_backend.PostgresBackend):
+    """
+    Pyslate backend reading translations from the PostgreSQL table through TranslationConnectionPool.
+    A connection is held only for the time of a single lookup, so one instance can be shared
+    by all the requests and hooks.
+    """
+
+    def __init__(self, connection_pool, table_name):
+        super().__init__(None, table_name)
+        self.connection_pool = connection_pool
+
+    def get_record(self, tag_names, languages):
+        with self.connection_pool.connection() as conn:
+            with conn.cursor() as cur:
+                for language in languages:
+                    for tag_name in tag_names:
+                        query_str = "SELECT content, form FROM " + self.table_name + \
+                                    " WHERE name = %s AND language = %s"
+                        cur.execute(query_str, (tag_name, language))
+                        ret = cur.fetchone()
+                        if ret:
+                            return ret
+        return None
+
+
+class InMemoryTranslationBackend:
+    """
+    Pyslate backend keeping all the translations in memory, so every tag lookup is a dict hit.
+    All translations of a language are loaded at once (through TranslationConnectionPool) on its first lookup.
+    The translations table changes only on deploy or on admin's edit, so instead of querying the database
+    the backend checks the version returned by `get_version` (at most once per `version_check_interval` seconds)
+    and drops all loaded translations when it's changed.
+    """
+
+    def __init__(self, connection_pool, table_name, get_version=lambda: None, version_check_interval=5):
+        self.connection_pool = connection_pool
+        self.table_name = table_name
+        self.get_version = get_version
+        self.version_check_interval = version_check_interval
+        self._translations_by_language = {}
+        self._version = None
+        self._last_version_check = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        self._reload_if_outdated()
+        return self._version
+
+    def get_content(self, tag_names, languages):
+        record = self.get_record(tag_names, languages)
+        if record:
+            return record[0]
+        return None
+
+    def get_form(self, tag_names, languages):
+        record = self.get_record(tag_names, languages)
+        if record:
+            return record[1]
+        return None
+
+    def get_record(self, tag_names, languages):
+        self._reload_if_outdated()
+        for language in languages:
+            translations = self._get_translations_for_language(language)
+            for tag_name in tag_names:
+                if tag_name in translations:
+                    return translations[tag_name]
+        return None
+
+    def _reload_if_outdated(self):
+        now = time.monotonic()
+        if self._last_version_check is not None and now - self._last_version_check < self.version_check_interval:
+            return
+        self._last_version_check = now
+        current_version = self.get_version()
+        if current_version != self._version:
+            logger.info("Translations version changed from %s to %s", self._version, current_version)
+            with self._lock:
+                self._version = current_version
+                self._translations_by_language = {}
+
+    def _get_translations_for_language(self, language):
+        translations = self._translations_by_language.get(language)
+        if translations is None:
+            with self._lock:
+                translations = self._translations_by_language.get(language)
+                if translations is None:
+                    translations = self._load_translations(language)
+                    self._translations_by_language[language] = translations
+        return translations
+
+    def _load_translations(self, language):
+        with self.connection_pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT name, content, form FROM " + self.table_name + " WHERE language = %s",
+                            (language,))
+                return {name: (content, form) for name, content, form in cur.fetchall()}
+
+
+def render_event_text(pyslate, event, date_text=None):
+    if date_text is None:
+        date_text = pyslate.t("game_date", game_date=event.date)
+    return date_text + ": " + pyslate.t(event.type_name, html=True, **event.params)
+
+
+class ObserverDependentParts:
+    """
+    Parts of a text which depend on the observer (encoded entity ids, names given by the observer, trust).
+    When the text is translated once for many observers, each of these parts is put into the text as a marker
+    and filled in separately for every observer by `fill`.
+    """
+    MARKER = "\x02{}\x03"
+    MARKER_PATTERN = re.compile("\x02(\\d+)\x03")
+
+    def __init__(self):
+        self._render_functions = []
+        self.named_entity_ids = set()
+
+    def add(self, render_for_observer):
+        """
+        :param render_for_observer: function taking the observer and a dict of names given by him
+               (by the id of the named entity) and returning the text of the part
+        :return: the marker to be put into the text
+        """
+        self._render_functions.append(render_for_observer)
+        return self.MARKER.format(len(self._render_functions) - 1)
+
+    def fill(self, text, observer, observed_names):
+        return self.MARKER_PATTERN.sub(
+            lambda match: self._render_functions[int(match.group(1))](observer, observed_names), text)
+
+
+def render_event_texts(pyslate, event_observers):
+    """
+    Renders texts of events for their observers speaking the language of `pyslate`.
+    The text of every event is translated only once for each gender of the observers, parts depending on
+    the observer are filled in afterwards. Params of the events and all the names given by the observers
+    are loaded in single queries.
+    :return: list of the texts in the order of `event_observers`
+    """
+    models.Event.resolve_params_of_events({event_observer.event for event_observer in event_observers})
+
+    translations_by_event_and_gen = {}
+    date_text_by_timestamp = {}
+    for event_observer in event_observers:
+        event, observer = event_observer.event, event_observer.observer
+        if (event, observer.sex) in translations_by_event_and_gen:
+            continue
+        if event.date not in date_text_by_timestamp:
+            date_text_by_timestamp[event.date] = pyslate.t("game_date", game_date=event.date)
+        observer_parts = ObserverDependentParts()
+        pyslate.context = dict(observer_parts=observer_parts, obs_gen=observer.sex)
+        text = render_event_text(pyslate, event, date_text_by_timestamp[event.date])
+        translations_by_event_and_gen[(event, observer.sex)] = text, observer_parts
+
+    named_entity_ids = {entity_id for _, observer_parts in translations_by_event_and_gen.values()
+                        for entity_id in observer_parts.named_entity_ids}
+    observed_names_by_observer_id = models.ObservedName.get_names_by_observer_id(
+        {event_observer.observer_id for event_observer in event_observers}, named_entity_ids)
+
+    texts = []
+    for event_observer in event_observers:
+        observer = event_observer.observer
+        text, observer_parts = translations_by_event_and_gen[(event_observer.event, observer.sex)]
+        texts.append(observer_parts.fill(text, observer, observed_names_by_observer_id.get(observer.id, {})))
+    return texts
+
 
 def create_pyslate(language, backend=None, character=None, **kwargs):
     # converters for custom info
@@ -33,8 +284,12 @@ def create_pyslate(language, backend=None, character=None, **kwargs):
             entity_type_name = params["entity_type"]
             entity_id = params.get(entity_type_name + "_id", 0)
             from exeris.app import app
-            observer_id_for_encryption = params.get("observer").id if params.get("observer", None) else 0
-            enc_entity_id = app.encode(entity_id, character_id=observer_id_for_encryption)
+            if "observer_parts" in params:
+                enc_entity_id = params["observer_parts"].add(
+                    lambda observer, observed_names: app.encode(entity_id, character_id=observer.id))
+            else:
+                observer_id_for_encryption = params.get("observer").id if params.get("observer", None) else 0
+                enc_entity_id = app.encode(entity_id, character_id=observer_id_for_encryption)
             classes = ["entity", entity_type_name]
             classes += ["dynamic_nameable"] if params.get("dynamic_nameable", False) else []
             return '<span data-entity-id="{}" class="{}">{}</span>'.format(
@@ -76,6 +331,31 @@ def create_pyslate(language, backend=None, character=None, **kwargs):
                 the_most_trusted = int(trusted_id)
         return the_most_trusted
 
+    def get_trust_text(helper, params):
+        """
+        Text telling whether the observer is trusted by the domesticated animal described by params.
+        """
+        if "trusted" not in params:
+            return ""
+        trust_dict = params["trusted"]
+        the_most_trusted = get_the_most_trusted(trust_dict)
+
+        if "observer_parts" in params:
+            most_trusted_text = " " + helper.translation("domestication_most_trusted")
+            trusted_text = " " + helper.translation("domestication_trusted")
+            return params["observer_parts"].add(
+                lambda observer, observed_names: most_trusted_text if observer.id == the_most_trusted
+                else trusted_text if str(observer.id) in trust_dict else "")
+
+        if "observer" not in params:
+            return ""
+        observer_id = params["observer"].id
+        if observer_id == the_most_trusted:
+            return " " + helper.translation("domestication_most_trusted")
+        elif str(observer_id) in trust_dict:
+            return " " + helper.translation("domestication_trusted")
+        return ""
+
     if character:  # add character-specific data if character is specified
         kwargs["context"] = dict(kwargs.get("context", {}), observer=character, obs_gen=character.sex)
 
@@ -102,7 +382,6 @@ def create_pyslate(language, backend=None, character=None, **kwargs):
         material_text = ""
         damage_text = ""
         title_text = ""
-        trust_text = ""
 
         number = 1
         if params.get("item_amount", None):
@@ -145,13 +424,7 @@ def create_pyslate(language, backend=None, character=None, **kwargs):
             title_text = helper.translation("tp_item_title", title=params["item_title"])
             title_text += " "
 
-        if "observer" in params and "trusted" in params:
-            observer_id = params["observer"].id
-            trust_dict = params.get("trusted", {})
-            if observer_id == get_the_most_trusted(trust_dict):
-                trust_text = " " + helper.translation("domestication_most_trusted")
-            elif str(observer_id) in trust_dict:
-                trust_text = " " + helper.translation("domestication_trusted")
+        trust_text = get_trust_text(helper, params)
 
         post_info_text = all_converters_for_info(post_converters, helper, params, form)
 
@@ -217,6 +490,14 @@ def create_pyslate(language, backend=None, character=None, **kwargs):
     @htmlize
     def func_location_info(helper, tag_name, params):
 
+        if "observer_parts" in params and "location_id" in params:
+            observer_parts = params["observer_parts"]
+            location_id = params["location_id"]
+            observer_parts.named_entity_ids.add(location_id)
+            unnamed_location_text = get_unnamed_location_text(helper, tag_name, params)
+            return observer_parts.add(
+                lambda observer, observed_names: observed_names.get(location_id, unnamed_location_text))
+
         if "observer" in params and "location_id" in params:
             observer = params["observer"]
             location_id = params["location_id"]
@@ -224,6 +505,9 @@ def create_pyslate(language, backend=None, character=None, **kwargs):
             if observed_name:
                 return observed_name.name
 
+        return get_unnamed_location_text(helper, tag_name, params)
+
+    def get_unnamed_location_text(helper, tag_name, params):
         title_text = ""
         if "location_title" in params:
             title_text = helper.translation("tp_location_title", title=params["location_title"])
@@ -244,14 +528,7 @@ def create_pyslate(language, backend=None, character=None, **kwargs):
                                                item_form=form)
             material_text += " "
 
-        trust_text = ""
-        if "observer" in params and "trusted" in params:
-            observer_id = params["observer"].id
-            trust_dict = params.get("trusted", {})
-            if observer_id == get_the_most_trusted(trust_dict):
-                trust_text = " " + helper.translation("domestication_most_trusted")
-            elif str(observer_id) in trust_dict:
-                trust_text = " " + helper.translation("domestication_trusted")
+        trust_text = get_trust_text(helper, params)
 
         return helper.translation("tp_location_info", location_name=location_name, title=title_text,
                                   main_material=material_text, trust=trust_text).strip()
@@ -268,7 +545,15 @@ def create_pyslate(language, backend=None, character=None, **kwargs):
         helper.return_form(character_gen)
 
         visible_name = None
-        if "observer" in params and "character_id" in params:
+        if "observer_parts" in params and "character_id" in params:
+            observer_parts = params["observer_parts"]
+            character_id = params["character_id"]
+            observer_parts.named_entity_ids.add(character_id)
+            generic_name = helper.translation("entity_character#" + character_gen)
+            visible_name = observer_parts.add(
+                lambda observer, observed_names: pyslate.t("tp_character_title", title=observed_names[character_id])
+                if character_id in observed_names else generic_name)
+        elif "observer" in params and "character_id" in params:
             observer = params["observer"]
             character_id = params["character_id"]
 
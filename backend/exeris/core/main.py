@@ -1,3 +1,4 @@
+import functools
 import json
 import logging
 import logging.config
@@ -12,6 +13,7 @@ from flask_sqlalchemy import SQLAlchemy
 db = SQLAlchemy()
 app = None
 property_cache = None
+use_effective_properties = False
 
 logger = logging.getLogger(__name__)
 
@@ -137,12 +139,13 @@ class Hooks:
     SPOKEN_ALOUD = "spoken_aloud"
     WHISPERED = "whispered"
     EATEN = "eaten"
-    NEW_EVENT = "new_event"
+    NEW_EVENTS = "new_events"
     NEW_CHARACTER_NOTIFICATION = "new_character_notification"
     POSITION_CHANGED = "position_changed"
     NEW_PLAYER_NOTIFICATION = "new_player_notification"
     ENTITY_CONTENTS_COUNT_DECREASED = "entity_contents_count_decreased"
     DAMAGE_EXCEEDED = "damage_exceeded"
+    COMBAT_ROUND_RESOLVED = "combat_round_resolved"
 
 
 class Intents:
@@ -194,17 +197,27 @@ def create_app(database=db, own_config_file_path=""):
     return app
 
 
-def _cipher(character_id):
+CIPHER_CACHE_SIZE = 1024
+
+
+@functools.lru_cache(maxsize=CIPHER_CACHE_SIZE)
+def _cipher_for_key(secret_key, character_id):
+    # ECB mode has no state, so the same cipher object can be safely reused for all the encryptions
     h = hashlib.sha256()
-    h.update(app.config['SECRET_KEY'].encode())
+    h.update(secret_key.encode())
+    h.update(character_id.to_bytes(8, 'big'))
+    return AES.new(h.digest(), AES.MODE_ECB)
+
+
+def _cipher(character_id):
     if character_id is None and hasattr(g, "character"):
         character_id = g.character.id
     assert character_id is not None, "encryption key cannot be None"
-    h.update(character_id.to_bytes(8, 'big'))
-    return AES.new(h.digest(), AES.MODE_ECB)
+    return _cipher_for_key(app.config['SECRET_KEY'], character_id)
 
 
 _encode_token = b'f' * 8
+_BLOCK_SIZE = 16
 
 
 def encode(uid, character_id=None):
@@ -219,6 +232,33 @@ def decode(encoded_id, character_id=None):
     return int.from_bytes(pt[:8], 'big')
 
 
+def encode_many(uids, character_id=None):
+    """
+    Works like `encode` for every element of the list, but all the ids are encrypted in a single call.
+    """
+    if not uids:
+        return []
+    pt = b"".join(uid.to_bytes(8, 'big') + _encode_token for uid in uids)
+    ct = _cipher(character_id).encrypt(pt)
+    return [str(int.from_bytes(ct[i:i + _BLOCK_SIZE], 'big')) for i in range(0, len(ct), _BLOCK_SIZE)]
+
+
+def decode_many(encoded_ids, character_id=None):
+    """
+    Works like `decode` for every element of the list, but all the ids are decrypted in a single call.
+    """
+    if not encoded_ids:
+        return []
+    ct = b"".join(int(encoded_id).to_bytes(16, 'big') for encoded_id in encoded_ids)
+    pt = _cipher(character_id).decrypt(ct)
+    uids = []
+    for i in range(0, len(pt), _BLOCK_SIZE):
+        if pt[i + 8:i + _BLOCK_SIZE] != _encode_token:
+            raise ValueError('Could not decode ID')
+        uids.append(int.from_bytes(pt[i:i + 8], 'big'))
+    return uids
+
+
 _hooks = {}
 
 
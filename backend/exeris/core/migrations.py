@@ -0,0 +1,93 @@
+import logging
+
+from exeris.core.main import db
+
+logger = logging.getLogger(__name__)
+
+# Changes of the schema of already existing databases.
+# `db.create_all()` creates only the missing tables, so every column or index added to an existing table
+# needs a migration here. Every migration is applied only once and recorded in the schema_migrations table.
+# The statements need to be idempotent, because they are also applied to databases created by `db.create_all()`
+# when all the tables were already up to date.
+MIGRATIONS = [
+    ("event_observers_rendered_text", [
+        "ALTER TABLE event_observers ADD COLUMN IF NOT EXISTS rendered_text VARCHAR",
+        "ALTER TABLE event_observers ADD COLUMN IF NOT EXISTS rendered_version VARCHAR(64)",
+    ]),
+    ("events_date_index", [
+        "CREATE INDEX IF NOT EXISTS ix_events_date ON events (date)",
+    ]),
+    ("entity_snapshots_reference_count", [
+        "ALTER TABLE entity_snapshots ADD COLUMN IF NOT EXISTS reference_count INTEGER NOT NULL DEFAULT 0",
+        # count references from the already existing events, it's done only once
+        "UPDATE entity_snapshots SET reference_count = refs.count FROM ("
+        "  SELECT groups.value ->> 'entity_snapshot' AS hash, count(*) AS count"
+        "  FROM events, jsonb_each(CASE WHEN jsonb_typeof(events.params -> 'groups') = 'object'"
+        "                               THEN events.params -> 'groups' ELSE '{}'::jsonb END) AS groups"
+        "  WHERE groups.value ? 'entity_snapshot'"
+        "  GROUP BY groups.value ->> 'entity_snapshot'"
+        ") AS refs WHERE entity_snapshots.hash = refs.hash",
+        "CREATE INDEX IF NOT EXISTS entity_snapshots_unreferenced_idx ON entity_snapshots (hash) "
+        "WHERE reference_count <= 0",
+    ]),
+    ("intents_action_type", [
+        "ALTER TABLE intents ADD COLUMN IF NOT EXISTS action_type VARCHAR(150)",
+        # the same as the class name set by Intent.validate_serialized_action
+        "UPDATE intents SET action_type = serialized_action ->> 0 WHERE action_type IS NULL",
+        "CREATE INDEX IF NOT EXISTS ix_intents_action_type ON intents (action_type)",
+        "CREATE INDEX IF NOT EXISTS intents_target_id_action_type_idx ON intents (target_id, action_type)",
+    ]),
+    ("entity_properties_indexes", [
+        "CREATE INDEX IF NOT EXISTS entity_properties_name_entity_id_idx ON entity_properties (name, entity_id)",
+        "CREATE INDEX IF NOT EXISTS entity_properties_data_idx ON entity_properties USING gin (data)",
+        "CREATE INDEX IF NOT EXISTS entity_type_properties_name_type_name_idx "
+        "ON entity_type_properties (name, type_name)",
+        "CREATE INDEX IF NOT EXISTS entity_type_properties_data_idx ON entity_type_properties USING gin (data)",
+    ]),
+    ("entities_effective_properties", [
+        "ALTER TABLE entities ADD COLUMN IF NOT EXISTS effective_properties JSONB",
+        "CREATE INDEX IF NOT EXISTS entities_effective_properties_idx ON entities USING gin (effective_properties)",
+    ]),
+    ("entities_states_indexes", [
+        # the same expressions as Entity.damage and Entity.hunger
+        "CREATE INDEX IF NOT EXISTS entities_states_damage_idx ON entities (CAST(states ->> 'damage' AS FLOAT))",
+        "CREATE INDEX IF NOT EXISTS entities_states_hunger_idx ON entities (CAST(states ->> 'hunger' AS FLOAT))",
+        "DROP INDEX IF EXISTS ix_entities_states",
+    ]),
+    ("entity_properties_union_id_index", [
+        "CREATE INDEX IF NOT EXISTS entity_properties_union_id_idx "
+        "ON entity_properties (CAST(data ->> 'union_id' AS INTEGER)) WHERE name = 'MemberOfUnion'",
+    ]),
+    ("entity_snapshots_references_index", [
+        # references to snapshots are counted by a query on events instead of a counter updated by every event
+        "DROP INDEX IF EXISTS entity_snapshots_unreferenced_idx",
+        "ALTER TABLE entity_snapshots DROP COLUMN IF EXISTS reference_count",
+        "CREATE INDEX IF NOT EXISTS events_referenced_snapshots_idx "
+        "ON events USING gin (jsonb_path_query_array(params, '$.groups.*.entity_snapshot'))",
+    ]),
+    ("scheduled_tasks_claimed_until", [
+        "ALTER TABLE scheduled_tasks ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP",
+    ]),
+]
+
+MIGRATIONS_LOCK_ID = 91731  # any number, it's used only to prevent running migrations concurrently by many processes
+
+
+def apply_migrations():
+    """
+    Applies all the migrations which were not applied yet and commits the changes.
+    It must be called after `db.create_all()` and before querying any of the models.
+    """
+    db.session.execute("SELECT pg_advisory_xact_lock(:lock_id)", {"lock_id": MIGRATIONS_LOCK_ID})
+    db.session.execute("CREATE TABLE IF NOT EXISTS schema_migrations "
+                       "(name VARCHAR PRIMARY KEY, applied_at TIMESTAMP NOT NULL DEFAULT now())")
+    applied_migrations = {row[0] for row in db.session.execute("SELECT name FROM schema_migrations")}
+
+    for name, statements in MIGRATIONS:
+        if name in applied_migrations:
+            continue
+        logger.info("Applying migration %s", name)
+        for statement in statements:
+            db.session.execute(statement)
+        db.session.execute("INSERT INTO schema_migrations (name) VALUES (:name)", {"name": name})
+    db.session.commit()
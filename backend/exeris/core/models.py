@@ -1,5 +1,8 @@
 import collections
 import datetime
+import hashlib
+import itertools
+import json
 import logging
 
 import geoalchemy2 as gis
@@ -185,14 +188,10 @@ class EntityType(db.Model):
                                 EntityTypeProperty.type_name == self.name)) \
                 .label("property_exists")
         else:
-            entity_type_query_parts = []
-            for key, value in kwargs.items():
-                cast_value = util.Sql.cast_json_value_to_psql_type(EntityTypeProperty.data[key], value)
-                entity_type_query_parts += [cast_value == value]
             return sql.select([True]) \
                 .where(sql.and_(EntityTypeProperty.name == name,
                                 EntityTypeProperty.type_name == self.name,
-                                *entity_type_query_parts)) \
+                                EntityTypeProperty.data.contains(kwargs))) \
                 .label("property_exists")
 
     def key_value_pair_exists(self, key, value, kv_dict):
@@ -385,13 +384,18 @@ class Entity(db.Model):
                                          foreign_keys=parent_entity_id, remote_side=id, uselist=False)
     role = sql.Column(sql.SmallInteger, nullable=True)
 
-    __table_args__ = (sql.Index("parent_entity_role_index", "parent_entity_id", "role", "discriminator_type"),)
+    __table_args__ = (sql.Index("parent_entity_role_index", "parent_entity_id", "role", "discriminator_type"),
+                      sql.Index("entities_effective_properties_idx", "effective_properties", postgresql_using="gin"))
 
     title = sql.Column(sql.String, nullable=True)
     properties = sql.orm.relationship("EntityProperty", back_populates="entity",
                                       cascade="all, delete, delete-orphan")
 
-    states = sql.Column(sqlalchemy_json_mutable.JsonDict, index=True)  # index for items to be deleted
+    states = sql.Column(sqlalchemy_json_mutable.JsonDict)  # the most frequently queried keys have expression indexes
+
+    # data of all EntityTypeProperties and EntityProperties merged by property name, kept up to date on flush
+    # and used instead of the property tables when main.use_effective_properties is enabled
+    effective_properties = sql.Column(psql.JSONB, nullable=True)
 
     @hybrid_property
     def being_in(self):
@@ -451,8 +455,14 @@ class Entity(db.Model):
     def alter_type(self, new_type):
         self.type = new_type
         self.add_type_specific_states()
+        StaleEffectiveProperties.mark_entity(self)
 
     def get_property(self, name):
+        effective_properties = self._get_effective_properties() if main.use_effective_properties else None
+        if effective_properties is not None:
+            effective_property = effective_properties.get(name)
+            return dict(effective_property) if effective_property is not None else None
+
         props = {}
         ok = False
         if main.property_cache and main.property_cache.type_cached(self.type):
@@ -475,6 +485,21 @@ class Entity(db.Model):
             return None
         return props
 
+    def _get_effective_properties(self):
+        """
+        :return: merged data of all the properties or None if they are not known (e.g. not computed yet)
+        """
+        session = sql.orm.object_session(self)
+        if session is None:
+            return None
+        deleted_objects = session.deleted
+        if sql.inspect(self).pending or StaleEffectiveProperties.for_session(session).is_stale(self, deleted_objects):
+            # changed since the last flush, so they are computed from the properties loaded in the session
+            return compute_effective_properties(self, deleted_objects)
+        if self.effective_properties is None:  # e.g. discarded after a change of properties of the entity type
+            self.effective_properties = compute_effective_properties(self)
+        return self.effective_properties
+
     def get_entity_property(self, name):
         return EntityProperty.query.get((self.id, name))
 
@@ -490,41 +515,41 @@ class Entity(db.Model):
 
     @has_property.expression
     def has_property(cls, name, **kwargs):
+        """
+        Property check compiled to semi-joins on (name, entity_id) and (name, type_name) of the property tables.
+        Key-value pairs are matched using JSONB containment, so the lookups can use indexes of these tables.
+        A key present in EntityProperty takes precedence over the same key in EntityTypeProperty.
+        When main.use_effective_properties is enabled, the already merged Entity.effective_properties is used instead,
+        unless they are not known (e.g. discarded after a change of properties of the entity type).
+        """
+        if main.use_effective_properties:
+            if not kwargs:
+                effective_properties_check = cls.effective_properties.has_key(name)
+            else:
+                effective_properties_check = cls.effective_properties.contains({name: kwargs})
+            return sql.or_(effective_properties_check,
+                           sql.and_(cls.effective_properties.is_(None),
+                                    cls._has_property_in_property_tables(name, **kwargs)))
+        return cls._has_property_in_property_tables(name, **kwargs)
+
+    @classmethod
+    def _has_property_in_property_tables(cls, name, **kwargs):
         if not kwargs:
-            cls_subquery = sql.orm.aliased(cls)
-            return db.session.query(cls_subquery.id) \
-                .filter(cls.id == cls_subquery.id) \
-                .outerjoin(EntityProperty, sql.and_(EntityProperty.entity_id == cls_subquery.id,
-                                                    EntityProperty.name == name)) \
-                .outerjoin(EntityTypeProperty, sql.and_(EntityTypeProperty.type_name == cls_subquery.type_name,
-                                                        EntityTypeProperty.name == name)) \
-                .filter(
-                sql.or_(
-                    EntityProperty.name.isnot(None),
-                    EntityTypeProperty.name.isnot(None)
-                )).correlate(cls).exists()
-        else:
-            entity_or_type_query_parts = []
-            for key, value in kwargs.items():
-                entity_cast_value = util.Sql.cast_json_value_to_psql_type(EntityProperty.data[key], value)
-                type_cast_value = util.Sql.cast_json_value_to_psql_type(EntityTypeProperty.data[key], value)
-
-                entity_or_type_query_parts += [sql.or_(
-                    entity_cast_value == value,
-                    sql.and_(
-                        type_cast_value == value,
-                        sql.sql.functions.coalesce(entity_cast_value == value, True)
-                    )
-                )]
-
-                cls_subquery = sql.orm.aliased(cls)
-            return db.session.query(cls_subquery.id) \
-                .filter(cls.id == cls_subquery.id) \
-                .outerjoin(EntityProperty, sql.and_(EntityProperty.entity_id == cls_subquery.id,
-                                                    EntityProperty.name == name)) \
-                .outerjoin(EntityTypeProperty, sql.and_(EntityTypeProperty.type_name == cls_subquery.type_name,
-                                                        EntityTypeProperty.name == name)) \
-                .filter(sql.and_(*entity_or_type_query_parts)).correlate(cls).exists()
+            return sql.or_(cls.id.in_(EntityProperty.entity_ids_having(name)),
+                           cls.type_name.in_(EntityTypeProperty.type_names_having(name)))
+
+        key_value_query_parts = []
+        for key, value in kwargs.items():
+            key_value = {key: value}
+            key_value_query_parts += [sql.or_(
+                cls.id.in_(EntityProperty.entity_ids_having(name, EntityProperty.data.contains(key_value))),
+                sql.and_(
+                    cls.type_name.in_(
+                        EntityTypeProperty.type_names_having(name, EntityTypeProperty.data.contains(key_value))),
+                    ~cls.id.in_(EntityProperty.entity_ids_having(name, EntityProperty.data.has_key(key)))
+                )
+            )]
+        return sql.and_(*key_value_query_parts)
 
     @hybrid_property
     def damage(self):
@@ -534,6 +559,22 @@ class Entity(db.Model):
     def damage(self, new_value):
         self.states[main.States.DAMAGE] = new_value
 
+    @damage.expression
+    def damage(cls):
+        return cls.states[main.States.DAMAGE].astext.cast(sql.Float)
+
+    @hybrid_property
+    def hunger(self):
+        return self.states[main.States.HUNGER]
+
+    @hunger.setter
+    def hunger(self, new_value):
+        self.states[main.States.HUNGER] = new_value
+
+    @hunger.expression
+    def hunger(cls):
+        return cls.states[main.States.HUNGER].astext.cast(sql.Float)
+
     @hybrid_property
     def modifiers(self):
         return self.states[main.States.MODIFIERS]
@@ -631,6 +672,11 @@ class Entity(db.Model):
         return str(self.__class__) + str(self.__dict__)
 
 
+# indexes on the expressions of the hybrid properties for the scans of damaged and starving entities
+sql.Index("entities_states_damage_idx", Entity.damage)
+sql.Index("entities_states_hunger_idx", Entity.hunger)
+
+
 @sqlalchemy.event.listens_for(Entity, "load", propagate=True)
 def clamp_states_to_0_1(target, _):
     target.states = sqlalchemy_json_mutable.mutable_types.NestedMutableDict.coerce("states", target.states)
@@ -643,6 +689,10 @@ class Intent(db.Model):
     """
     __tablename__ = "intents"
 
+    DESERIALIZED_ACTIONS_KEY = "deserialized_intent_actions"
+    PRELOADED_ENTITIES_KEY = "preloaded_intent_entities"
+    ACTION_TYPE_MAXLEN = 150
+
     id = sql.Column(sql.Integer, primary_key=True, autoincrement=True)
 
     def __init__(self, executor, intent_type, priority, target, serialized_action):
@@ -661,22 +711,85 @@ class Intent(db.Model):
     target_id = sql.Column(sql.Integer, sql.ForeignKey(Entity.id, ondelete="CASCADE"), nullable=True, index=True)
     target = sql.orm.relationship(Entity, uselist=False, foreign_keys=target_id)
 
+    # qualified class name of the serialized action, kept in sync with serialized_action to be queried with index
+    action_type = sql.Column(sql.String(ACTION_TYPE_MAXLEN), index=True)
     serialized_action = sql.Column(sqlalchemy_json_mutable.JsonList)  # single action
 
-    def __enter__(self):
+    __table_args__ = (sql.Index("intents_target_id_action_type_idx", "target_id", "action_type"),)
+
+    @sql.orm.validates("serialized_action")
+    def validate_serialized_action(self, key, serialized_action):
+        if not isinstance(serialized_action, list) or len(serialized_action) != 2 \
+                or not isinstance(serialized_action[0], str) or not isinstance(serialized_action[1], dict):
+            raise AssertionError("'{}' is not a serialized action".format(serialized_action))
+        if len(serialized_action[0]) > Intent.ACTION_TYPE_MAXLEN:
+            raise AssertionError("action type '{}' is too long".format(serialized_action[0]))
+
+        self.action_type = serialized_action[0]
+        self._get_deserialized_actions().pop(self, None)
+        return serialized_action
+
+    @staticmethod
+    def _get_deserialized_actions():
+        return db.session.info.setdefault(Intent.DESERIALIZED_ACTIONS_KEY, {})
+
+    def get_action(self):
+        """
+        Returns the action deserialized from serialized_action.
+        The action is deserialized only once per transaction (so once per tick in the scheduler)
+        and the same instance is returned for every subsequent call.
+        """
+        from exeris.core import deferred
+        deserialized_actions = self._get_deserialized_actions()
+        if self not in deserialized_actions:
+            deserialized_actions[self] = deferred.call(self.serialized_action)
+        return deserialized_actions[self]
+
+    def set_action(self, action):
+        from exeris.core import deferred
+        self.serialized_action = deferred.serialize(action)
+        self._get_deserialized_actions()[self] = action
+
+    @classmethod
+    def preload_actions(cls, intents):
+        """
+        Loads all the entities referenced by actions of the specified intents in bulk, see `deferred.preload_entities`.
+        The session's identity map holds only weak references, so the loaded entities are kept in the session info
+        till the end of the transaction. Otherwise they could be garbage collected before the actions need them.
+        """
         from exeris.core import deferred
-        self._value = deferred.call(self.serialized_action)
+        deserialized_actions = cls._get_deserialized_actions()
+        loaded_entities = deferred.preload_entities([intent.serialized_action for intent in intents
+                                                     if intent not in deserialized_actions])
+        db.session.info.setdefault(Intent.PRELOADED_ENTITIES_KEY, []).extend(loaded_entities)
+
+    def __enter__(self):
+        self._value = self.get_action()
         return self._value
 
     def __exit__(self, type, value, traceback):
-        from exeris.core import deferred
-        self.serialized_action = deferred.serialize(self._value)
+        self.set_action(self._value)
 
     def __repr__(self):
         return "{{Intent, executor: {}, type: {}, target: {}, action: {}}}".format(self.executor, self.type,
                                                                                    self.target, self.serialized_action)
 
 
+@sql.event.listens_for(sql.orm.Session, "after_commit")
+def discard_deserialized_intent_actions_after_commit(session):
+    # releasing a savepoint (e.g. after every intent in WorkProcess) doesn't expire any instances
+    if not session.transaction.nested:
+        session.info.pop(Intent.DESERIALIZED_ACTIONS_KEY, None)
+        session.info.pop(Intent.PRELOADED_ENTITIES_KEY, None)
+
+
+@sql.event.listens_for(sql.orm.Session, "after_soft_rollback")
+def discard_deserialized_intent_actions_after_rollback(session, previous_transaction):
+    session.info.pop(Intent.DESERIALIZED_ACTIONS_KEY, None)  # the actions could be changed by the rolled back code
+    if not previous_transaction.nested:
+        session.info.pop(Intent.PRELOADED_ENTITIES_KEY, None)
+
+
 class LocationType(EntityType):
     __tablename__ = "location_types"
 
@@ -756,6 +869,7 @@ class Character(Entity):
     @name.setter
     def name(self, value):
         if self.id is not None:
+            EventObserver.invalidate_rendered_texts([self.id])
             observed_name = ObservedName.query.filter_by(target=self, observer=self).first()
             if observed_name:
                 observed_name.name = value
@@ -1069,14 +1183,141 @@ class EventType(db.Model):
         self.group = group
 
 
+class EntitySnapshot(db.Model):
+    """
+    Pyslatized state of an entity referenced by event params. It's content-addressed (identified by a hash of the data)
+    so the same state of an entity seen in many events (e.g. a doer in events for doer, target and observers)
+    is stored only once.
+    """
+    __tablename__ = "entity_snapshots"
+
+    REFERENCE_KEY = "entity_snapshot"
+
+    hash = sql.Column(sql.String(40), primary_key=True)
+    data = sql.Column(psql.JSONB)
+
+    @staticmethod
+    def get_hash(data):
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def save_many(cls, data_list):
+        """
+        Stores the data (if it's not stored yet) and returns a list of references to it,
+        which can be put into event params.
+        The snapshots are locked with FOR KEY SHARE until the end of the transaction, so they can't be removed
+        as unreferenced before the events referencing them are committed. These locks don't block each other,
+        so many transactions can reference the same snapshot at the same time.
+        """
+        hashes = [cls.get_hash(data) for data in data_list]
+        data_by_hash = dict(zip(hashes, data_list))
+        not_locked_hashes = set(data_by_hash)
+        while not_locked_hashes:  # repeated only if a snapshot was removed in the meantime
+            # new snapshots are inserted in the order of hashes, so concurrent inserts of the same ones can't deadlock
+            db.session.execute(psql.insert(cls.__table__)
+                               .values([{"hash": snapshot_hash, "data": data_by_hash[snapshot_hash]}
+                                        for snapshot_hash in sorted(not_locked_hashes)])
+                               .on_conflict_do_nothing(index_elements=[cls.hash]))
+            locked_hashes = db.session.query(cls.hash).filter(cls.hash.in_(not_locked_hashes)) \
+                .with_for_update(read=True, key_share=True).all()
+            not_locked_hashes -= {snapshot_hash for snapshot_hash, in locked_hashes}
+        return [{cls.REFERENCE_KEY: snapshot_hash} for snapshot_hash in hashes]
+
+    @classmethod
+    def count_references(cls, hashes):
+        """
+        :return: dict of numbers of events referencing each of the snapshots
+        """
+        return {snapshot_hash: Event.query.filter(Event.referenced_snapshots.has_key(snapshot_hash)).count()
+                for snapshot_hash in set(hashes)}
+
+    @classmethod
+    def remove_unreferenced(cls, hashes):
+        """
+        Removes the snapshots which are not referenced by any event.
+        Snapshots locked by transactions which can reference them in new events are skipped.
+        """
+        if not hashes:
+            return
+        locked_hashes = [snapshot_hash for snapshot_hash, in db.session.query(cls.hash)
+                         .filter(cls.hash.in_(set(hashes))).with_for_update(skip_locked=True).all()]
+        if not locked_hashes:
+            return
+        # a separate statement, so it sees events committed by transactions which held the locks
+        cls.query.filter(cls.hash.in_(locked_hashes)) \
+            .filter(~sql.exists().where(Event.referenced_snapshots.has_key(cls.hash))) \
+            .delete(synchronize_session=False)
+
+    @staticmethod
+    def is_pyslatized_entity(value):
+        return isinstance(value, collections.Mapping) and "entity_type" in value
+
+    @classmethod
+    def is_reference(cls, value):
+        return isinstance(value, collections.Mapping) and cls.REFERENCE_KEY in value
+
+    @classmethod
+    def get_referenced_hashes(cls, params):
+        groups = params.get("groups") or {}
+        return [group[cls.REFERENCE_KEY] for group in groups.values() if cls.is_reference(group)]
+
+    @classmethod
+    def compact_groups(cls, params):
+        """
+        :return: copy of params where every pyslatized entity in "groups" is replaced by a reference to a snapshot
+        """
+        groups = params.get("groups")
+        if not groups:
+            return params
+        names_to_compact = [name for name, group in groups.items() if cls.is_pyslatized_entity(group)]
+        references = cls.save_many([groups[name] for name in names_to_compact])
+        return dict(params, groups=dict(groups, **dict(zip(names_to_compact, references))))
+
+    @classmethod
+    def resolve_groups(cls, params):
+        """
+        :return: copy of params where every reference to a snapshot in "groups" is replaced by its data
+        """
+        return cls.resolve_groups_of_many([params])[0]
+
+    @classmethod
+    def resolve_groups_of_many(cls, params_list):
+        """
+        Resolves groups of many params, loading all the referenced snapshots in a single query.
+        :return: list of resolved params in the order of `params_list`
+        """
+        hashes = {snapshot_hash for params in params_list for snapshot_hash in cls.get_referenced_hashes(params)}
+        data_by_hash = {}
+        if hashes:
+            data_by_hash = dict(db.session.query(cls.hash, cls.data).filter(cls.hash.in_(hashes)).all())
+        return [cls._replace_references(params, data_by_hash) for params in params_list]
+
+    @classmethod
+    def _replace_references(cls, params, data_by_hash):
+        groups = params.get("groups")
+        if not groups or not any(cls.is_reference(group) for group in groups.values()):
+            return params
+        resolved_groups = {}
+        for name, group in groups.items():
+            if not cls.is_reference(group):
+                resolved_groups[name] = group
+            elif group[cls.REFERENCE_KEY] in data_by_hash:
+                resolved_groups[name] = data_by_hash[group[cls.REFERENCE_KEY]]
+            else:
+                logger.warning("Entity snapshot %s referenced by group '%s' doesn't exist",
+                               group[cls.REFERENCE_KEY], name)
+        return dict(params, groups=resolved_groups)
+
+
 class Event(db.Model):
     __tablename__ = "events"
 
     id = sql.Column(sql.Integer, primary_key=True)
     type_name = sql.Column(sql.String, sql.ForeignKey("event_types.name"))
     type = sql.orm.relationship(EventType, uselist=False)
-    params = sql.Column(sqlalchemy_json_mutable.JsonDict)
-    date = sql.Column(sql.BigInteger)
+    # entities in groups are stored as references to EntitySnapshot, use `params` to get them resolved
+    compact_params = sql.Column("params", sqlalchemy_json_mutable.JsonDict)
+    date = sql.Column(sql.BigInteger, index=True)
 
     def __init__(self, event_type, params):
         if isinstance(event_type, str):
@@ -1088,12 +1329,51 @@ class Event(db.Model):
         from exeris.core import general
         self.date = general.GameDate.now().game_timestamp
 
+    @property
+    def params(self):
+        if not self._are_params_resolved():
+            self._resolved_params = EntitySnapshot.resolve_groups(self.compact_params)
+            self._resolved_params_source = self.compact_params
+        return self._resolved_params
+
+    @params.setter
+    def params(self, value):
+        self.compact_params = EntitySnapshot.compact_groups(value)
+
+    def _are_params_resolved(self):
+        # resolved params are valid as long as compact_params is not replaced or reloaded from the database
+        return getattr(self, "_resolved_params_source", None) is self.compact_params
+
+    @classmethod
+    def resolve_params_of_events(cls, events):
+        """
+        Resolves params of all the events in a single query, so later access to their `params` needs no queries.
+        """
+        events = [event for event in events if not event._are_params_resolved()]
+        resolved_params_list = EntitySnapshot.resolve_groups_of_many([event.compact_params for event in events])
+        for event, resolved_params in zip(events, resolved_params_list):
+            event._resolved_params = resolved_params
+            event._resolved_params_source = event.compact_params
+
+    @hybrid_property
+    def referenced_snapshots(self):
+        return EntitySnapshot.get_referenced_hashes(self.compact_params)
+
+    @referenced_snapshots.expression
+    def referenced_snapshots(cls):
+        return sql.func.jsonb_path_query_array(cls.compact_params, "$.groups.*." + EntitySnapshot.REFERENCE_KEY,
+                                               type_=psql.JSONB)
+
     @hybrid_property
     def observers(self):
         return [junction.observer for junction in self.observers_junction]
 
     def __repr__(self):
-        return "{Event, type=" + self.type_name + ", params=" + str(self.params) + "}"
+        return "{Event, type=" + self.type_name + ", params=" + str(self.compact_params) + "}"
+
+
+# index on hashes of the referenced snapshots, used to check if a snapshot is still referenced by any event
+sql.Index("events_referenced_snapshots_idx", Event.referenced_snapshots, postgresql_using="gin")
 
 
 class EventObserver(db.Model):
@@ -1107,15 +1387,65 @@ class EventObserver(db.Model):
                                                          passive_deletes=True))
     times_seen = sql.Column(sql.Integer)
 
+    # text of the event translated for the observer, valid only as long as rendered_version stays the same
+    rendered_text = sql.Column(sql.String, nullable=True)
+    rendered_version = sql.Column(sql.String(64), nullable=True)
+
     def __init__(self, event, observer):
         self.event = event
         self.observer = observer
         self.times_seen = 0
 
+    def get_rendered_text(self, version):
+        if version is not None and self.rendered_version == version:
+            return self.rendered_text
+        return None
+
+    def set_rendered_text(self, text, version):
+        if version is None:  # text couldn't be invalidated when translations are changed
+            return
+        self.rendered_text = text
+        self.rendered_version = version
+
+    @classmethod
+    def invalidate_rendered_texts(cls, observer_ids):
+        """
+        Drops rendered texts of all events seen by the specified observers,
+        e.g. because names of entities in these events could be changed.
+        """
+        if not observer_ids:
+            return
+        cls.query.filter(cls.observer_id.in_(observer_ids)) \
+            .update({cls.rendered_text: None, cls.rendered_version: None}, synchronize_session=False)
+
     def __repr__(self):
         return str(self.__class__) + str(self.__dict__)
 
 
+class ArchivedEvent(db.Model):
+    """
+    Event moved out of the events table when it's too old to be kept there.
+    Its params have all the groups resolved, so it doesn't depend on any EntitySnapshot.
+    """
+    __tablename__ = "archived_events"
+
+    id = sql.Column(sql.Integer, primary_key=True, autoincrement=False)  # the same as the id of the original event
+    type_name = sql.Column(sql.String)
+    params = sql.Column(psql.JSONB)
+    date = sql.Column(sql.BigInteger)
+    observer_ids = sql.Column(psql.ARRAY(sql.Integer))
+
+    def __init__(self, event, observer_ids):
+        self.id = event.id
+        self.type_name = event.type_name
+        self.params = event.params
+        self.date = event.date
+        self.observer_ids = observer_ids
+
+    def __repr__(self):
+        return "{ArchivedEvent, id=" + str(self.id) + ", type=" + self.type_name + "}"
+
+
 class EntityContentsPreference(db.Model):
     __tablename__ = "entity_contents_preferences"
 
@@ -1134,6 +1464,8 @@ class EntityContentsPreference(db.Model):
 
 class EntityTypeProperty(db.Model):
     __tablename__ = "entity_type_properties"
+    __table_args__ = (sql.Index("entity_type_properties_name_type_name_idx", "name", "type_name"),
+                      sql.Index("entity_type_properties_data_idx", "data", postgresql_using="gin"))
 
     def __init__(self, name, data=None, type=None):
         self.type = type
@@ -1146,12 +1478,18 @@ class EntityTypeProperty(db.Model):
     name = sql.Column(sql.String, primary_key=True)
     data = sql.Column(sqlalchemy_json_mutable.JsonDict)
 
+    @classmethod
+    def type_names_having(cls, name, *criteria):
+        return sql.select([cls.type_name]).where(sql.and_(cls.name == name, *criteria))
+
     def __repr__(self):
         return "{{EntityTypeProperty name={}, for={}, data={}}}".format(self.name, self.type_name, self.data)
 
 
 class EntityProperty(db.Model):
     __tablename__ = "entity_properties"
+    __table_args__ = (sql.Index("entity_properties_name_entity_id_idx", "name", "entity_id"),
+                      sql.Index("entity_properties_data_idx", "data", postgresql_using="gin"))
 
     entity_id = sql.Column(sql.Integer, sql.ForeignKey(Entity.id, ondelete="CASCADE"), primary_key=True)
     entity = sql.orm.relationship(Entity, uselist=False, back_populates="properties")
@@ -1164,10 +1502,202 @@ class EntityProperty(db.Model):
     name = sql.Column(sql.String, primary_key=True)
     data = sql.Column(sqlalchemy_json_mutable.JsonDict)
 
+    @classmethod
+    def entity_ids_having(cls, name, *criteria):
+        return sql.select([cls.entity_id]).where(sql.and_(cls.name == name, *criteria))
+
     def __repr__(self):
         return "Property(entity: {}, name: {}, data {}".format(self.entity.id, self.name, self.data)
 
 
+def _entity_classes_with_type_name():
+    return [mapper.class_ for mapper in Entity.__mapper__.self_and_descendants
+            if "type_name" in mapper.local_table.c]
+
+
+# index on union id of MemberOfUnion properties, used to find all members of the union
+sql.Index("entity_properties_union_id_idx", EntityProperty.data["union_id"].astext.cast(sql.Integer),
+          postgresql_where=EntityProperty.name == P.MEMBER_OF_UNION)
+
+
+def _is_type_changed(entity):
+    entity_state = sql.inspect(entity)
+    return "type_name" in entity_state.attrs.keys() and entity_state.attrs.type_name.history.has_changes()
+
+
+class StaleEffectiveProperties:
+    """
+    Entities and entity types whose properties were changed in the session since the last flush,
+    so Entity.effective_properties of these entities are outdated until the flush recomputes (or discards) them.
+    Deleting a property doesn't change any attribute, so pending deletions (usually very few) are checked separately.
+    It's tracked only when main.use_effective_properties is enabled.
+    """
+    SESSION_KEY = "stale_effective_properties"
+
+    def __init__(self):
+        self.entity_ids = set()
+        self.type_names = set()
+
+    @classmethod
+    def for_session(cls, session):
+        return session.info.setdefault(cls.SESSION_KEY, cls())
+
+    @classmethod
+    def mark_entity(cls, entity):
+        session = sql.orm.object_session(entity)
+        if main.use_effective_properties and session is not None and entity.id is not None:
+            cls.for_session(session).entity_ids.add(entity.id)
+
+    @classmethod
+    def mark_entity_id(cls, session, entity_id):
+        if main.use_effective_properties and session is not None and entity_id is not None:
+            cls.for_session(session).entity_ids.add(entity_id)
+
+    @classmethod
+    def mark_type_name(cls, session, type_name):
+        if main.use_effective_properties and session is not None and type_name is not None:
+            cls.for_session(session).type_names.add(type_name)
+
+    def is_stale(self, entity, deleted_objects):
+        if entity.id in self.entity_ids or entity.type_name in self.type_names:
+            return True
+        return any(isinstance(obj, EntityProperty) and obj.entity_id == entity.id
+                   or isinstance(obj, EntityTypeProperty) and obj.type_name == entity.type_name
+                   for obj in deleted_objects)
+
+
+@sql.event.listens_for(EntityProperty.data, "set")
+@sql.event.listens_for(EntityProperty.data, "modified")
+def mark_entity_of_changed_property(entity_property, *args):
+    StaleEffectiveProperties.mark_entity_id(sql.orm.object_session(entity_property), entity_property.entity_id)
+
+
+@sql.event.listens_for(Entity.properties, "append", propagate=True)
+@sql.event.listens_for(Entity.properties, "remove", propagate=True)
+def mark_entity_with_changed_properties(entity, *args):
+    StaleEffectiveProperties.mark_entity(entity)
+
+
+@sql.event.listens_for(EntityTypeProperty.data, "set")
+@sql.event.listens_for(EntityTypeProperty.data, "modified")
+def mark_type_of_changed_property(type_property, *args):
+    StaleEffectiveProperties.mark_type_name(sql.orm.object_session(type_property), type_property.type_name)
+
+
+@sql.event.listens_for(EntityType.properties, "append", propagate=True)
+@sql.event.listens_for(EntityType.properties, "remove", propagate=True)
+def mark_type_with_changed_properties(entity_type, *args):
+    StaleEffectiveProperties.mark_type_name(sql.orm.object_session(entity_type), entity_type.name)
+
+
+@sql.event.listens_for(sql.orm.Session, "after_commit")
+@sql.event.listens_for(sql.orm.Session, "after_soft_rollback")
+def forget_stale_effective_properties(session, *args):
+    session.info.pop(StaleEffectiveProperties.SESSION_KEY, None)
+
+
+def compute_effective_properties(entity, deleted_properties=()):
+    """
+    Merges data of all EntityTypeProperties and EntityProperties of the entity the same way as Entity.get_property.
+    """
+    effective_properties = {}
+    entity_type = getattr(entity, "type", None)
+    type_properties = entity_type.properties if entity_type is not None else []
+    for prop in itertools.chain(type_properties, entity.properties):
+        if prop not in deleted_properties:
+            # copy of the data, so it won't share nested dicts with the property
+            effective_properties.setdefault(prop.name, {}).update(json.loads(json.dumps(prop.data)))
+    return effective_properties
+
+
+def _entity_has_type_name(entity):
+    return "type_name" in sql.inspect(entity).mapper.columns
+
+
+def _discard_effective_properties_of_types(session, type_names):
+    """
+    Entities of the types can be too many to load them, so their effective properties are discarded
+    with a bulk update and recomputed lazily (see Entity.get_property and fill_missing_effective_properties).
+    """
+    entities_table = Entity.__table__
+    for entity_class in _entity_classes_with_type_name():
+        entity_class_table = entity_class.__table__
+        session.execute(entities_table.update()
+                        .where(entities_table.c.id.in_(sql.select([entity_class_table.c.id])
+                                                       .where(entity_class_table.c.type_name.in_(type_names))))
+                        .values(effective_properties=None))
+    for obj in list(session.identity_map.values()):
+        if not isinstance(obj, Entity) or not _entity_has_type_name(obj):
+            continue
+        loaded_attributes = sql.inspect(obj).dict
+        if "type_name" not in loaded_attributes:
+            session.expire(obj, ["effective_properties"])
+        elif loaded_attributes["type_name"] in type_names:
+            sql.orm.attributes.set_committed_value(obj, "effective_properties", None)
+
+
+@sql.event.listens_for(sql.orm.Session, "before_flush")
+def update_effective_properties(session, flush_context, instances):
+    """
+    Recomputes Entity.effective_properties of the entities whose properties are flushed.
+    Effective properties of all the entities of types with changed properties are discarded instead.
+    When main.use_effective_properties is disabled, they are not maintained at all
+    (and are discarded on startup by `prepare_effective_properties`).
+    """
+    if not main.use_effective_properties:
+        return
+
+    changed_entities = set()
+    changed_type_names = set()
+    deleted_objects = set(session.deleted)
+    for obj in itertools.chain(session.new, session.dirty, deleted_objects):
+        if isinstance(obj, EntityProperty):
+            if obj.entity is not None:
+                changed_entities.add(obj.entity)
+        elif isinstance(obj, EntityTypeProperty):
+            changed_type_names.add(obj.type.name if obj.type is not None else obj.type_name)
+        elif isinstance(obj, Entity) and (obj in session.new or _is_type_changed(obj)):
+            changed_entities.add(obj)
+    changed_type_names.discard(None)
+
+    if changed_type_names:
+        _discard_effective_properties_of_types(session, changed_type_names)
+    for entity in changed_entities - deleted_objects:
+        entity.effective_properties = compute_effective_properties(entity, deleted_objects)
+    session.info.pop(StaleEffectiveProperties.SESSION_KEY, None)  # they are up to date after the flush
+
+
+def prepare_effective_properties():
+    """
+    Called on startup. Effective properties are not maintained when main.use_effective_properties is disabled,
+    so they are discarded to be recomputed from scratch once the flag is enabled again.
+    """
+    if main.use_effective_properties:
+        fill_missing_effective_properties()
+    else:
+        Entity.query.filter(Entity.effective_properties.isnot(None)) \
+            .update({Entity.effective_properties: None}, synchronize_session=False)
+
+
+def fill_missing_effective_properties(batch_size=1000):
+    """
+    Computes Entity.effective_properties for all the entities which don't have them,
+    e.g. created or modified when main.use_effective_properties was disabled.
+    """
+    while True:
+        entities = Entity.query.with_polymorphic("*") \
+            .filter(Entity.effective_properties.is_(None)).limit(batch_size).all()
+        if not entities:
+            return
+        for entity in entities:
+            entity.effective_properties = compute_effective_properties(entity)
+        db.session.flush()
+
+
+# changes of a few keys of JsonDict columns (e.g. Entity.states) are saved using jsonb_set
+sqlalchemy_json_mutable.enable_partial_updates(sql.orm.Session)
+
+
 class PassageToNeighbour:
     """
     View class for displaying passage from the perspective of one side.
@@ -1302,6 +1832,8 @@ class Sequences(db.Model):
     __tablename__ = "sequences"
     entity_union_sequence = sql.Sequence("entity_union_sequence")
     serial_id = sql.Column(sql.Integer, entity_union_sequence, primary_key=True)
+    # values encoded by general.Identifiers, not bound to any column so it needs to be in metadata to be created
+    unique_identifier_sequence = sql.Sequence("unique_identifier_sequence", metadata=db.metadata)
 
 
 class RootLocation(Location):
@@ -1618,6 +2150,19 @@ class ObservedName(db.Model):
         self.target = target
         self.name = name
 
+    @classmethod
+    def get_names_by_observer_id(cls, observer_ids, target_ids):
+        """
+        :return: dict of names given to the targets (by target id) for every observer id having any of these names
+        """
+        if not observer_ids or not target_ids:
+            return {}
+        names_by_observer_id = collections.defaultdict(dict)
+        for observer_id, target_id, name in db.session.query(cls.observer_id, cls.target_id, cls.name) \
+                .filter(cls.observer_id.in_(observer_ids)).filter(cls.target_id.in_(target_ids)).all():
+            names_by_observer_id[observer_id][target_id] = name
+        return names_by_observer_id
+
     def __repr__(self):
         return "{{ObservedName target={}, by={}, name={}}}".format(self.target, self.observer, self.name)
 
@@ -1728,12 +2273,22 @@ class ScheduledTask(db.Model):
     process_data = sql.Column(sqlalchemy_json_mutable.JsonList)
     execution_game_timestamp = sql.Column(sql.BigInteger, index=True)
     execution_interval = sql.Column(sql.Integer, nullable=True)
+    # a task is run by the scheduler which claimed it, others skip it until the claim expires
+    claimed_until = sql.Column(sql.DateTime, nullable=True)
 
     def __init__(self, process_json, execution_game_timestamp, execution_interval=None):
         self.process_data = process_json
         self.execution_game_timestamp = execution_game_timestamp
         self.execution_interval = execution_interval
 
+    @hybrid_property
+    def process_name(self):
+        return self.process_data[0]
+
+    @process_name.expression
+    def process_name(cls):
+        return cls.process_data[0].astext
+
     def is_repeatable(self):
         return self.execution_interval is not None
 
@@ -8,7 +8,7 @@ import markdown
 import sqlalchemy as sql
 from shapely.geometry import Point
 
-from exeris.core import models, main, deferred
+from exeris.core import models, main
 from exeris.core.main import db
 from exeris.core.properties_base import P, PropertyBase, OptionalPropertyBase
 
@@ -22,6 +22,7 @@ class DynamicNameableProperty(PropertyBase):
         if not observer:
             raise ValueError
 
+        models.EventObserver.invalidate_rendered_texts([observer.id])
         existing_name = models.ObservedName.query.filter_by(observer=observer, target=self.entity).first()
         if existing_name:
             existing_name.name = name
@@ -45,6 +46,15 @@ class SkillsProperty(PropertyBase):
 
         return statistics.mean([specific_skill_value, general_skill_value])
 
+    def get_skill_factors(self, skill_types):
+        """
+        Returns a dict of skill factors (like `get_skill_factor`) for all the specified skill types at once.
+        """
+        return {skill_type.name: statistics.mean([
+            self.property_dict.get(skill_type.name, SkillsProperty.SKILL_DEFAULT_VALUE),
+            self.property_dict.get(skill_type.general_name, SkillsProperty.SKILL_DEFAULT_VALUE)])
+            for skill_type in skill_types}
+
     def get_all_skills(self):
 
         skill_values = {}
@@ -197,14 +207,14 @@ class CombatableProperty(PropertyBase):
     def combat_action(self):
         combat_intent = models.Intent.query.filter_by(type=main.Intents.COMBAT, executor=self.entity).first()
         if combat_intent:
-            return deferred.call(combat_intent.serialized_action)
+            return combat_intent.get_action()
         return None
 
     @combat_action.setter
     def combat_action(self, combat_action):
         combat_intent = models.Intent.query.filter_by(type=main.Intents.COMBAT, executor=self.entity).first()
         if combat_intent:
-            combat_intent.serialized_action = deferred.serialize(combat_action)
+            combat_intent.set_action(combat_action)
         raise ValueError("Can't update combat action, {} is not in combat".format(self.entity))
 
     def get_weapon(self):
@@ -314,9 +324,26 @@ class OptionalMemberOfUnionProperty(OptionalPropertyBase):
         own_property = self.entity_property
         if not own_property:
             return []
-        return models.EntityProperty.query \
+        union_id = own_property.data["union_id"]
+        return self.get_entity_properties_of_unions([union_id])[union_id]
+
+    @classmethod
+    def get_entity_properties_of_unions(cls, union_ids):
+        """
+        Returns a dict of lists of MemberOfUnion entity properties (with the entities loaded) of all the union members
+        for every union id, using a single query.
+        """
+        entity_properties_by_union_id = {union_id: [] for union_id in union_ids}
+        if not entity_properties_by_union_id:
+            return entity_properties_by_union_id
+
+        entity_properties = models.EntityProperty.query \
             .filter_by(name=P.MEMBER_OF_UNION) \
-            .filter(self.json_to_int(models.EntityProperty.data["union_id"]) == own_property.data["union_id"]).all()
+            .filter(cls.json_to_int(models.EntityProperty.data["union_id"]).in_(entity_properties_by_union_id.keys())) \
+            .options(sql.orm.joinedload(models.EntityProperty.entity)).all()
+        for entity_property in entity_properties:
+            entity_properties_by_union_id[entity_property.data["union_id"]].append(entity_property)
+        return entity_properties_by_union_id
 
     def is_in_same_union_as(self, other_entity):
         return other_entity in [ep.entity for ep in self.get_entity_properties_of_own_union()]
@@ -336,21 +363,25 @@ class OptionalMemberOfUnionProperty(OptionalPropertyBase):
         """Split union into two unions. It is split across the passage between `self.entity` and `neighbouring_location`
         It is required that there is no other path from `self.entity` and `neighbouring_location`
         except the single direct passage"""
-        entities_in_former_union = [prop.entity for prop in self.get_entity_properties_of_own_union()]
+        from exeris.core import general
+        entities_in_former_union = {prop.entity for prop in self.get_entity_properties_of_own_union()}
+        location_graph = general.LocationGraph.for_session()  # passages are loaded before any union id is changed
+        location_graph.load([entity for entity in entities_in_former_union if isinstance(entity, models.Location)])
 
         new_union_id = self.create_new_union_id()
         self._update_union_id(self.entity, new_union_id)
 
-        passages_to_visit = self.entity.passages_to_neighbours
-        visited_locations = []
-        while len(passages_to_visit):
-            passage = passages_to_visit.pop()
-            loc_on_other_side = passage.other_side
-            if loc_on_other_side != neighbouring_location and loc_on_other_side in entities_in_former_union:
-                self._update_union_id(loc_on_other_side, new_union_id)
-                visited_locations.append(loc_on_other_side)
-                passages_to_visit += [psg for psg in loc_on_other_side.passages_to_neighbours if
-                                      psg.other_side not in visited_locations]
+        locations_to_visit = [self.entity]
+        visited_locations = {self.entity}
+        while locations_to_visit:
+            location = locations_to_visit.pop()
+            for passage_to_neighbour in location_graph.get_passages_to_neighbours(location):
+                loc_on_other_side = passage_to_neighbour.other_side
+                if loc_on_other_side != neighbouring_location and loc_on_other_side not in visited_locations \
+                        and loc_on_other_side in entities_in_former_union:
+                    self._update_union_id(loc_on_other_side, new_union_id)
+                    visited_locations.add(loc_on_other_side)
+                    locations_to_visit.append(loc_on_other_side)
 
     def _update_union_id(self, location, new_union_id):
         entity_prop = location.get_entity_property(P.MEMBER_OF_UNION)
@@ -1,5 +1,8 @@
+import collections
 import copy
 
+import sqlalchemy as sql
+
 from exeris.core import models, deferred, general, main
 from exeris.core import properties
 from exeris.core.main import db, Types
@@ -139,7 +142,7 @@ class ActivityFactory:
 
         for action_name, action_args in result:
             action_args = copy.deepcopy(action_args)
-            action_class = deferred.object_import(action_name)  # get result class by name
+            action_class = deferred.get_compiled(action_name).callable  # get result class by name
             if hasattr(action_class, "_form_inputs"):
                 for input_name, input_class in action_class._form_inputs.items():
                     # if user_input wasn't already set explicitly
@@ -168,11 +171,11 @@ class ActivityFactory:
 
     @classmethod
     def get_user_inputs_for_recipe(cls, recipe):
-        result_actions_and_args = [(deferred.object_import(x[0]), x[1]) for x in recipe.result]
+        result_actions_and_args = [(deferred.get_compiled(x[0]).callable, x[1]) for x in recipe.result]
         result_actions_requiring_input = [x for x in result_actions_and_args if hasattr(x[0], "_form_inputs")]
         if recipe.result_entity:
             result_entity_action_and_args = ActivityFactory.action_from_result_entity(recipe.result_entity)
-            result_entity_action_and_args[0] = deferred.object_import(result_entity_action_and_args[0])
+            result_entity_action_and_args[0] = deferred.get_compiled(result_entity_action_and_args[0]).callable
             if hasattr(result_entity_action_and_args[0], "_form_inputs"):
                 result_actions_requiring_input.append(result_entity_action_and_args)
 
@@ -200,42 +203,39 @@ class ActivityFactory:
             descending_types = models.EntityType.by_name(type_name).get_descending_types()
             allowed_types += [subtype.name for subtype, eff in descending_types]
 
-        # items
-        item_query_parts = cls.property_related_query_parts(activity_container_spec, models.Item)
-        if allowed_types:
-            item_query_parts += [models.Item.type_name.in_(allowed_types)]
-        items = models.Item.query.filter(models.Item.is_in(character.parent_locations()),
-                                         *item_query_parts).all()
-
-        # locations
-        location_ids = models.ids(character.parent_locations())
-        for loc in character.parent_locations():
-            location_ids += [directed_passage.other_side.id for directed_passage in loc.passages_to_neighbours
-                             if directed_passage.passage.is_accessible(False)]
-
-        loc_query_parts = cls.property_related_query_parts(activity_container_spec, models.Location)
-        if allowed_types:
-            loc_query_parts += [models.Location.type_name.in_(allowed_types)]
-
-        locations = models.Location.query.filter(models.Location.id.in_(location_ids),
-                                                 *loc_query_parts).all()
-
-        # passages
-        passage_ids = []
-        for loc in character.parent_locations():
-            passage_ids += [directed_passage.passage.id for directed_passage in loc.passages_to_neighbours
-                            if directed_passage.passage.is_accessible(False)]
-
-        passage_query_parts = cls.property_related_query_parts(activity_container_spec, models.Passage)
-        if allowed_types:
-            passage_query_parts += [models.Passage.type_name.in_(allowed_types)]
-
-        passages = []
+        parent_locations = character.parent_locations()
+        location_graph = general.LocationGraph.for_session()
+        location_graph.load(parent_locations)
+        accessible_passages = [directed_passage for loc in parent_locations
+                               for directed_passage in location_graph.get_accessible_passages_to_neighbours(loc)]
+
+        location_ids = models.ids(parent_locations) + [directed_passage.other_side.id
+                                                       for directed_passage in accessible_passages]
+        passage_ids = [directed_passage.passage.id for directed_passage in accessible_passages]
+
+        def candidate_ids_query(entity_class, *criteria):
+            query_parts = cls.property_related_query_parts(activity_container_spec, entity_class)
+            if allowed_types:
+                query_parts += [entity_class.type_name.in_(allowed_types)]
+            return db.session.query(entity_class.id.label("entity_id")).filter(*criteria, *query_parts).statement
+
+        candidate_queries = [candidate_ids_query(models.Item, models.Item.is_in(parent_locations)),
+                             candidate_ids_query(models.Location, models.Location.id.in_(location_ids))]
         if passage_ids:
-            passages = models.Passage.query.filter(models.Passage.id.in_(passage_ids),
-                                                   *passage_query_parts).all()
+            candidate_queries += [candidate_ids_query(models.Passage, models.Passage.id.in_(passage_ids))]
+        candidate_ids = sql.union_all(*candidate_queries).alias("candidate_ids")
+
+        # all the candidates are loaded at once, so subclass columns need to be loaded together with the entity
+        entity_with_subclasses = sql.orm.with_polymorphic(
+            models.Entity, [models.Item, models.Location, models.RootLocation, models.Passage])
+        entities = db.session.query(entity_with_subclasses) \
+            .filter(entity_with_subclasses.id.in_(sql.select([candidate_ids.c.entity_id]))) \
+            .order_by(entity_with_subclasses.id).all()
 
-        return items + locations + passages
+        # keep items first, then locations and passages
+        entity_classes_order = [models.Item, models.Location, models.Passage]
+        return sorted(entities, key=lambda entity: next(i for i, entity_class in enumerate(entity_classes_order)
+                                                        if isinstance(entity, entity_class)))
 
     @classmethod
     def property_related_query_parts(cls, activity_container_spec, entity_class):
@@ -290,81 +290,159 @@ class ActivityFactory:
         return errors
 
 
-class RecipeListProducer:
-    def __init__(self, character):
-        self.character = character
+class RecipeIndex:
+    """
+    Requirements of recipes precomputed to be matched using set operations against a character's context.
+    Recipes are bucketed by location types and concrete types of all the groups
+    of mandatory tools and machines are found only once.
+    It keeps only ids of recipes and plain data, so it can be shared by many sessions (see `RecipeIndexCache`).
+    """
 
-    def get_recipe_list(self):
-        # prefetch data
-        location = self.character.get_location()
+    def __init__(self, recipes):
+        self.position_by_recipe_id = {recipe.id: position for position, recipe in enumerate(recipes)}
+        self.recipe_ids_for_any_location_type = []
+        self.recipe_ids_by_location_type = collections.defaultdict(list)
+        self.requirements_by_recipe_id = {}
+
+        self._concrete_type_names_by_group_name = {}
+        for recipe in recipes:
+            req = recipe.requirements
+            if "location_types" in req:
+                for location_type in req["location_types"]:
+                    self.recipe_ids_by_location_type[location_type].append(recipe.id)
+            else:
+                self.recipe_ids_for_any_location_type.append(recipe.id)
+
+            self.requirements_by_recipe_id[recipe.id] = {
+                "terrain_types": set(req["terrain_types"]) if "terrain_types" in req else None,
+                "permanence": "permanence" in req,
+                "skills": list(req.get("skills", {}).items()),
+                "required_resources": set(req["required_resources"]) if "required_resources" in req else None,
+                "mandatory_machines": [self._get_concrete_type_names(machine_name)
+                                       for machine_name in req.get("mandatory_machines", [])],
+                "mandatory_tools": [self._get_concrete_type_names(tool_type_name)
+                                    for tool_type_name in req.get("mandatory_tools", [])],
+            }
+
+    def _get_concrete_type_names(self, group_name):
+        if group_name not in self._concrete_type_names_by_group_name:
+            group = models.EntityType.by_name(group_name)
+            self._concrete_type_names_by_group_name[group_name] = {
+                entity_type.name for entity_type in models.get_concrete_types_for_groups([group])}
+        return self._concrete_type_names_by_group_name[group_name]
+
+    def get_available_recipe_ids(self, context):
+        candidate_recipe_ids = set(self.recipe_ids_for_any_location_type)
+        candidate_recipe_ids.update(self.recipe_ids_by_location_type.get(context.location_type, []))
+
+        available_recipe_ids = [recipe_id for recipe_id in candidate_recipe_ids
+                                if self._meets_requirements(self.requirements_by_recipe_id[recipe_id], context)]
+        return sorted(available_recipe_ids, key=lambda recipe_id: self.position_by_recipe_id[recipe_id])
+
+    @staticmethod
+    def _meets_requirements(req, context):
+        if req["terrain_types"] is not None and not req["terrain_types"].intersection(context.terrain_types):
+            return False
+
+        if req["permanence"] and not context.can_be_permanent:
+            return False
+
+        for skill_name, min_skill_value in req["skills"]:
+            if context.skills[skill_name] < min_skill_value:
+                return False
 
-        skills = {}
-        for (skill_name,) in db.session.query(models.SkillType.name).all():
-            skills_property = properties.SkillsProperty(self.character)
-            skills[skill_name] = skills_property.get_skill_factor(skill_name)
+        if req["required_resources"] is not None \
+                and not req["required_resources"].intersection(context.available_resources):
+            return False
+
+        for machine_type_names in req["mandatory_machines"]:
+            if not machine_type_names.intersection(context.machine_type_names):
+                return False
+
+        for tool_type_names in req["mandatory_tools"]:
+            if not tool_type_names.intersection(context.tool_type_names):
+                return False
+
+        return True
+
+
+class RecipeContext:
+    """
+    Everything about the character's surroundings which is needed to check which recipes are available.
+    """
+
+    def __init__(self, character):
+        location = character.get_location()
+
+        skill_types = models.SkillType.query.all()
+        self.skills = properties.SkillsProperty(character).get_skill_factors(skill_types) if skill_types else {}
 
         character_position = location.get_position()
 
-        location_type = location.type_name
+        self.location_type = location.type_name
         terrain_types = db.session.query(models.TerrainArea.type_name) \
             .filter(models.TerrainArea.terrain.ST_Intersects(character_position.wkt)).all()
-        terrain_types = [terain_type[0] for terain_type in terrain_types]
+        self.terrain_types = {terrain_type[0] for terrain_type in terrain_types}
 
         available_resources = db.session.query(models.ResourceArea.resource_type_name) \
             .filter(models.ResourceArea.center.ST_DWithin(character_position.wkt, models.ResourceArea.radius)).all()
-        available_resources = [resource[0] for resource in available_resources]
+        self.available_resources = {resource[0] for resource in available_resources}
 
-        can_be_permanent = location.get_root().can_be_permanent()
+        self.can_be_permanent = location.get_root().can_be_permanent()
 
-        all_recipes = models.EntityRecipe.query.all()
+        # the character itself is considered a machine, see `ActivityProgress.get_all_machines_around_entity`
+        machine_type_names = db.session.query(models.Item.type_name) \
+            .filter(models.Item.is_in(character.parent_locations())).distinct().all()
+        self.machine_type_names = {character.type_name} | {type_name for (type_name,) in machine_type_names}
 
-        def is_recipe_available(recipe):
-            req = recipe.requirements
-
-            if "location_types" in req:
-                if location_type not in req["location_types"]:
-                    return False
+        tool_type_names = db.session.query(models.Item.type_name) \
+            .filter(models.Item.is_in(character)).distinct().all()
+        self.tool_type_names = {type_name for (type_name,) in tool_type_names}
 
-            if "terrain_types" in req:
-                if not set(req["terrain_types"]).intersection(set(terrain_types)):
-                    return False
 
-            if "permanence" in req:
-                if not can_be_permanent:
-                    return False
+class RecipeIndexCache:
+    """
+    RecipeIndex shared by all the requests handled by the process.
+    It's rebuilt only when the version of recipes (hash of recipes and elements of type groups) changes.
+    """
 
-            if "skills" in req:
-                for skill_name, min_skill_value in req["skills"]:
-                    if skills[skill_name] < min_skill_value:
-                        return False
+    def __init__(self):
+        self._version_and_index = None, None
 
-            if "required_resources" in req:
-                if not set(req["required_resources"]).intersection(set(available_resources)):
-                    return False
+    def get(self):
+        version = self.get_recipes_version()
+        cached_version, recipe_index = self._version_and_index
+        if version != cached_version:
+            recipe_index = RecipeIndex(models.EntityRecipe.query.order_by(models.EntityRecipe.id).all())
+            self._version_and_index = version, recipe_index
+        return recipe_index
 
-            if "mandatory_machines" in req:
-                for machine_name in req["mandatory_machines"]:
-                    group = models.EntityType.by_name(machine_name)
-                    allowed_types = models.get_concrete_types_for_groups([group])
+    @staticmethod
+    def get_recipes_version():
+        return db.session.execute(
+            "SELECT (SELECT md5(coalesce(string_agg(id || ':' || requirements::text, ',' ORDER BY id), ''))"
+            "        FROM entity_recipes)"
+            "    || (SELECT md5(coalesce(string_agg(parent_name || '>' || child_name, ','"
+            "                                       ORDER BY parent_name, child_name), ''))"
+            "        FROM entity_group_elements)").scalar()
 
-                    from exeris.core import actions
-                    machines = actions.ActivityProgress.get_all_machines_around_entity(allowed_types,
-                                                                                       self.character)
-                    if not machines:
-                        return False
 
-            if "mandatory_tools" in req:
-                for tool_type_name in req["mandatory_tools"]:
-                    group = models.EntityType.by_name(tool_type_name)
-                    allowed_types = models.get_concrete_types_for_groups([group])
+recipe_index_cache = RecipeIndexCache()
 
-                    tools = general.ItemQueryHelper.query_all_types_in(allowed_types, self.character).first()
-                    if not tools:
-                        return False
 
-            return True
+class RecipeListProducer:
+    def __init__(self, character, recipe_index=None):
+        self.character = character
+        self.recipe_index = recipe_index
 
-        return [recipe for recipe in all_recipes if is_recipe_available(recipe)]
+    def get_recipe_list(self):
+        recipe_index = self.recipe_index or recipe_index_cache.get()
+        available_recipe_ids = recipe_index.get_available_recipe_ids(RecipeContext(self.character))
+        if not available_recipe_ids:
+            return []
+        recipes_by_id = {recipe.id: recipe for recipe in
+                         models.EntityRecipe.query.filter(models.EntityRecipe.id.in_(available_recipe_ids)).all()}
+        return [recipes_by_id[recipe_id] for recipe_id in available_recipe_ids if recipe_id in recipes_by_id]
 
 
 class InputField:
@@ -5,8 +5,6 @@ import math
 from exeris.core import map_data
 from shapely.geometry import Point
 
-import sqlalchemy as sql
-
 
 def round_probabilistic(value):
     """
@@ -86,19 +84,6 @@ def serialize_notifications(notifications, pyslate):
              } for n in notifications]
 
 
-class Sql:
-    @staticmethod
-    def cast_json_value_to_psql_type(field, value):
-        field = field.astext
-        if isinstance(value, bool):
-            field = field.cast(sql.Boolean)
-        elif isinstance(value, int):
-            field = field.cast(sql.Integer)
-        elif isinstance(value, float):
-            field = field.cast(sql.Float)
-        return field
-
-
 def cart_to_pol(certesian_point):
     rho = math.sqrt(certesian_point.x ** 2 + certesian_point.y ** 2)
     phi = math.atan2(certesian_point.y, certesian_point.x)
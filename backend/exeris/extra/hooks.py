@@ -1,11 +1,11 @@
+import collections
+
 import exeris
-from exeris.app import app, socketio
+from exeris.app import socketio
 from exeris.core import main, actions, models, util
 from exeris.core.properties_base import P
 from exeris.extra import notifications_service
-from exeris.core.i18n import create_pyslate
-from pyslate.backends import postgres_backend
-import psycopg2
+from exeris.core.i18n import create_pyslate, render_event_texts
 
 
 @main.hook(main.Hooks.DAMAGE_EXCEEDED)
@@ -27,25 +27,34 @@ def on_root_location_contents_reduced(entity):
         entity.remove()
 
 
-@main.hook(main.Hooks.NEW_EVENT)
-def on_new_event(event_observer):
-    observer = event_observer.observer
-    event = event_observer.event
+@main.hook(main.Hooks.NEW_EVENTS)
+def on_new_events(event_observers):
+    sids_by_player_id = exeris.app.socketio_users.get_all_by_player_ids(
+        {event_observer.observer.player_id for event_observer in event_observers})
+
+    event_observers_to_send = [event_observer for event_observer in event_observers
+                               if sids_by_player_id[event_observer.observer.player_id]]
+    if not event_observers_to_send:
+        return
 
-    conn = psycopg2.connect(app.config["SQLALCHEMY_DATABASE_URI"])
-    pyslate = create_pyslate(observer.language, backend=postgres_backend.PostgresBackend(conn, "translations"),
-                             character=observer)
+    event_observers_by_language = collections.defaultdict(list)
+    for event_observer in event_observers_to_send:
+        event_observers_by_language[event_observer.observer.language].append(event_observer)
 
-    for sid in exeris.app.socketio_users.get_all_by_player_id(observer.player_id):
-        notifications_service.add_event_to_send(sid, observer.id, event.id,
-                                                pyslate.t("game_date", game_date=event.date) + ": " +
-                                                pyslate.t(event.type_name, html=True, **event.params))
+    for language, event_observers_in_language in event_observers_by_language.items():
+        pyslate = create_pyslate(language, backend=exeris.app.translation_backend)
+        rendered_version = exeris.app.get_rendered_event_version(language)
+        event_texts = render_event_texts(pyslate, event_observers_in_language)
+        for event_observer, event_text in zip(event_observers_in_language, event_texts):
+            observer = event_observer.observer
+            event_observer.set_rendered_text(event_text, rendered_version)
+            for sid in sids_by_player_id[observer.player_id]:
+                notifications_service.add_event_to_send(sid, observer.id, event_observer.event.id, event_text)
 
 
 @main.hook(main.Hooks.NEW_CHARACTER_NOTIFICATION)
 def on_new_notification(character, notification):
-    conn = psycopg2.connect(app.config["SQLALCHEMY_DATABASE_URI"])
-    pyslate = create_pyslate(character.language, backend=postgres_backend.PostgresBackend(conn, "translations"),
+    pyslate = create_pyslate(character.language, backend=exeris.app.translation_backend,
                              character=character)
 
     for sid in exeris.app.socketio_users.get_all_by_player_id(character.player_id):
@@ -55,8 +64,7 @@ def on_new_notification(character, notification):
 
 @main.hook(main.Hooks.NEW_PLAYER_NOTIFICATION)
 def on_new_player_notification(player, notification):
-    conn = psycopg2.connect(app.config["SQLALCHEMY_DATABASE_URI"])
-    pyslate = create_pyslate(player.language, backend=postgres_backend.PostgresBackend(conn, "translations"))
+    pyslate = create_pyslate(player.language, backend=exeris.app.translation_backend)
 
     for sid in exeris.app.socketio_users.get_all_by_player_id(player.id):
         notification_info = util.serialize_notifications([notification], pyslate)[0]
@@ -67,3 +75,8 @@ def on_new_player_notification(player, notification):
 def on_position_changed(character):
     for sid in exeris.app.socketio_users.get_all_by_player_id(character.player_id):
         socketio.emit("character.position_changed", (character.id,), room=sid)
+
+
+@main.hook(main.Hooks.COMBAT_ROUND_RESOLVED)
+def on_combat_round_resolved(combat_entity, fighters_count, duration):
+    exeris.app.combat_round_timings.record(duration)
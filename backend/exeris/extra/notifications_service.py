@@ -1,38 +1,60 @@
 # Notification and in-game event queue service. Should be referenced directly.
 # It queues all pending notifications and events to send them to the client through socketio
 # if and only if the transaction is commited successfully.
-# In case of rollback all the queued data is discarded
+# In case of rollback all the queued data is discarded.
+# The queue (outbox) is stored in the info dict of the current session, so concurrent requests
+# (which use separate sessions) never send or discard each other's data.
+# Everything queued for the same room (sid) is sent as a single message.
+
+import collections
 
 import sqlalchemy
 from exeris.app import socketio
+from exeris.core.main import db
 from flask_sqlalchemy import SignallingSession
 
-_notifications_to_send = []
-_events_to_send = []
+OUTBOX_KEY = "notifications_outbox"
+
+
+class Outbox:
+    def __init__(self):
+        self.events_by_room = collections.OrderedDict()
+        self.notifications_by_room = collections.OrderedDict()
+
+    def add_event(self, sid, observer_id, event_id, event_text):
+        self.events_by_room.setdefault(sid, []).append((observer_id, {"id": event_id, "text": event_text}))
+
+    def add_notification(self, sid, notification):
+        self.notifications_by_room.setdefault(sid, []).append(notification)
+
+
+def _get_outbox(session):
+    return session.info.setdefault(OUTBOX_KEY, Outbox())
 
 
 def add_event_to_send(sid, observer_id, event_id, event_text):
-    _events_to_send.append((sid, observer_id, event_id, event_text))
+    _get_outbox(db.session()).add_event(sid, observer_id, event_id, event_text)
 
 
 def add_notification_to_send(sid, notification):
-    _notifications_to_send.append((sid, notification))
+    _get_outbox(db.session()).add_notification(sid, notification)
 
 
 @sqlalchemy.event.listens_for(SignallingSession, 'after_commit')
 def send_after_commit(session):
-    for new_event in _events_to_send:
-        socketio.emit("character.new_event", (new_event[1],
-                                              {"id": new_event[2], "text": new_event[3]}), room=new_event[0])
+    if session.transaction.nested:  # releasing a savepoint doesn't commit anything yet
+        return
+    outbox = session.info.pop(OUTBOX_KEY, None)
+    if not outbox:
+        return
 
-    for new_notification in _notifications_to_send:
-        socketio.emit("player.new_notification", (new_notification[1],), room=new_notification[0])
+    for sid, events in outbox.events_by_room.items():
+        socketio.emit("character.new_events", (events,), room=sid)
 
-    _notifications_to_send.clear()
-    _events_to_send.clear()
+    for sid, notifications in outbox.notifications_by_room.items():
+        socketio.emit("player.new_notifications", (notifications,), room=sid)
 
 
 @sqlalchemy.event.listens_for(SignallingSession, 'after_rollback')
 def send_after_rollback(session):
-    _notifications_to_send.clear()
-    _events_to_send.clear()
+    session.info.pop(OUTBOX_KEY, None)
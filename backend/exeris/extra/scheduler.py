@@ -1,13 +1,27 @@
+import datetime
 import logging
 import time
 
+import sqlalchemy as sql
+
 from exeris.core import models, deferred, general
 from exeris.core.main import db
 
 
 class Scheduler:
-    def __init__(self):
+    # the longest time a task can take, after that it can be run by another scheduler
+    TASK_CLAIM_DURATION = datetime.timedelta(minutes=10)
+
+    def __init__(self, included_processes=None, excluded_processes=None):
+        """
+        Many schedulers can run at the same time in separate processes, because every task is claimed
+        (with a short committed update, skipping the tasks claimed by others) till it's done.
+        :param included_processes: qualified names of the only processes to run, all are run if not specified
+        :param excluded_processes: qualified names of processes which should never be run by this scheduler
+        """
         self.logger = logging.getLogger(__name__)
+        self.included_processes = included_processes
+        self.excluded_processes = excluded_processes
 
     def run(self):
         while True:
@@ -21,11 +35,13 @@ class Scheduler:
             task = self.pop_task()
             if task:
                 self.logger.info("### Running task %s", task.process_data)
+                self.claim_task(task)
 
                 self.process_task(task)
 
                 if task.is_repeatable():  # it should be kept in the database to be used again
                     self.update_next_execution_time(task)
+                    task.claimed_until = None
                 else:
                     db.session.delete(task)
                     self.logger.info("Task deleted")
@@ -40,8 +56,26 @@ class Scheduler:
 
         self.logger.debug("current game timestamp: " + str(current_timestamp))
 
-        return models.ScheduledTask.query.filter(models.ScheduledTask.execution_game_timestamp <= current_timestamp) \
-            .order_by(models.ScheduledTask.execution_game_timestamp).first()
+        tasks_query = models.ScheduledTask.query \
+            .filter(models.ScheduledTask.execution_game_timestamp <= current_timestamp) \
+            .filter(sql.or_(models.ScheduledTask.claimed_until.is_(None),
+                            models.ScheduledTask.claimed_until < datetime.datetime.now()))
+        if self.included_processes is not None:
+            tasks_query = tasks_query.filter(models.ScheduledTask.process_name.in_(self.included_processes))
+        if self.excluded_processes:
+            tasks_query = tasks_query.filter(~models.ScheduledTask.process_name.in_(self.excluded_processes))
+
+        # the lock prevents other schedulers from claiming the same task before the claim is committed
+        return tasks_query.order_by(models.ScheduledTask.execution_game_timestamp) \
+            .with_for_update(skip_locked=True).first()
+
+    def claim_task(self, task):
+        """
+        The claim is committed before the task is run, so the task doesn't keep a row lock (or a transaction)
+        open for the whole time and the processes can commit their own transactions.
+        """
+        task.claimed_until = datetime.datetime.now() + Scheduler.TASK_CLAIM_DURATION
+        self._commit_transaction()
 
     def process_task(self, task):
         tries = 0
@@ -51,10 +85,12 @@ class Scheduler:
             try:
                 self._start_transaction()  # force finishing previous transaction
                 tries += 1
+                start_time = time.monotonic()
                 process.perform()
 
                 self._commit_transaction()
-                self.logger.info("Task executed successfully: %s", task.process_data)
+                self.logger.info("Task executed successfully in %.3f s: %s", time.monotonic() - start_time,
+                                 task.process_data)
                 return True
             except Exception as e:
                 self.logger.warning("Failed to run process for the %s time: %s,", tries, task.process_data,
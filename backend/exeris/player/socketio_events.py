@@ -53,8 +53,7 @@ def get_notifications_list():
 
     notifications = util.serialize_notifications(notifications, g.pyslate)
 
-    for notification in notifications:
-        client_socket.emit("player.new_notification", notification)
+    client_socket.emit("player.new_notifications", notifications)
 
 
 @socketio_player_event("player.show_notification")
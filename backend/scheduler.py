@@ -1,23 +1,43 @@
 #!/usr/bin/env python3
+import multiprocessing
+
 import exeris.extra.scheduler as scheduler
 from exeris.app import app
-from exeris.core import general, models
+from exeris.core import general, models, actions, deferred, migrations
 from exeris.core.main import db
 
+COMBAT_PROCESSES = [deferred.get_qualified_class_name(actions.CombatProcess)]
+
+PERIODIC_PROCESSES = [
+    ("exeris.core.actions.WorkProcess", 5),
+    ("exeris.core.actions.EatingProcess", 3600),
+    ("exeris.core.actions.AnimalsProcess", 24 * 3600),
+    ("exeris.core.actions.EventsRetentionProcess", actions.EventsRetentionProcess.SCHEDULER_RUNNING_INTERVAL),
+]
+
+
+def run_combat_scheduler():
+    with app.app_context():
+        scheduler.Scheduler(included_processes=COMBAT_PROCESSES).run()
+
+
 with app.app_context():
     db.create_all()
+    migrations.apply_migrations()
+    models.prepare_effective_properties()
 
-    if not models.ScheduledTask.query.count():
-        activity_task = models.ScheduledTask(["exeris.core.actions.WorkProcess", {}],
-                                             general.GameDate.now().game_timestamp, 5)
-        db.session.add(activity_task)
-        eating_task = models.ScheduledTask(["exeris.core.actions.EatingProcess", {}],
-                                           general.GameDate.now().game_timestamp, 3600)
-        db.session.add(eating_task)
-        animals_task = models.ScheduledTask(["exeris.core.actions.AnimalsProcess", {}],
-                                            general.GameDate.now().game_timestamp, 24 * 3600)
-        db.session.add(animals_task)
+    # every periodic process is seeded separately, so a process added later is also scheduled in existing databases
+    for process_name, execution_interval in PERIODIC_PROCESSES:
+        if not models.ScheduledTask.query.filter(models.ScheduledTask.process_name == process_name).first():
+            db.session.add(models.ScheduledTask([process_name, {}], general.GameDate.now().game_timestamp,
+                                                execution_interval))
+    db.session.commit()
 
-        db.session.commit()
+    # combat rounds are run in parallel by separate worker processes, which can't share the db connections
+    combat_workers_count = app.config["SCHEDULER_COMBAT_WORKERS"]
+    db.session.remove()
+    db.engine.dispose()
+    for _ in range(combat_workers_count):
+        multiprocessing.Process(target=run_combat_scheduler, daemon=True).start()
 
-    scheduler.Scheduler().run()
+    scheduler.Scheduler(excluded_processes=COMBAT_PROCESSES if combat_workers_count else None).run()
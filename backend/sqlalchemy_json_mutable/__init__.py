@@ -1,8 +1,10 @@
 from .mutable_types import JsonDict, NestedMutableDict, ShallowJsonDict, JsonList, ShallowJsonList
+from .partial_updates import enable_partial_updates
 
 __all__ = (
     'JsonDict',
     'JsonList',
     'ShallowJsonDict',
     'ShallowJsonList',
+    'enable_partial_updates',
 )
@@ -6,7 +6,63 @@ from . import tracked_impl
 
 
 class NestedMutableDict(tracked_impl.TrackedDict, mutable.MutableDict):
-    """SQLAlchemy `mutable` extension dictionary with nested change tracking."""
+    """SQLAlchemy `mutable` extension dictionary with nested change tracking.
+    Changes made by the listeners themselves (e.g. clamping of the changed value) don't notify the listeners again.
+
+    Paths of the changed values are recorded, so a few changes can be saved as a partial update (see `partial_updates`).
+    `None` instead of the set of paths means the whole value needs to be saved.
+    """
+
+    MAX_PARTIALLY_UPDATED_PATHS = 8
+
+    _notifying_listeners = False
+
+    def __init__(self, *args, **kwds):
+        super(NestedMutableDict, self).__init__(*args, **kwds)
+        self.changed_paths = set()
+
+    def path_changed(self, path=()):
+        if self.changed_paths is None:
+            return
+        if not path or len(self.changed_paths) >= self.MAX_PARTIALLY_UPDATED_PATHS:
+            self.changed_paths = None
+        else:
+            self.changed_paths.add(path)
+
+    def get_partial_changes(self):
+        """Returns a list of pairs (path, new value) which are enough to save all the changes
+        or None if the whole value needs to be saved."""
+        if not self.changed_paths:
+            return None
+        partial_changes = []
+        for path in sorted(self.changed_paths, key=len):
+            if any(path[:len(updated_path)] == updated_path for updated_path, _ in partial_changes):
+                continue  # already a part of the updated value
+            value = self
+            for key in path:
+                if not isinstance(value, dict) or key not in value:
+                    return None
+                value = dict.__getitem__(value, key)
+            partial_changes.append((path, value))
+        return partial_changes
+
+    def reset_changed_paths(self):
+        self.changed_paths = set()
+
+    @classmethod
+    def _listen_on_attribute(cls, attribute, coerce, parent_cls):
+        super(NestedMutableDict, cls)._listen_on_attribute(attribute, coerce, parent_cls)
+        if parent_cls is not attribute.class_:
+            return
+
+        def set_(target, value, oldvalue, initiator):
+            """A replaced value needs to be saved as a whole, unless it's just the loaded value being coerced."""
+            if isinstance(value, cls) and value is not oldvalue:
+                if isinstance(oldvalue, cls) or value != oldvalue:
+                    value.changed_paths = None
+            return value
+
+        sqlalchemy.event.listen(attribute, "set", set_, raw=True, retval=True, propagate=True)
 
     @classmethod
     def coerce(cls, key, value):
@@ -18,8 +74,13 @@ class NestedMutableDict(tracked_impl.TrackedDict, mutable.MutableDict):
         return super(NestedMutableDict, cls).coerce(key, value)
 
     def changed_event(self, *args):
-        for listener in self.listeners:
-            listener(self)
+        if not self._notifying_listeners:
+            self._notifying_listeners = True
+            try:
+                for listener in self.listeners:
+                    listener(self)
+            finally:
+                self._notifying_listeners = False
         self.changed()
 
 
@@ -0,0 +1,87 @@
+"""
+Saves a few changed paths of a NestedMutableDict value using jsonb_set instead of rewriting the whole document.
+
+When enabled for a session class, changes of the tracked dicts of persistent objects are written before the flush
+by UPDATE statements grouped by the set of changed paths, and the attribute is no longer flushed by the ORM.
+Values with too many changes, replaced values and removals of keys are saved as a whole, as usual.
+"""
+
+import collections
+
+import sqlalchemy
+import sqlalchemy.dialects.postgresql as psql
+from sqlalchemy.orm import attributes
+
+from . import mutable_types
+
+_tracked_dict_columns_by_mapper = {}
+
+
+def enable_partial_updates(session_class):
+    sqlalchemy.event.listen(session_class, "before_flush", _save_partial_changes)
+    sqlalchemy.event.listen(session_class, "after_flush", _reset_changed_paths)
+
+
+def _get_tracked_dict_columns(mapper):
+    """Returns a list of pairs (attribute name, column) for all the JsonDict columns of the mapped class"""
+    if mapper not in _tracked_dict_columns_by_mapper:
+        _tracked_dict_columns_by_mapper[mapper] = [(prop.key, prop.columns[0]) for prop in mapper.column_attrs
+                                                   if isinstance(prop.columns[0].type, mutable_types.JsonDict)]
+    return _tracked_dict_columns_by_mapper[mapper]
+
+
+def _save_partial_changes(session, flush_context, instances):
+    changes_by_column_and_paths = collections.defaultdict(list)
+    deleted_objects = session.deleted
+    for obj in session.dirty:
+        state = sqlalchemy.inspect(obj)
+        if state.key is None or obj in deleted_objects:
+            continue
+        for attribute_name, column in _get_tracked_dict_columns(state.mapper):
+            value = state.dict.get(attribute_name)
+            if attribute_name not in state.committed_state or not isinstance(value, mutable_types.NestedMutableDict):
+                continue
+            partial_changes = value.get_partial_changes()
+            if partial_changes is not None:
+                paths = tuple(path for path, _ in partial_changes)
+                changes_by_column_and_paths[(column, paths)].append((state, attribute_name, partial_changes))
+
+    for (column, paths), changes in changes_by_column_and_paths.items():
+        session.execute(_create_update_statement(column, paths),
+                        [_get_update_parameters(state, partial_changes)
+                         for state, _, partial_changes in changes],
+                        mapper=changes[0][0].mapper)
+        for state, attribute_name, _ in changes:
+            value = state.dict[attribute_name]
+            attributes.set_committed_value(state.obj(), attribute_name, value)  # it won't be saved again by the ORM
+            value.reset_changed_paths()
+
+
+def _create_update_statement(column, paths):
+    updated_value = column
+    for path_index, path in enumerate(paths):
+        updated_value = sqlalchemy.func.jsonb_set(updated_value,
+                                                  sqlalchemy.literal([str(key) for key in path],
+                                                                     psql.ARRAY(sqlalchemy.Text)),
+                                                  sqlalchemy.cast(
+                                                      sqlalchemy.bindparam("partial_value_{}".format(path_index),
+                                                                           type_=psql.JSONB), psql.JSONB))
+    primary_key_criteria = [pk_column == sqlalchemy.bindparam("partial_pk_{}".format(pk_index))
+                            for pk_index, pk_column in enumerate(column.table.primary_key.columns)]
+    return column.table.update().where(sqlalchemy.and_(*primary_key_criteria)).values({column.name: updated_value})
+
+
+def _get_update_parameters(state, partial_changes):
+    parameters = {"partial_pk_{}".format(pk_index): pk_value for pk_index, pk_value in enumerate(state.identity)}
+    parameters.update({"partial_value_{}".format(path_index): value
+                       for path_index, (_, value) in enumerate(partial_changes)})
+    return parameters
+
+
+def _reset_changed_paths(session, flush_context):
+    for obj in list(session.new) + list(session.dirty):
+        state = sqlalchemy.inspect(obj)
+        for attribute_name, _ in _get_tracked_dict_columns(state.mapper):
+            value = state.dict.get(attribute_name)
+            if isinstance(value, mutable_types.NestedMutableDict):
+                value.reset_changed_paths()
@@ -4,7 +4,9 @@ This module contains the tracked object classes.
 TrackedObject forms the basis for both the TrackedDict and the TrackedList.
 
 A function for automatic conversion of dicts and lists to their tracked
-counterparts is also included.
+counterparts is also included. Dicts nested in a TrackedDict are converted
+lazily, on the first access to them, so values which are only read or saved
+never pay for the conversion.
 """
 
 import inspect
@@ -21,11 +23,14 @@ logger = logging.getLogger(__name__)
 class TrackedObject(object):
     """A base class for delegated change-tracking.
     It's possible to register listeners for any change of this object by adding a function to the listeners' list.
-    The function should take a singl argument: reference to the tracked object."""
+    The function should take a singl argument: reference to the tracked object.
+    Besides the change notification, the path of the changed value is propagated up to the root object."""
     _type_mapping = {}
+    parent_key = None  # key of this object in the parent dict
 
     def __init__(self, *args, **kwds):
-        logger.debug('%s: __init__', self._repr())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s: __init__', self._repr())
         self.parent = None
         super(TrackedObject, self).__init__(*args, **kwds)
         self.listeners = []
@@ -38,12 +43,22 @@ class TrackedObject(object):
 
         The message (if provided) will be debug logged.
         """
-        if message is not None:
-            logger.debug('%s: %s', self._repr(), message % args)
-        logger.debug('%s: changed', self._repr())
+        if logger.isEnabledFor(logging.DEBUG):
+            if message is not None:
+                logger.debug('%s: %s', self._repr(), message % args)
+            logger.debug('%s: changed', self._repr())
         if self.parent is not None:
             self.parent.changed_event()
 
+    def path_changed(self, path=()):
+        """Propagates the path of the changed value (a tuple of dict keys relative to this object) to the root.
+
+        A change of anything inside of a list is treated as a change of the whole list.
+        """
+        if self.parent is not None:
+            parent_path = () if isinstance(self.parent, list) else (self.parent_key,) + path
+            self.parent.path_changed(parent_path)
+
     @classmethod
     def register(cls, origin_types):
         """Registers the class decorated with this method as a mutation tracker.
@@ -64,7 +79,7 @@ class TrackedObject(object):
         return decorator
 
     @classmethod
-    def convert(cls, obj, parent):
+    def convert(cls, obj, parent, key=None):
         """Converts objects to registered tracked types
 
         This checks the type of the given object against the registered tracked
@@ -74,13 +89,13 @@ class TrackedObject(object):
         If its type does not occur in the registered types mapping, the object
         is returned unchanged.
         """
-        obj_type = type(obj)
-        for origin_type, replacement in cls._type_mapping.items():
-            if obj_type is origin_type:
-                new = replacement(obj)
-                new.parent = parent
-                return new
-        return obj
+        replacement = cls._type_mapping.get(type(obj))
+        if replacement is None:
+            return obj
+        new = replacement(obj)
+        new.parent = parent
+        new.parent_key = key
+        return new
 
     @classmethod
     def convert_iterable(cls, iterable, parent):
@@ -90,7 +105,7 @@ class TrackedObject(object):
     @classmethod
     def convert_iteritems(cls, iteritems, parent):
         """Returns a generator like `convert_iterable` for 2-tuple iterators."""
-        return ((key, cls.convert(value, parent)) for key, value in iteritems)
+        return ((key, cls.convert(value, parent, key)) for key, value in iteritems)
 
     @classmethod
     def convert_mapping(cls, mapping, parent):
@@ -109,32 +124,86 @@ class TrackedObject(object):
 
 @TrackedObject.register(dict)
 class TrackedDict(TrackedObject, dict):
-    """A TrackedObject implementation of the basic dictionary."""
+    """A TrackedObject implementation of the basic dictionary.
+    Values are stored as they are and converted to tracked objects on the first access."""
+
+    _all_values_tracked = False
 
     def __init__(self, source=(), **kwds):
-        super(TrackedDict, self).__init__(itertools.chain(
-            self.convert_mapping(source, self),
-            self.convert_mapping(kwds, self)))
+        super(TrackedDict, self).__init__(source, **kwds)
+
+    def _tracked_value(self, key, value):
+        tracked_value = self.convert(value, self, key)
+        if tracked_value is not value:
+            dict.__setitem__(self, key, tracked_value)  # replacing the value with its tracked copy is not a change
+        return tracked_value
+
+    def _track_all_values(self):
+        if not self._all_values_tracked:
+            for key, value in dict.items(self):
+                self._tracked_value(key, value)
+            self._all_values_tracked = True
+
+    def __getitem__(self, key):
+        return self._tracked_value(key, super(TrackedDict, self).__getitem__(key))
+
+    def __iter__(self):
+        # overridden only to disable the fast path of dict.update(), dict() and {**...}, which read the stored values
+        # directly, so they use keys() and __getitem__ instead and the nested values they copy are tracked
+        return super(TrackedDict, self).__iter__()
+
+    def copy(self):
+        self._track_all_values()
+        return super(TrackedDict, self).copy()
+
+    def __or__(self, other):
+        self._track_all_values()
+        return super(TrackedDict, self).__or__(other)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def values(self):
+        self._track_all_values()
+        return super(TrackedDict, self).values()
+
+    def items(self):
+        self._track_all_values()
+        return super(TrackedDict, self).items()
 
     def __setitem__(self, key, value):
-        super(TrackedDict, self).__setitem__(key, self.convert(value, self))
+        super(TrackedDict, self).__setitem__(key, self.convert(value, self, key))
+        self.path_changed((key,))
         self.changed_event('__setitem__: %r=%r', key, value)
 
+    # removal of a key is a change of the whole dict containing it
+
     def __delitem__(self, key):
         super(TrackedDict, self).__delitem__(key)
+        self.path_changed()
         self.changed_event('__delitem__: %r', key)
 
     def clear(self):
         super(TrackedDict, self).clear()
+        self.path_changed()
         self.changed_event('clear')
 
     def pop(self, *key_and_default):
         value = super(TrackedDict, self).pop(*key_and_default)
+        self.path_changed()
         self.changed_event('pop: %r', key_and_default)
         return value
 
     def popitem(self):
         value = super(TrackedDict, self).popitem()
+        self.path_changed()
         self.changed_event('popitem')
         return value
 
@@ -142,8 +211,13 @@ class TrackedDict(TrackedObject, dict):
         super(TrackedDict, self).update(itertools.chain(
             self.convert_mapping(source, self),
             self.convert_mapping(kwds, self)))
+        self.path_changed()
         self.changed_event('update(%r, %r)', source, kwds)
 
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
     def __copy__(self):
         result = self.__class__()
         result.__dict__.update(self.__dict__)
@@ -152,46 +226,54 @@ class TrackedDict(TrackedObject, dict):
     def __deepcopy__(self, memo):
         result = self.__class__()
         memo[id(self)] = result
-        for k, v in self.items():  # keys are immutable, so needn't be copied
-            result[k] = copy.deepcopy(v, memo)
+        for k, v in dict.items(self):  # keys are immutable, so needn't be copied
+            dict.__setitem__(result, k, copy.deepcopy(v, memo))  # the copy is tracked lazily as well
         return result
 
 
 @TrackedObject.register(list)
 class TrackedList(TrackedObject, list):
-    """A TrackedObject implementation of the basic list."""
+    """A TrackedObject implementation of the basic list.
+    Lists are always changed as a whole, so their items don't need to know their index."""
 
     def __init__(self, iterable=()):
         super(TrackedList, self).__init__(self.convert_iterable(iterable, self))
 
     def __setitem__(self, key, value):
         super(TrackedList, self).__setitem__(key, self.convert(value, self))
+        self.path_changed()
         self.changed_event('__setitem__: %r=%r', key, value)
 
     def __delitem__(self, key):
         super(TrackedList, self).__delitem__(key)
+        self.path_changed()
         self.changed_event('__delitem__: %r', key)
 
     def __iadd__(self, iterable):
         super(TrackedList, self).extend(self.convert_iterable(iterable, self))
+        self.path_changed()
         self.changed_event('__iadd__: %r', iterable)
         return self
 
     def append(self, item):
         super(TrackedList, self).append(self.convert(item, self))
+        self.path_changed()
         self.changed_event('append: %r', item)
 
     def extend(self, iterable):
         super(TrackedList, self).extend(self.convert_iterable(iterable, self))
+        self.path_changed()
         self.changed_event('extend: %r', iterable)
 
     def pop(self, index=None):
         value = super(TrackedList, self).pop(index)
+        self.path_changed()
         self.changed_event('pop: %d', index)
         return value
 
     def sort(self, cmp=None, key=None, reverse=False):
         super(TrackedList, self).sort(cmp=cmp, key=key, reverse=reverse)
+        self.path_changed()
         self.changed_event('sort')
 
     def __copy__(self):
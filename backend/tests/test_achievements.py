@@ -1,11 +1,14 @@
+from unittest.mock import patch
+
 from flask_testing import TestCase
 from shapely.geometry import Point
 
 # noinspection PyUnresolvedReferences
 import exeris.core.achievements
-from exeris.core.actions import SayAloudAction
+from exeris.core.achievements import ProgressBuffer, UnlockedAchievementsCache
+from exeris.core.actions import SayAloudAction, WhisperToSomebodyAction
 from exeris.core.main import db
-from exeris.core.models import RootLocation, Achievement
+from exeris.core.models import RootLocation, Achievement, AchievementCharacterProgress, Notification
 from tests import util
 
 
@@ -34,3 +37,76 @@ class PassageTest(TestCase):
 
         # now there should be achievement
         Achievement.query.filter_by(achiever=player, achievement="speaker").one()
+
+    def test_progress_saved_right_after_single_action(self):
+        util.initialize_date()
+
+        rl = RootLocation(Point(1, 1), 123)
+        player = util.create_player("elo")
+        char = util.create_character("jan", rl, player)
+        listener = util.create_character("listener", rl, player)
+
+        db.session.add_all([rl])
+
+        SayAloudAction(char, "Hej").perform()
+
+        spoken_progress = AchievementCharacterProgress.query.filter_by(
+            name=exeris.core.achievements.AchievementEntries.TEXTS_SPOKEN, character=char).one()
+        self.assertEqual(1, spoken_progress.details)
+
+        db.session.begin_nested()
+        WhisperToSomebodyAction(char, listener, "psst").perform()
+        db.session.commit()  # the events are already flushed, but the progress is saved by the commit
+        self.assertNotIn(ProgressBuffer.SESSION_KEY, db.session.info)
+
+        whispers_progress = AchievementCharacterProgress.query.filter_by(
+            name=exeris.core.achievements.AchievementEntries.WHISPERS, character=char).one()
+        self.assertEqual([listener.id], whispers_progress.details)
+
+    def test_unlocked_achievements_cached_only_after_root_transaction_commit(self):
+        with patch.object(exeris.core.achievements.unlocked_achievements, "commit") as commit_mock:
+            db.session.begin_nested()
+            db.session.commit()
+        commit_mock.assert_not_called()
+
+    def test_unlocked_achievements_cache_size_limited(self):
+        util.initialize_date()
+
+        players = [util.create_player("player" + str(i)) for i in range(3)]
+        db.session.flush()
+
+        cache = UnlockedAchievementsCache()
+        with patch.object(UnlockedAchievementsCache, "MAX_CACHED_PLAYERS", 2):
+            for player in players + [players[1]]:
+                cache.is_unlocked(db.session, player, "speaker")
+
+        self.assertEqual([players[2].id, players[1].id], list(cache._achievements_by_player_id.keys()))
+
+    def test_getting_whisperer_achievement_once_from_buffered_progress(self):
+        util.initialize_date()
+
+        rl = RootLocation(Point(1, 1), 123)
+        player = util.create_player("elo")
+        char = util.create_character("jan", rl, player)
+        listeners = [util.create_character("listener" + str(i), rl, player) for i in range(3)]
+
+        db.session.add_all([rl])
+
+        for i in range(2):
+            for listener in listeners:
+                WhisperToSomebodyAction(char, listener, "psst").perform()
+        db.session.flush()
+
+        whispers_progress = AchievementCharacterProgress.query.filter_by(
+            name=exeris.core.achievements.AchievementEntries.WHISPERS, character=char).one()
+        self.assertCountEqual([listener.id for listener in listeners], whispers_progress.details)
+
+        Achievement.query.filter_by(achiever=player, achievement="whisperer").one()
+        notification = Notification.query.filter_by(player=player, title_tag="achievement_unlocked").one()
+        self.assertIsNotNone(notification.get_option("notification.close"))
+
+        # whispering again to the same people doesn't unlock anything new
+        WhisperToSomebodyAction(char, listeners[0], "psst").perform()
+        db.session.flush()
+        self.assertEqual(1, Achievement.query.filter_by(achiever=player, achievement="whisperer").count())
+        self.assertEqual(1, Notification.query.filter_by(player=player, title_tag="achievement_unlocked").count())
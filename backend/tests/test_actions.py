@@ -88,6 +88,34 @@ class ActionsSerializationTest(TestCase):
             ]}, serialized[1])
 
 
+    def test_compiled_action_is_resolved_once(self):
+        compiled_action = deferred.get_compiled("exeris.core.actions.RemoveItemAction")
+
+        self.assertIs(RemoveItemAction, compiled_action.callable)
+        self.assertEqual({"item": Item}, compiled_action.argument_types)
+        self.assertIs(compiled_action, deferred.get_compiled("exeris.core.actions.RemoveItemAction"))
+
+    def test_preload_entities_of_serialized_actions(self):
+        hammer_type = ItemType("hammer", 30)
+        rl = RootLocation(Point(1, 1), 35)
+        hammer = Item(hammer_type, rl)
+        other_hammer = Item(hammer_type, rl)
+        db.session.add_all([hammer_type, rl, hammer, other_hammer])
+        db.session.flush()
+
+        serialized_actions = [deferred.serialize(RemoveItemAction(hammer)),
+                              deferred.serialize(RemoveItemAction(other_hammer, False))]
+        db.session.expunge_all()
+
+        loaded_instances = deferred.preload_entities(serialized_actions)
+        self.assertCountEqual([hammer.id, other_hammer.id], [instance.id for instance in loaded_instances])
+
+        # deserialization takes entities loaded by preload_entities from the identity map
+        deserialized_actions = [deferred.call(serialized_action) for serialized_action in serialized_actions]
+        self.assertIs(next(instance for instance in loaded_instances if instance.id == hammer.id),
+                      deserialized_actions[0].item)
+
+
 class FinishActivityActionsTest(TestCase):
     create_app = util.set_up_app_with_database
     tearDown = util.tear_down_rollback
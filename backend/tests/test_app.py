@@ -41,4 +41,14 @@ class EncoderTest(TestCase):
             enc = main.encode(val)
             self.assertRaises(ValueError, main.decode, str(int(enc) + 1))
 
+    def test_codec_many(self):
+        g.character = self.character1
+        encoded = main.encode_many(list(self.values))
+        self.assertEqual([main.encode(val) for val in self.values], encoded)
+        self.assertEqual(list(self.values), main.decode_many(encoded))
+        self.assertEqual([], main.encode_many([]))
+
+        encoded[3] = str(int(encoded[3]) + 1)
+        self.assertRaises(ValueError, main.decode_many, encoded)
+
     tearDown = util.tear_down_rollback
@@ -1,9 +1,9 @@
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, ANY
 
 from flask_testing import TestCase
 from shapely.geometry import Point, Polygon
 
-from exeris.core import main, combat, deferred, models, properties
+from exeris.core import main, combat, deferred, models, properties, general
 from exeris.core.actions import FightInCombatAction, CombatProcess, AttackEntityAction, JoinCombatAction, \
     ChangeCombatStanceAction
 from exeris.core.main import db
@@ -176,8 +176,14 @@ class CombatTest(TestCase):
         with patch("exeris.core.actions.FightInCombatAction.calculate_hit_damage", new=lambda x, y: 0.1):
             task_mock = TaskMock()
             task_mock.stop_repeating = MagicMock()
+            resolved_rounds = combat.round_timings.rounds
             combat_process = CombatProcess(combat_entity, task_mock)
-            combat_process.perform()
+            with patch("exeris.core.main.call_hook", wraps=main.call_hook) as call_hook_mock:
+                combat_process.perform()
+            self.assertEqual(resolved_rounds + 1, combat.round_timings.rounds)
+            self.assertIsNotNone(combat.round_timings.stats()["last_time"])
+            call_hook_mock.assert_any_call(main.Hooks.COMBAT_ROUND_RESOLVED, combat_entity=combat_entity,
+                                           fighters_count=3, duration=ANY)
 
             # test if gaul is hit twice, each for 0.1
             self.assertAlmostEqual(0.2, gaul1.damage)
@@ -211,6 +217,48 @@ class CombatTest(TestCase):
             self.assertEqual([], Intent.query.all())
             self.assertEqual(0, Combat.query.count())
 
+    def test_combat_round_checks_range_once_per_pair_of_positions(self):
+        util.initialize_date()
+        rl = RootLocation(Point(1, 1), 100)
+
+        roman1 = util.create_character("roman1", rl, util.create_player("abc1"))
+        roman2 = util.create_character("roman2", rl, util.create_player("abc12"))
+        gaul1 = util.create_character("gaul1", rl, util.create_player("abc21"))
+        gaul2 = util.create_character("gaul2", rl, util.create_player("abc22"))
+
+        combat_entity = Combat()
+        db.session.add_all([rl, combat_entity])
+        db.session.flush()
+
+        ROMAN_SIDE, GAUL_SIDE = combat.SIDE_ATTACKER, combat.SIDE_DEFENDER
+        for fighter, side in [(roman1, ROMAN_SIDE), (roman2, ROMAN_SIDE), (gaul1, GAUL_SIDE), (gaul2, GAUL_SIDE)]:
+            db.session.add(Intent(fighter, main.Intents.COMBAT, 1, combat_entity,
+                                  deferred.serialize(FightInCombatAction(fighter, combat_entity, side,
+                                                                         combat.STANCE_OFFENSIVE))))
+        db.session.flush()
+
+        is_near_calls = []
+        original_is_near = general.VisibilityBasedRange.is_near
+
+        def is_near_counting_calls(rng, entity_a, entity_b):
+            is_near_calls.append((entity_a, entity_b))
+            return original_is_near(rng, entity_a, entity_b)
+
+        with patch("exeris.core.general.VisibilityBasedRange.is_near", new=is_near_counting_calls):
+            combat_round = combat.CombatRound(combat_entity, combat_entity.fighters_intents())
+
+            roman1_foes = combat.get_combat_actions_of_visible_foes(roman1, combat_entity, combat_round)
+            self.assertCountEqual([gaul1, gaul2], [foe_action.executor for foe_action in roman1_foes])
+            gaul2_foes = combat.get_combat_actions_of_visible_foes(gaul2, combat_entity, combat_round)
+            self.assertCountEqual([roman1, roman2], [foe_action.executor for foe_action in gaul2_foes])
+
+            # everyone stands in the same location
+            self.assertEqual(1, len(is_near_calls))
+
+            combat_round.remove_fighter(gaul1)
+            roman1_foes = combat.get_combat_actions_of_visible_foes(roman1, combat_entity, combat_round)
+            self.assertEqual([gaul2], [foe_action.executor for foe_action in roman1_foes])
+
     def test_combat_process_for_animals(self):
         util.initialize_date()
         rl = RootLocation(Point(1, 1), 100)
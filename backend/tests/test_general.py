@@ -5,12 +5,12 @@ from flask_testing import TestCase
 from shapely.geometry import Point, Polygon
 
 from exeris.core import models, map_data
-from exeris.core.main import db, Types
+from exeris.core.main import db, Types, Hooks
 from exeris.core.general import GameDate, SameLocationRange, NeighbouringLocationsRange, VisibilityBasedRange, \
-    EventCreator, TraversabilityBasedRange, RangeSpec, Identifiers
+    EventCreator, TraversabilityBasedRange, RangeSpec, Identifiers, LocationGraph
 from exeris.core.models import GameDateCheckpoint, RootLocation, Location, Item, ItemType, Passage, EntityProperty, \
     EventType, EventObserver, LocationType, PassageType, TerrainType, TerrainArea, PropertyArea, TypeGroup, \
-    UniqueIdentifier
+    UniqueIdentifier, EntitySnapshot, Event
 from exeris.core.properties import P
 from tests import util
 
@@ -348,6 +348,50 @@ class RangeSpecTest(TestCase):
         self.assertEqual([loc1, loc2, loc3, loc4, loc5], RangeSpec.get_path_between_locations(loc1, loc5))
 
 
+class LocationGraphTest(TestCase):
+    create_app = util.set_up_app_with_database
+    tearDown = util.tear_down_rollback
+
+    def _create_closed_building(self):
+        building_type = LocationType("building", 100)
+        rl = RootLocation(Point(1, 1), 32)
+        building = Location(rl, building_type)
+        db.session.add_all([building_type, rl, building])
+
+        passage = Passage.query.filter(Passage.between(rl, building)).one()
+        passage.properties.append(EntityProperty(P.CLOSEABLE, {"closed": True}))
+        db.session.flush()
+        return rl, passage
+
+    def test_location_graph_discarded_when_changes_are_flushed(self):
+        rl, passage = self._create_closed_building()
+
+        location_graph = LocationGraph.for_session()
+        self.assertEqual([], location_graph.get_accessible_passages_to_neighbours(rl))
+
+        passage.alter_property(P.CLOSEABLE, {"closed": False})
+        db.session.flush()  # the change is no longer pending, so it can't be noticed later
+
+        location_graph = LocationGraph.for_session()
+        self.assertEqual([passage], [directed_passage.passage for directed_passage
+                                     in location_graph.get_accessible_passages_to_neighbours(rl)])
+
+    def test_location_graph_discarded_after_bulk_update_and_rollback(self):
+        rl, passage = self._create_closed_building()
+
+        location_graph = LocationGraph.for_session()
+        location_graph.load([rl])
+
+        EntityProperty.query.filter_by(entity_id=passage.id, name=P.CLOSEABLE) \
+            .update({EntityProperty.data: {"closed": False}}, synchronize_session=False)
+        self.assertIsNot(location_graph, LocationGraph.for_session())
+
+        db.session.begin_nested()
+        location_graph = LocationGraph.for_session()
+        db.session.rollback()
+        self.assertIsNot(location_graph, LocationGraph.for_session())
+
+
 class EventCreatorTest(TestCase):
     create_app = util.set_up_app_with_database
     tearDown = util.tear_down_rollback
@@ -440,11 +484,149 @@ class EventCreatorTest(TestCase):
         observer_in_root_loc_count = EventObserver.query.filter_by(observer=observer_in_root_loc).count()
         self.assertEqual(0, observer_in_root_loc_count)
 
+    def test_entities_in_event_groups_stored_once(self):
+        util.initialize_date()
+
+        et1 = EventType("slap_doer", EventType.IMPORTANT)
+        et2 = EventType("slap_target", EventType.IMPORTANT)
+        et3 = EventType("slap_observer", EventType.NORMAL)
+        db.session.add_all([et1, et2, et3])
+
+        rl = RootLocation(Point(10, 10), 103)
+        plr = util.create_player("plr1")
+        doer = util.create_character("doer", rl, plr)
+        target = util.create_character("target", rl, plr)
+        observer = util.create_character("observer", rl, plr)
+        db.session.add(rl)
+        db.session.flush()
+
+        EventCreator.base("slap", doer=doer, target=target, rng=SameLocationRange())
+
+        self.assertEqual(2, EntitySnapshot.query.count())  # doer and target
+
+        event_obs = EventObserver.query.filter_by(observer=observer).one()
+        doer_reference = event_obs.event.compact_params["groups"]["doer"]
+        self.assertEqual({EntitySnapshot.REFERENCE_KEY: EntitySnapshot.get_hash(doer.pyslatize())}, doer_reference)
+        event_target = EventObserver.query.filter_by(observer=target).one()
+        self.assertEqual(doer_reference, event_target.event.compact_params["groups"]["doer"])
+
+        self.assertEqual({"groups": {
+            "doer": doer.pyslatize(),
+            "target": target.pyslatize()
+        }}, event_obs.event.params)
+
+    def test_entity_snapshots_removed_when_no_longer_referenced(self):
+        util.initialize_date()
+
+        event_type = EventType("slap_observer", EventType.NORMAL)
+        db.session.add(event_type)
+        doer_data = {"entity_type": Types.ALIVE_CHARACTER, "name": "doer"}
+
+        first_event = Event(event_type, {"groups": {"doer": doer_data}})
+        second_event = Event(event_type, {"groups": {"doer": doer_data, "target": doer_data}})
+        db.session.add_all([first_event, second_event])
+        db.session.flush()
+
+        doer_hash = EntitySnapshot.get_hash(doer_data)
+        self.assertEqual({doer_hash: 2}, EntitySnapshot.count_references([doer_hash]))
+
+        db.session.delete(second_event)
+        EntitySnapshot.remove_unreferenced([doer_hash])
+        self.assertEqual({doer_hash: 1}, EntitySnapshot.count_references([doer_hash]))
+        self.assertIsNotNone(EntitySnapshot.query.get(doer_hash))
+
+        db.session.delete(first_event)
+        EntitySnapshot.remove_unreferenced([doer_hash])
+        db.session.expire_all()
+        self.assertIsNone(EntitySnapshot.query.get(doer_hash))
+
+    def test_entity_snapshot_saved_only_when_referenced_by_event(self):
+        util.initialize_date()
+
+        db.session.add(EventType("slap_doer", EventType.IMPORTANT))
+
+        rl = RootLocation(Point(10, 10), 103)
+        plr = util.create_player("plr1")
+        doer = util.create_character("doer", rl, plr)
+        target = util.create_character("target", rl, plr)
+        db.session.add(rl)
+        db.session.flush()
+
+        EventCreator.create(tag_doer="slap_doer", doer=doer, target=target)
+
+        target_hash = EntitySnapshot.get_hash(target.pyslatize())
+        self.assertEqual([target_hash], [snapshot.hash for snapshot in EntitySnapshot.query.all()])
+        self.assertEqual({target_hash: 1}, EntitySnapshot.count_references([target_hash]))
+
+    def test_missing_entity_snapshot_skipped_when_resolving_params(self):
+        util.initialize_date()
+
+        event_type = EventType("slap_observer", EventType.NORMAL)
+        db.session.add(event_type)
+        doer_data = {"entity_type": Types.ALIVE_CHARACTER, "name": "doer"}
+        event = Event(event_type, {"groups": {"doer": doer_data}})
+        event.compact_params = {"message": "hi", "groups": {
+            "doer": event.compact_params["groups"]["doer"],
+            "target": {EntitySnapshot.REFERENCE_KEY: "no-such-hash"},
+        }}
+
+        self.assertEqual({"message": "hi", "groups": {"doer": doer_data}}, event.params)
+
+    def test_params_of_many_events_resolved_in_single_query(self):
+        util.initialize_date()
+
+        event_type = EventType("slap_observer", EventType.NORMAL)
+        db.session.add(event_type)
+        events = [Event(event_type, {"groups": {"doer": {"entity_type": Types.ALIVE_CHARACTER, "name": str(i)}}})
+                  for i in range(3)]
+        db.session.add_all(events)
+        db.session.flush()
+        db.session.expire_all()
+
+        with patch.object(EntitySnapshot, "resolve_groups_of_many",
+                          wraps=EntitySnapshot.resolve_groups_of_many) as resolve_mock:
+            Event.resolve_params_of_events(events)
+            for i, event in enumerate(events):
+                self.assertEqual({"groups": {"doer": {"entity_type": Types.ALIVE_CHARACTER, "name": str(i)}}},
+                                 event.params)
+                self.assertIs(event.params, event.params)  # memoized
+
+        resolve_mock.assert_called_once()
+
+    def test_new_events_hook_called_once_for_all_observers(self):
+        util.initialize_date()
+
+        et1 = EventType("slap_doer", EventType.IMPORTANT)
+        et2 = EventType("slap_target", EventType.IMPORTANT)
+        et3 = EventType("slap_observer", EventType.NORMAL)
+        db.session.add_all([et1, et2, et3])
+
+        rl = RootLocation(Point(10, 10), 103)
+        plr = util.create_player("plr1")
+        doer = util.create_character("doer", rl, plr)
+        target = util.create_character("target", rl, plr)
+        observers = [util.create_character("observer" + str(i), rl, plr) for i in range(5)]
+        db.session.add(rl)
+
+        with patch("exeris.core.main.call_hook") as call_hook_mock:
+            EventCreator.base("slap", doer=doer, target=target, rng=SameLocationRange())
+
+        call_hook_mock.assert_called_once()
+        self.assertEqual(Hooks.NEW_EVENTS, call_hook_mock.call_args[0][0])
+        event_observers = call_hook_mock.call_args[1]["event_observers"]
+        self.assertCountEqual([doer, target] + observers, [event_obs.observer for event_obs in event_observers])
+        self.assertTrue(all(event_obs.event.id is not None for event_obs in event_observers))
+
 
 class IdentifiersTest(TestCase):
     create_app = util.set_up_app_with_database
     tearDown = util.tear_down_rollback
 
+    def setUp(self):
+        # sequences are not transactional, so values allocated by other tests are not rolled back
+        db.session.execute("SELECT setval('unique_identifier_sequence', 1, false)")
+        self.addCleanup(setattr, Identifiers, "MIN_LENGTH", Identifiers.MIN_LENGTH)
+
     def test_unique_identifier_property(self):
         identifiers = []
         for letter in string.ascii_uppercase:
@@ -455,3 +637,20 @@ class IdentifiersTest(TestCase):
         Identifiers.MIN_LENGTH = 1
         unique_id = Identifiers.generate_unique_identifier()
         self.assertEqual(2, len(unique_id))
+
+    def test_identifiers_are_unique_and_encoded_bijectively(self):
+        identifiers = [Identifiers.generate_unique_identifier() for _ in range(100)]
+        self.assertEqual(100, len(set(identifiers)))
+        self.assertTrue(all(identifier.isalpha() and identifier.isupper() for identifier in identifiers))
+
+        Identifiers.MIN_LENGTH = 2
+        encoded_identifiers = [Identifiers.encode(number) for number in range(26 ** 2 + 26 ** 3)]
+        self.assertEqual(26 ** 2 + 26 ** 3, len(set(encoded_identifiers)))
+        self.assertTrue(all(len(identifier) == 2 for identifier in encoded_identifiers[:26 ** 2]))
+        self.assertTrue(all(len(identifier) == 3 for identifier in encoded_identifiers[26 ** 2:]))
+
+    def test_used_identifier_skipped(self):
+        db.session.add(UniqueIdentifier(Identifiers.encode(0), 0, "PLACEHOLDER"))
+
+        self.assertEqual(Identifiers.encode(1), Identifiers.generate_unique_identifier())
+        self.assertEqual(Identifiers.encode(2), Identifiers.generate_unique_identifier())
@@ -1,17 +1,18 @@
 import sqlalchemy
+from flask_sqlalchemy import get_debug_queries
 from flask_testing import TestCase
 from geoalchemy2.shape import from_shape
 from shapely.geometry import Point
 
-from exeris.core import actions, properties_base, main
+from exeris.core import actions, properties_base, main, deferred, models, migrations
 from exeris.core.general import GameDate
 from exeris.core.main import db, Types
 from exeris.core.map_data import MAP_HEIGHT, MAP_WIDTH
 from exeris.core.models import RootLocation, Location, Item, EntityProperty, EntityTypeProperty, \
     ItemType, Passage, TypeGroup, TypeGroupElement, EntityRecipe, BuildMenuCategory, LocationType, Character, \
-    Entity, Activity, SkillType, PassageType
+    Entity, Activity, SkillType, PassageType, Intent
 from exeris.core.properties_base import P
-from exeris.core.recipes import ActivityFactory, RecipeListProducer
+from exeris.core.recipes import ActivityFactory, RecipeListProducer, RecipeIndex, RecipeIndexCache
 from tests import util
 
 
@@ -203,6 +204,129 @@ class EntityTest(TestCase):
         Item.query.filter(Item.has_property("Happy", feel="blue")).filter(Item.role == Entity.ROLE_BEING_IN).one()
         Item.query.filter(Item.has_property("Sad", value=0.0)).filter(Item.role == Entity.ROLE_BEING_IN).one()
 
+    def test_damage_and_hunger_are_queried_using_expression_indexes(self):
+        rl = RootLocation(Point(1, 2), 31)
+        item_type = ItemType("hammer", 1)
+        damaged_item = Item(item_type, rl, weight=100)
+        damaged_item.damage = 1.0
+        item = Item(item_type, rl, weight=100)
+        starving_character = util.create_character("John", rl, util.create_player("AAA"))
+        starving_character.hunger = 1.0
+        util.create_character("Mary", rl, util.create_player("BBB"))
+        db.session.add_all([rl, item_type, damaged_item, item])
+        db.session.flush()
+
+        self.assertEqual(damaged_item, Item.query.filter(Item.damage == 1.0).one())
+        self.assertEqual(starving_character, Character.query.filter(Character.hunger == 1.0).one())
+
+        db.session.execute("SET LOCAL enable_seqscan = off")  # tables are too small to be worth an index otherwise
+        self.assertIn("entities_states_damage_idx", util.get_query_plan(Item.query.filter(Item.damage == 1.0)))
+        self.assertIn("entities_states_hunger_idx",
+                      util.get_query_plan(Character.query.filter(Character.hunger == 1.0)))
+
+    def test_effective_properties_are_used_when_enabled(self):
+        rl = RootLocation(Point(1, 2), 31)
+        item_type = ItemType("hammer", 1)
+        type_property = EntityTypeProperty(P.EDIBLE, {"yummy": False, "level": 1})
+        item_type.properties.append(type_property)
+        item = Item(item_type, rl, weight=100)
+        other_item = Item(item_type, rl, weight=100)
+        item_property = EntityProperty(P.EDIBLE, {"level": 5})
+        item.properties.append(item_property)
+        db.session.add_all([rl, item_type, item, other_item])
+        db.session.flush()
+        self.assertIsNone(item.effective_properties)  # not computed when disabled
+
+        main.use_effective_properties = True
+        try:
+            models.fill_missing_effective_properties()
+            self.assertEqual({P.EDIBLE: {"yummy": False, "level": 5}}, item.effective_properties)
+            self.assertEqual({"yummy": False, "level": 5}, item.get_property(P.EDIBLE))
+
+            self.assertEqual(item, Item.query.filter(Item.has_property(P.EDIBLE, level=5)).one())
+            self.assertEqual(2, Item.query.filter(Item.has_property(P.EDIBLE, yummy=False)).count())
+
+            type_property.data["yummy"] = True  # change of type property affects all the items of the type
+            self.assertEqual(2, Item.query.filter(Item.has_property(P.EDIBLE, yummy=True)).count())
+
+            item_property.data = {"level": 7}
+            self.assertEqual({"yummy": True, "level": 7}, item.get_property(P.EDIBLE))
+            self.assertIn(item_property, db.session.dirty)  # computed without flushing the session
+
+            db.session.delete(item_property)
+            self.assertEqual({"yummy": True, "level": 1}, item.get_property(P.EDIBLE))
+            self.assertEqual(2, Item.query.filter(Item.has_property(P.EDIBLE, level=1)).count())
+        finally:
+            main.use_effective_properties = False
+
+    def test_effective_properties_discarded_after_type_property_change_and_recomputed_lazily(self):
+        rl = RootLocation(Point(1, 2), 31)
+        item_type = ItemType("hammer", 1)
+        type_property = EntityTypeProperty(P.EDIBLE, {"level": 1})
+        item_type.properties.append(type_property)
+        item = Item(item_type, rl, weight=100)
+        db.session.add_all([rl, item_type, item])
+        db.session.flush()
+
+        main.use_effective_properties = True
+        try:
+            models.fill_missing_effective_properties()
+            self.assertEqual({P.EDIBLE: {"level": 1}}, item.effective_properties)
+
+            type_property.data = {"level": 3}
+            db.session.flush()
+            self.assertIsNone(item.effective_properties)  # discarded by a bulk update, the items are not loaded
+            self.assertEqual(item, Item.query.filter(Item.has_property(P.EDIBLE, level=3)).one())
+
+            self.assertEqual({"level": 3}, item.get_property(P.EDIBLE))
+            self.assertEqual({P.EDIBLE: {"level": 3}}, item.effective_properties)  # recomputed when needed
+        finally:
+            main.use_effective_properties = False
+
+    def test_effective_properties_not_maintained_when_disabled(self):
+        rl = RootLocation(Point(1, 2), 31)
+        item_type = ItemType("hammer", 1)
+        type_property = EntityTypeProperty(P.EDIBLE, {"level": 1})
+        item_type.properties.append(type_property)
+        item = Item(item_type, rl, weight=100)
+        db.session.add_all([rl, item_type, item])
+        db.session.flush()
+
+        main.use_effective_properties = True
+        try:
+            models.fill_missing_effective_properties()
+        finally:
+            main.use_effective_properties = False
+        self.assertEqual({P.EDIBLE: {"level": 1}}, item.effective_properties)
+
+        type_property.data = {"level": 3}
+        db.session.flush()
+        self.assertEqual({P.EDIBLE: {"level": 1}}, item.effective_properties)  # outdated
+
+        models.prepare_effective_properties()  # so they are discarded on startup
+        db.session.expire_all()
+        self.assertIsNone(item.effective_properties)
+
+    def test_has_property_expression_uses_indexes_of_property_tables(self):
+        rl = RootLocation(Point(1, 2), 31)
+        item_type = ItemType("hammer", 1)
+        item = Item(item_type, rl, weight=100)
+        item.properties.append(EntityProperty(P.EDIBLE, {"yummy": True}))
+        item_type.properties.append(EntityTypeProperty(P.SKILLS, {"crafting": 5}))
+        db.session.add_all([rl, item_type, item])
+        db.session.flush()
+
+        db.session.execute("SET LOCAL enable_seqscan = off")  # tables are too small to be worth an index otherwise
+
+        for property_filter in [Item.has_property(P.EDIBLE), Item.has_property(P.EDIBLE, yummy=True),
+                                ~Item.has_property(P.SKILLS, crafting=5)]:
+            query_plan = util.get_query_plan(Item.query.filter(property_filter))
+            self.assertNotIn("Seq Scan on entity_properties", query_plan)
+            self.assertNotIn("Seq Scan on entity_type_properties", query_plan)
+
+        query_plan = util.get_query_plan(ItemType.query.filter(ItemType.has_property(P.SKILLS, crafting=5)))
+        self.assertNotIn("Seq Scan on entity_type_properties", query_plan)
+
     def test_entity_and_entity_type_has_property_expression(self):
         rl = RootLocation(Point(1, 2), 31)
         item_type = ItemType("hammer", 1)
@@ -728,6 +852,38 @@ class GroupTest(TestCase):
         selectable_entities = factory.get_selectable_entities(recipe, initiator)
         self.assertCountEqual([anvil1, anvil2], selectable_entities)
 
+    def test_selectable_entities_of_different_classes_are_found_using_single_query(self):
+        building_type = LocationType("building", 100)
+        anvil_type = ItemType("anvil", 100, portable=False)
+        rl = RootLocation(Point(1, 1), 32)
+        open_building = Location(rl, building_type)
+        closed_building = Location(rl, building_type)
+        db.session.add_all([building_type, anvil_type, rl, open_building, closed_building])
+
+        closed_passage = Passage.query.filter(Passage.between(rl, closed_building)).one()
+        closed_passage.properties.append(EntityProperty(P.CLOSEABLE, {"closed": True}))
+        open_passage = Passage.query.filter(Passage.between(rl, open_building)).one()
+
+        anvil = Item(anvil_type, rl)
+        anvil_in_closed_building = Item(anvil_type, closed_building)
+        initiator = util.create_character("John", rl, util.create_player("AAA"))
+        tools_category = BuildMenuCategory("tools")
+        db.session.add_all([anvil, anvil_in_closed_building, tools_category])
+
+        recipe = EntityRecipe("project_anything", {}, {}, 11, tools_category,
+                              activity_container=["selected_entity",
+                                                  {"types": ["anvil", "building", Types.DOOR]}])
+        db.session.add(recipe)
+
+        selectable_entities = ActivityFactory.get_selectable_entities(recipe, initiator)
+        self.assertEqual([anvil, open_building, open_passage], selectable_entities)
+
+        # opening the door is noticed by the location graph cached in the session
+        closed_passage.alter_property(P.CLOSEABLE, {"closed": False})
+        selectable_entities = ActivityFactory.get_selectable_entities(recipe, initiator)
+        self.assertCountEqual([anvil, open_building, closed_building, open_passage, closed_passage],
+                              selectable_entities)
+
     def test_get_recipes_list(self):
         rl = RootLocation(Point(1, 1), 32)
         initiator = util.create_character("John", rl, util.create_player("AAA"))
@@ -755,6 +911,77 @@ class GroupTest(TestCase):
 
         self.assertEqual([available_recipe], recipe_list_producer.get_recipe_list())
 
+    def test_get_recipes_list_using_recipe_index(self):
+        rl = RootLocation(Point(1, 1), 32)
+        initiator = util.create_character("John", rl, util.create_player("AAA"))
+
+        stone_type = ItemType("stone", 50, stackable=True)
+        hammer_type = ItemType("hammer", 100)
+        building_type = LocationType("building", 1000)
+        tools_group = TypeGroup("tools")
+        tools_group.add_to_group(hammer_type)
+        smithing_skill_type = SkillType("smithing", "crafting")
+
+        tools_category = BuildMenuCategory("tools")
+        db.session.add_all([rl, stone_type, hammer_type, building_type, tools_group, smithing_skill_type,
+                            tools_category])
+        db.session.flush()
+
+        def create_recipe(requirements):
+            return EntityRecipe("project_manufacturing", {"item_name": "stone"}, requirements, 11, tools_category,
+                                result_entity=stone_type)
+
+        recipe_without_requirements = create_recipe({})
+        recipe_in_building = create_recipe({"location_types": ["building"]})
+        recipe_outside = create_recipe({"location_types": [main.Types.OUTSIDE]})
+        recipe_needing_tool = create_recipe({"mandatory_tools": ["tools"]})
+        recipe_needing_skill = create_recipe({"skills": {"smithing": 0.05}})
+        recipe_needing_high_skill = create_recipe({"skills": {"smithing": 0.5}})
+        db.session.add_all([recipe_without_requirements, recipe_in_building, recipe_outside, recipe_needing_tool,
+                            recipe_needing_skill, recipe_needing_high_skill])
+
+        recipe_index = RecipeIndex(EntityRecipe.query.order_by(EntityRecipe.id).all())
+        self.assertEqual({"hammer"},
+                         recipe_index.requirements_by_recipe_id[recipe_needing_tool.id]["mandatory_tools"][0])
+
+        recipe_list_producer = RecipeListProducer(initiator, recipe_index)
+        self.assertEqual([recipe_without_requirements, recipe_outside, recipe_needing_skill],
+                         recipe_list_producer.get_recipe_list())
+
+        hammer = Item(hammer_type, initiator)
+        db.session.add(hammer)
+        self.assertEqual([recipe_without_requirements, recipe_outside, recipe_needing_tool, recipe_needing_skill],
+                         recipe_list_producer.get_recipe_list())
+
+    def test_recipe_index_rebuilt_only_when_recipes_change(self):
+        stone_type = ItemType("stone", 50, stackable=True)
+        hammer_type = ItemType("hammer", 100)
+        tools_group = TypeGroup("tools")
+        tools_category = BuildMenuCategory("tools")
+        db.session.add_all([stone_type, hammer_type, tools_group, tools_category])
+
+        recipe_needing_tool = EntityRecipe("project_manufacturing", {"item_name": "stone"},
+                                           {"mandatory_tools": ["tools"]}, 11, tools_category,
+                                           result_entity=stone_type)
+        db.session.add(recipe_needing_tool)
+        db.session.flush()
+
+        recipe_index_cache = RecipeIndexCache()
+        recipe_index = recipe_index_cache.get()
+        self.assertIs(recipe_index, recipe_index_cache.get())
+        self.assertEqual(set(), recipe_index.requirements_by_recipe_id[recipe_needing_tool.id]["mandatory_tools"][0])
+
+        tools_group.add_to_group(hammer_type)
+        db.session.flush()
+        recipe_index = recipe_index_cache.get()
+        self.assertEqual({"hammer"},
+                         recipe_index.requirements_by_recipe_id[recipe_needing_tool.id]["mandatory_tools"][0])
+
+        recipe_needing_tool.requirements = {}
+        db.session.flush()
+        recipe_index = recipe_index_cache.get()
+        self.assertEqual([], recipe_index.requirements_by_recipe_id[recipe_needing_tool.id]["mandatory_tools"])
+
     def test_perform_error_check_for_activity_from_recipe_creation(self):
         hammer_type = ItemType("hammer", 100)
 
@@ -799,6 +1026,92 @@ class GroupTest(TestCase):
         self.assertCountEqual([steel_hammer, steel_needle], steel_tools.get_recipes())
 
 
+class IntentTest(TestCase):
+    create_app = util.set_up_app_with_database
+    tearDown = util.tear_down_rollback
+
+    def test_action_type_and_action_deserialized_once_per_transaction(self):
+        rl = RootLocation(Point(1, 1), 100)
+        hammer_type = ItemType("hammer", 100)
+        hammer = Item(hammer_type, rl)
+        character = util.create_character("John", rl, util.create_player("ABC"))
+        db.session.add_all([rl, hammer_type, hammer])
+        db.session.flush()
+
+        intent = Intent(character, main.Intents.WORK, 1, hammer,
+                        deferred.serialize(actions.RemoveItemAction(hammer)))
+        db.session.add(intent)
+        db.session.flush()
+
+        self.assertEqual("exeris.core.actions.RemoveItemAction", intent.action_type)
+        self.assertEqual(intent, Intent.query.filter_by(action_type="exeris.core.actions.RemoveItemAction").one())
+
+        action = intent.get_action()
+        self.assertEqual(hammer, action.item)
+        self.assertIs(action, intent.get_action())
+
+        action.gracefully = False
+        intent.set_action(action)
+        self.assertEqual(["exeris.core.actions.RemoveItemAction", {"item": hammer.id, "gracefully": False}],
+                         intent.serialized_action)
+        self.assertIs(action, intent.get_action())
+
+        db.session.begin_nested()
+        db.session.rollback()  # actions are deserialized again after rollback
+        self.assertIsNot(action, intent.get_action())
+        self.assertFalse(intent.get_action().gracefully)
+
+    def test_preloaded_entities_and_actions_kept_after_releasing_savepoint(self):
+        rl = RootLocation(Point(1, 1), 100)
+        hammer_type = ItemType("hammer", 100)
+        hammer = Item(hammer_type, rl)
+        character = util.create_character("John", rl, util.create_player("ABC"))
+        intent = Intent(character, main.Intents.WORK, 1, hammer,
+                        deferred.serialize(actions.RemoveItemAction(hammer)))
+        db.session.add_all([rl, hammer_type, hammer, intent])
+        db.session.flush()
+
+        Intent.preload_actions([intent])
+        self.assertIn(hammer, db.session.info[Intent.PRELOADED_ENTITIES_KEY])
+
+        db.session.begin_nested()
+        action = intent.get_action()
+        db.session.commit()  # savepoint released, like after every intent in WorkProcess
+
+        self.assertIs(action, intent.get_action())
+        self.assertIn(hammer, db.session.info[Intent.PRELOADED_ENTITIES_KEY])
+
+    def test_action_type_of_existing_intents_filled_by_migration(self):
+        rl = RootLocation(Point(1, 1), 100)
+        hammer_type = ItemType("hammer", 100)
+        hammer = Item(hammer_type, rl)
+        character = util.create_character("John", rl, util.create_player("ABC"))
+        db.session.add_all([rl, hammer_type, hammer])
+        intent = Intent(character, main.Intents.WORK, 1, hammer,
+                        deferred.serialize(actions.RemoveItemAction(hammer)))
+        db.session.add(intent)
+        db.session.flush()
+
+        # intent created before the column was added
+        Intent.query.filter_by(id=intent.id).update({Intent.action_type: None}, synchronize_session=False)
+
+        for statement in dict(migrations.MIGRATIONS)["intents_action_type"]:
+            db.session.execute(statement)
+        db.session.expire_all()
+
+        self.assertEqual("exeris.core.actions.RemoveItemAction", intent.action_type)
+
+    def test_malformed_serialized_action(self):
+        rl = RootLocation(Point(1, 1), 100)
+        character = util.create_character("John", rl, util.create_player("ABC"))
+        db.session.add(rl)
+
+        self.assertRaises(AssertionError, lambda: Intent(character, main.Intents.WORK, 1, None,
+                                                         {"exeris.core.actions.RemoveItemAction": {}}))
+        self.assertRaises(AssertionError, lambda: Intent(character, main.Intents.WORK, 1, None,
+                                                         ["exeris.core.actions.RemoveItemAction"]))
+
+
 class ListenersTest(TestCase):
     create_app = util.set_up_app_with_database
     tearDown = util.tear_down_rollback
@@ -827,3 +1140,84 @@ class ListenersTest(TestCase):
         test_item = Item.query.one()
         test_item.states[main.States.HUNGER] = 1.3
         self.assertEqual(1, test_item.states[main.States.HUNGER])
+
+    def test_changes_of_lazily_tracked_nested_values_are_saved(self):
+        test_item_type = ItemType("test_item", 100)
+        rl = RootLocation(Point(1, 1), 100)
+        test_item = Item(test_item_type, rl)
+        test_item.properties.append(EntityProperty(P.ANIMAL, {"resources": {"milk": {"amount": 3}}, "laid": [1]}))
+        db.session.add_all([test_item_type, rl, test_item])
+        db.session.flush()
+        db.session.expire_all()
+
+        animal_property = EntityProperty.query.filter_by(name=P.ANIMAL).one()
+        animal_property.data["resources"]["milk"]["amount"] = 5
+        animal_property.data["laid"].append(2)
+        self.assertIn(animal_property, db.session.dirty)
+        db.session.flush()
+        db.session.expire_all()
+
+        animal_property = EntityProperty.query.filter_by(name=P.ANIMAL).one()
+        self.assertEqual({"resources": {"milk": {"amount": 5}}, "laid": [1, 2]}, animal_property.data)
+
+        for resources in animal_property.data.values():  # values reached through values() are tracked as well
+            if isinstance(resources, dict):
+                resources["egg"] = 1
+        self.assertIn(animal_property, db.session.dirty)
+
+    def test_changes_of_nested_values_copied_from_tracked_dict_are_saved(self):
+        test_item_type = ItemType("test_item", 100)
+        rl = RootLocation(Point(1, 1), 100)
+        test_item = Item(test_item_type, rl)
+        test_item.properties.append(EntityProperty(P.ANIMAL, {"resources": {"milk": {"amount": 3}}}))
+        db.session.add_all([test_item_type, rl, test_item])
+        db.session.flush()
+        db.session.expire_all()
+
+        test_item = Item.query.one()
+        # get_property merges the property data into a new dict using dict.update
+        test_item.get_property(P.ANIMAL).get("resources")["milk"]["amount"] = 5
+        for key, value in test_item.get_property(P.ANIMAL).items():
+            value["egg"] = {"amount": 1}
+        animal_property = EntityProperty.query.filter_by(name=P.ANIMAL).one()
+        self.assertIn(animal_property, db.session.dirty)
+        db.session.flush()
+        db.session.expire_all()
+
+        animal_property = EntityProperty.query.filter_by(name=P.ANIMAL).one()
+        self.assertEqual({"resources": {"milk": {"amount": 5}, "egg": {"amount": 1}}}, animal_property.data)
+
+    def test_changes_of_few_keys_are_saved_using_partial_updates(self):
+        test_item_type = ItemType("test_item", 100)
+        rl = RootLocation(Point(1, 1), 100)
+        test_item = Item(test_item_type, rl)
+        test_item.properties.append(EntityProperty(P.ANIMAL, {"resources": {"milk": 3, "egg": 1}, "laid": [1]}))
+        db.session.add_all([test_item_type, rl, test_item])
+        db.session.flush()
+        db.session.expire_all()
+
+        test_item = Item.query.one()
+        animal_property = EntityProperty.query.filter_by(name=P.ANIMAL).one()
+        test_item.damage = 0.5
+        animal_property.data["resources"]["milk"] = 5
+        animal_property.data["laid"].append(2)
+        queries_before_flush = len(get_debug_queries())
+        db.session.flush()
+        update_statements = [query.statement for query in get_debug_queries()[queries_before_flush:]
+                             if query.statement.startswith("UPDATE")]
+        self.assertEqual(2, len(update_statements))  # one for states and one for the property data
+        self.assertTrue(all("jsonb_set" in statement for statement in update_statements))
+        db.session.expire_all()
+
+        test_item = Item.query.one()
+        animal_property = EntityProperty.query.filter_by(name=P.ANIMAL).one()
+        self.assertEqual(0.5, test_item.damage)
+        self.assertEqual({"resources": {"milk": 5, "egg": 1}, "laid": [1, 2]}, animal_property.data)
+
+        # removed keys and replaced values are saved as a whole
+        del animal_property.data["resources"]["egg"]
+        db.session.flush()
+        animal_property.data = {"laid": []}
+        db.session.flush()
+        db.session.expire_all()
+        self.assertEqual({"laid": []}, EntityProperty.query.filter_by(name=P.ANIMAL).one().data)
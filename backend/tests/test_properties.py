@@ -5,7 +5,7 @@ from shapely.geometry import Point
 from exeris.core.main import db
 from exeris.core.models import RootLocation, LocationType, Location, EntityTypeProperty, ObservedName, SkillType, \
     EntityProperty, \
-    ItemType, Item, TextContent, TypeGroup
+    ItemType, Item, TextContent, TypeGroup, Event, EventType, EventObserver
 # noinspection PyUnresolvedReferences
 from exeris.core import properties, main
 from exeris.core.properties_base import P
@@ -42,6 +42,34 @@ class EntityPropertiesTest(TestCase):
         new_name = ObservedName.query.filter_by(observer=doer, target=building).one()
         self.assertEqual("Wroclaw", new_name.name)
 
+    def test_dynamic_name_change_invalidates_rendered_events(self):
+        util.initialize_date()
+        rl = RootLocation(Point(1, 1), 123)
+        building_type = LocationType("building", 1000)
+        building = Location(rl, building_type)
+        building_type.properties.append(EntityTypeProperty(P.DYNAMIC_NAMEABLE))
+
+        doer = util.create_character("doer", rl, util.create_player("ABC"))
+        other = util.create_character("other", rl, util.create_player("DEF"))
+
+        event_type = EventType("event_building_seen", EventType.NORMAL)
+        event = Event(event_type, {"groups": {"building": building.pyslatize()}})
+        doer_event_obs = EventObserver(event, doer)
+        other_event_obs = EventObserver(event, other)
+        doer_event_obs.set_rendered_text("old text", "en:1")
+        other_event_obs.set_rendered_text("old text", "en:1")
+        db.session.add_all([rl, building_type, building, event_type, event, doer_event_obs, other_event_obs])
+        db.session.flush()
+
+        self.assertEqual("old text", doer_event_obs.get_rendered_text("en:1"))
+        self.assertIsNone(doer_event_obs.get_rendered_text("en:2"))
+
+        properties.DynamicNameableProperty(building).set_dynamic_name(doer, "Krakow")
+        db.session.expire_all()
+
+        self.assertIsNone(doer_event_obs.get_rendered_text("en:1"))
+        self.assertEqual("old text", other_event_obs.get_rendered_text("en:1"))  # didn't rename the building
+
     def test_get_and_alter_skill_success(self):
         rl = RootLocation(Point(1, 1), 111)
         char = util.create_character("ABC", rl, util.create_player("wololo"))
@@ -260,6 +288,31 @@ class LocationPropertyTest(TestCase):
 
         self.assertEqual(self._get_union_id(cog2), self._get_union_id(cog4))
 
+    def test_members_of_many_unions_are_found_using_union_id_index(self):
+        rl = RootLocation(Point(1, 1), 10)
+        cog_type = LocationType("cog", 1000)
+
+        cogs = [Location(rl, cog_type, title="cog" + str(i)) for i in range(5)]
+        db.session.add_all([rl, cog_type] + cogs)
+
+        first_union_property = properties.OptionalMemberOfUnionProperty(cogs[0])
+        first_union_property.union(cogs[1])
+        first_union_property.union(cogs[2])
+        second_union_property = properties.OptionalMemberOfUnionProperty(cogs[3])
+        second_union_property.union(cogs[4])
+
+        first_union_id = first_union_property.get_union_id()
+        second_union_id = second_union_property.get_union_id()
+        entity_properties_by_union_id = properties.OptionalMemberOfUnionProperty.get_entity_properties_of_unions(
+            [first_union_id, second_union_id])
+        self.assertCountEqual(cogs[:3], [ep.entity for ep in entity_properties_by_union_id[first_union_id]])
+        self.assertCountEqual(cogs[3:], [ep.entity for ep in entity_properties_by_union_id[second_union_id]])
+
+        db.session.execute("SET LOCAL enable_seqscan = off")  # tables are too small to be worth an index otherwise
+        union_members_query = EntityProperty.query.filter_by(name=P.MEMBER_OF_UNION).filter(
+            properties.OptionalMemberOfUnionProperty.json_to_int(EntityProperty.data["union_id"]) == first_union_id)
+        self.assertIn("entity_properties_union_id_idx", util.get_query_plan(union_members_query))
+
     def _get_union_id(self, entity):
         entity_property = EntityProperty.query.filter_by(entity=entity, name=P.MEMBER_OF_UNION).one()
         return entity_property.data["union_id"]
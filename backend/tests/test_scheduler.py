@@ -1,3 +1,4 @@
+import datetime
 import math
 from unittest.mock import patch
 
@@ -8,13 +9,13 @@ from exeris.core import properties
 from exeris.core.actions import ActivityProgressProcess, EatingProcess, DecayProcess, \
     WorkProcess, EatAction, WorkOnActivityAction, TravelInDirectionAction, \
     CreateItemAction, ActivityProgress, StartControllingMovementAction, TravelToEntityAction, ControlMovementAction, \
-    AnimalsProcess
-from exeris.core.general import GameDate
+    AnimalsProcess, EventsRetentionProcess
+from exeris.core.general import GameDate, EventCreator, SameLocationRange
 from exeris.core.main import db, Types
 from exeris.core.models import Activity, ItemType, RootLocation, Item, ScheduledTask, TypeGroup, EntityProperty, \
     SkillType, Character, EntityTypeProperty, Intent, PropertyArea, TerrainType, TerrainArea, Notification, \
     ResourceArea, \
-    LocationType, Location, Passage
+    LocationType, Location, Passage, Event, EventType, EventObserver, ArchivedEvent, EntitySnapshot
 from exeris.core.properties_base import P
 from exeris.extra.scheduler import Scheduler
 from flask_testing import TestCase
@@ -783,6 +784,25 @@ class SchedulerEatingTest(TestCase):
         self.assertAlmostEqual(value_after_two_ticks, char.states["fitness"])
         self.assertAlmostEqual(value_after_two_ticks, char.states["perception"])
 
+    def test_eating_process_locks_characters(self):
+        rl = RootLocation(Point(1, 1), 111)
+        db.session.add(rl)
+        util.create_character("testing", rl, util.create_player("DEF"))
+        db.session.flush()
+
+        statements = []
+
+        def collect_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sql.event.listen(db.engine, "before_cursor_execute", collect_statement)
+        self.addCleanup(sql.event.remove, db.engine, "before_cursor_execute", collect_statement)
+
+        process = EatingProcess(None)
+        process.perform()
+
+        self.assertTrue(any("FROM entities" in statement and "FOR UPDATE" in statement for statement in statements))
+
     def test_eating_applying_single_attr_food(self):
         rl = RootLocation(Point(1, 1), 111)
         db.session.add(rl)
@@ -904,6 +924,39 @@ class SchedulerAnimalsProcessTest(TestCase):
         dropped_eggs = Item.query.filter_by(type=egg_type).one()
         self.assertEqual(5, dropped_eggs.amount)
 
+    def test_animal_process_for_many_hens_with_a_shared_nest(self):
+        self._set_up_hen_entity_and_type()
+
+        hen_type = ItemType.by_name("hen")
+        egg_type = ItemType.by_name("egg")
+        rl = RootLocation.query.one()
+
+        nest_type = ItemType("nest", 100)
+        nest_type.properties.append(EntityTypeProperty(P.BIRD_NEST))
+        nest = Item(nest_type, rl)
+        db.session.add_all([nest_type, nest])
+
+        hens = []
+        for eggs in [2, 4]:
+            hen = Item(hen_type, rl)
+            hen.states[main.States.HUNGER] = 0
+            hen.properties.append(EntityProperty(P.ANIMAL, {"resources": {egg_type.name: eggs}}))
+            hen.properties.append(EntityProperty(P.DOMESTICATED, {"resources_increase": {"eggs_increase": 3}}))
+            hens.append(hen)
+        db.session.add_all(hens)
+
+        animals_process = AnimalsProcess(None)
+        animals_process.perform()
+
+        for hen in hens:
+            self.assertAlmostEqual(0.1, hen.states[main.States.HUNGER])
+            self.assertAlmostEqual(0.0, hen.get_entity_property(P.ANIMAL).data["resources"][egg_type.name])
+
+        # both hens have laid all their eggs into the same nest
+        eggs_in_nest = Item.query.filter_by(type=egg_type).one()
+        self.assertEqual(nest, eggs_in_nest.being_in)
+        self.assertEqual(5 + 5, eggs_in_nest.amount)
+
     def _set_up_hen_entity_and_type(self):
         rl = RootLocation(Point(1, 1), 100)
         egg_type = ItemType("egg", 10, stackable=True)
@@ -1049,3 +1102,111 @@ class SchedulerDecayTest(TestCase):
             "hammer": {"left": 1, "needed": 1}
         }
         self.assertEqual(input_req_after_decay, activity.requirements["input"])
+
+
+class SchedulerTaskClaimingTest(TestCase):
+    create_app = util.set_up_app_with_database
+    tearDown = util.tear_down_rollback
+
+    def test_tasks_filtered_by_process(self):
+        util.initialize_date()
+        combat_process_name = "exeris.core.actions.CombatProcess"
+
+        combat_task = ScheduledTask([combat_process_name, {"combat_entity": 1}], 0, 30)
+        work_task = ScheduledTask(["exeris.core.actions.WorkProcess", {}], 1, 5)
+        future_combat_task = ScheduledTask([combat_process_name, {"combat_entity": 2}],
+                                           GameDate.now().game_timestamp + 1000, 30)
+        db.session.add_all([combat_task, work_task, future_combat_task])
+        db.session.flush()
+
+        self.assertEqual(combat_process_name, combat_task.process_name)
+        self.assertEqual(combat_task, Scheduler().pop_task())
+        self.assertEqual(combat_task, Scheduler(included_processes=[combat_process_name]).pop_task())
+        self.assertEqual(work_task, Scheduler(excluded_processes=[combat_process_name]).pop_task())
+        self.assertIsNone(Scheduler(included_processes=["exeris.core.actions.EatingProcess"]).pop_task())
+
+    def test_claimed_task_skipped_until_claim_expires(self):
+        util.initialize_date()
+
+        combat_task = ScheduledTask(["exeris.core.actions.CombatProcess", {"combat_entity": 1}], 0, 30)
+        work_task = ScheduledTask(["exeris.core.actions.WorkProcess", {}], 1, 5)
+        db.session.add_all([combat_task, work_task])
+        db.session.flush()
+
+        scheduler = Scheduler()
+        with patch("exeris.extra.scheduler.Scheduler._commit_transaction") as commit_mock:
+            scheduler.claim_task(scheduler.pop_task())
+        commit_mock.assert_called_once_with()  # the claim is committed before the task is run
+
+        self.assertEqual(work_task, Scheduler().pop_task())
+
+        combat_task.claimed_until = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        self.assertEqual(combat_task, Scheduler().pop_task())
+
+
+class SchedulerEventsRetentionTest(TestCase):
+    create_app = util.set_up_app_with_database
+    tearDown = util.tear_down_rollback
+
+    def test_old_events_archived(self):
+        util.initialize_date()
+
+        rl = RootLocation(Point(1, 1), 111)
+        observer = util.create_character("observer", rl, util.create_player("abc"))
+        event_type = EventType("event_old_or_new", EventType.NORMAL)
+        db.session.add_all([rl, event_type])
+        db.session.flush()
+        observer_data = observer.pyslatize()
+
+        old_event = Event(event_type, {"groups": {"doer": observer_data}})
+        old_event.date = GameDate.now().game_timestamp - EventsRetentionProcess.RETENTION_PERIOD - 10
+        recent_event = Event(event_type, {})
+        db.session.add_all([old_event, recent_event,
+                            EventObserver(old_event, observer), EventObserver(recent_event, observer)])
+        db.session.flush()
+        old_event_id = old_event.id
+
+        process = EventsRetentionProcess(None)
+        process.perform()
+        db.session.expire_all()
+
+        self.assertIsNone(Event.query.get(old_event_id))
+        self.assertEqual([recent_event], [event_obs.event for event_obs in EventObserver.query.all()])
+
+        archived_event = ArchivedEvent.query.one()
+        self.assertEqual(old_event_id, archived_event.id)
+        self.assertEqual("event_old_or_new", archived_event.type_name)
+        self.assertEqual({"groups": {"doer": observer_data}}, archived_event.params)
+        self.assertEqual([observer.id], archived_event.observer_ids)
+
+    def test_entity_snapshots_of_archived_events_removed_when_no_longer_referenced(self):
+        util.initialize_date()
+
+        db.session.add_all([EventType("slap_doer", EventType.IMPORTANT), EventType("slap_target", EventType.IMPORTANT),
+                            EventType("slap_observer", EventType.NORMAL)])
+        rl = RootLocation(Point(1, 1), 111)
+        plr = util.create_player("abc")
+        doer = util.create_character("doer", rl, plr)
+        target = util.create_character("target", rl, plr)
+        util.create_character("observer", rl, plr)
+        db.session.add(rl)
+        db.session.flush()
+        doer_hash = EntitySnapshot.get_hash(doer.pyslatize())
+        target_hash = EntitySnapshot.get_hash(target.pyslatize())
+
+        EventCreator.base("slap", doer=doer, target=target, rng=SameLocationRange())
+        # the event for target and the event for observers reference doer, the other two reference target
+        self.assertEqual({doer_hash: 2, target_hash: 2}, EntitySnapshot.count_references([doer_hash, target_hash]))
+
+        Event.query.update({Event.date: GameDate.now().game_timestamp - EventsRetentionProcess.RETENTION_PERIOD - 10})
+        EventCreator.create(tag_doer="slap_doer", doer=doer, target=target)
+        self.assertEqual({doer_hash: 2, target_hash: 3}, EntitySnapshot.count_references([doer_hash, target_hash]))
+
+        process = EventsRetentionProcess(None)
+        process.perform()
+        db.session.expire_all()
+
+        self.assertEqual(3, ArchivedEvent.query.count())
+        self.assertEqual({doer_hash: 0, target_hash: 1}, EntitySnapshot.count_references([doer_hash, target_hash]))
+        self.assertIsNone(EntitySnapshot.query.get(doer_hash))
+        self.assertIsNotNone(EntitySnapshot.query.get(target_hash))
@@ -1,15 +1,21 @@
+from unittest.mock import patch, call
+
 from exeris.core.actions import ControlMovementAction, TravelInDirectionAction
 from flask import g
 from flask_testing import TestCase
 from shapely import geometry
 from shapely.geometry import Point
 
+import exeris.app
 from exeris.core import main
 from exeris.core.general import GameDate
-from exeris.core.i18n import create_pyslate
+from exeris.core.i18n import create_pyslate, TranslationConnectionPool, PooledPostgresBackend, \
+    InMemoryTranslationBackend, render_event_text
 from exeris.core.main import db, Types
 from exeris.core.models import Item, ItemType, RootLocation, EntityProperty, Character, ObservedName, Location, \
-    LocationType, TerrainArea, TerrainType, Passage, Activity, PassageType, EntityType, EntityTypeProperty
+    LocationType, TerrainArea, TerrainType, Passage, Activity, PassageType, EntityType, EntityTypeProperty, Event, \
+    EventType, EventObserver
+from exeris.extra import hooks, notifications_service
 from exeris.core.properties import P
 from pyslate.backends import json_backend
 from tests import util
@@ -216,6 +222,9 @@ data = {
     "tp_game_date": {
         "en": "%{day}-%{moon}m. %{hour}:%{minute}",
     },
+    "event_whisper_observer": {
+        "en": "${doer:character_info} whispers to ${target:character_info}.",
+    },
 
 }
 
@@ -553,6 +562,69 @@ class CharacterAndLocationTranslationTest(TestCase):
         self.assertEqual("open door to building 'FALA'", full_passage_with_other_side_text)
 
 
+class EventTextsTranslationTest(TestCase):
+    create_app = util.set_up_app_with_database
+    tearDown = util.tear_down_rollback
+
+    def test_new_events_are_rendered_once_and_sent_to_online_observers(self):
+        util.initialize_date()
+
+        rl = RootLocation(Point(1, 1), 111)
+        plr = util.create_player("adwdas")
+        doer = util.create_character("doer", rl, plr, sex=Character.SEX_MALE)
+        target = util.create_character("target", rl, plr, sex=Character.SEX_FEMALE)
+        obs1 = util.create_character("obs1", rl, plr)  # obs1 doesn't know anybody
+        obs2 = util.create_character("obs2", rl, plr, sex=Character.SEX_FEMALE)  # obs2 knows the doer
+        obs3 = util.create_character("obs3", rl, plr)  # obs3 knows the target
+
+        event_type = EventType("event_whisper_observer")
+        event = Event(event_type, {"groups": {"doer": doer.pyslatize(), "target": target.pyslatize()}})
+        event_observers = [EventObserver(event, obs) for obs in [obs1, obs2, obs3]]
+        db.session.add_all([rl, event_type, event, ObservedName(obs2, doer, "John"),
+                            ObservedName(obs3, target, "Judith")] + event_observers)
+        db.session.flush()
+
+        backend = json_backend.JsonBackend(json_data=data)
+        with patch.object(exeris.app, "translation_backend", backend), \
+                patch.object(exeris.app, "get_rendered_event_version", return_value="en:1"), \
+                patch.object(exeris.app.socketio_users, "get_all_by_player_ids",
+                             return_value={plr.id: ["sid1"]}), \
+                patch.object(notifications_service, "add_event_to_send") as add_event_to_send_mock:
+            hooks.on_new_events(event_observers)
+
+        # the same texts as rendered separately for every observer
+        expected_texts = [render_event_text(create_pyslate("en", backend=backend, character=obs), event)
+                          for obs in [obs1, obs2, obs3]]
+        self.assertIn(">man</span> whispers to <span", expected_texts[0])
+        self.assertIn(">John</span> whispers to <span", expected_texts[1])
+        self.assertIn(">Judith</span>.", expected_texts[2])
+
+        self.assertEqual(expected_texts, [event_obs.get_rendered_text("en:1") for event_obs in event_observers])
+        self.assertCountEqual([call("sid1", obs.id, event.id, expected_text)
+                               for obs, expected_text in zip([obs1, obs2, obs3], expected_texts)],
+                              add_event_to_send_mock.call_args_list)
+
+
+    def test_rendered_texts_are_not_stored_when_version_of_translations_is_unknown(self):
+        util.initialize_date()
+
+        rl = RootLocation(Point(1, 1), 111)
+        plr = util.create_player("adwdas")
+        obs = util.create_character("obs", rl, plr)
+        event_type = EventType("event_whisper_observer")
+        event_observer = EventObserver(Event(event_type, {}), obs)
+        db.session.add_all([rl, event_type, event_observer])
+
+        with patch.object(exeris.app.translation_backend, "_reload_if_outdated"), \
+                patch.object(exeris.app.translation_backend, "_version", None):
+            rendered_version = exeris.app.get_rendered_event_version("en")
+        self.assertIsNone(rendered_version)
+
+        event_observer.set_rendered_text("some text", rendered_version)
+        self.assertIsNone(event_observer.rendered_text)
+        self.assertIsNone(event_observer.get_rendered_text(rendered_version))
+
+
 class GameDateDisplayTest(TestCase):
     create_app = util.set_up_app_with_database
     tearDown = util.tear_down_rollback
@@ -640,3 +712,51 @@ class ActionTranslationTest(TestCase):
                 }
             }
         }, control_movement_action.pyslatize())
+
+
+class TranslationConnectionPoolTest(TestCase):
+    create_app = util.set_up_app_with_database
+    tearDown = util.tear_down_rollback
+
+    def test_connection_is_returned_to_pool(self):
+        connection_pool = TranslationConnectionPool(self.app.config["SQLALCHEMY_DATABASE_URI"], 1)
+
+        with self.assertRaises(ValueError):
+            with connection_pool.connection():
+                raise ValueError()
+
+        # the only connection must be available again, otherwise it'd wait forever
+        backend = PooledPostgresBackend(connection_pool, "translations")
+        self.assertIsNone(backend.get_content(["nonexistent_tag"], ["en"]))
+
+        self.assertEqual(2, connection_pool.stats()["borrows"])
+        self.assertEqual(0, connection_pool.stats()["waits"])
+        connection_pool.close()
+
+    def test_in_memory_backend_reloaded_on_version_change(self):
+        connection_pool = TranslationConnectionPool(self.app.config["SQLALCHEMY_DATABASE_URI"], 1)
+        version = {"value": 1}
+        backend = InMemoryTranslationBackend(connection_pool, "translations", get_version=lambda: version["value"],
+                                             version_check_interval=0)
+
+        def execute_sql(query, args):
+            with connection_pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, args)
+
+        execute_sql("INSERT INTO translations (name, language, content, form) VALUES (%s, %s, %s, %s)",
+                    ("tag_in_memory", "en", "old text", "m"))
+        try:
+            pyslate = create_pyslate("en", backend=backend)
+            self.assertEqual("old text", pyslate.t("tag_in_memory"))
+
+            execute_sql("UPDATE translations SET content = %s WHERE name = %s", ("new text", "tag_in_memory"))
+            self.assertEqual("old text", backend.get_content(["tag_in_memory"], ["en"]))  # still cached
+
+            version["value"] = 2
+            self.assertEqual("new text", backend.get_content(["tag_in_memory"], ["en"]))
+            self.assertEqual("m", backend.get_form(["tag_in_memory"], ["en"]))
+            self.assertIsNone(backend.get_content(["nonexistent_tag"], ["en"]))
+        finally:
+            execute_sql("DELETE FROM translations WHERE name = %s", ("tag_in_memory",))
+            connection_pool.close()
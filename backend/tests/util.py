@@ -1,9 +1,11 @@
 import datetime
 
-from exeris.core import general
+from exeris.core import general, migrations
 from exeris.core.main import create_app, db
 from exeris.core.models import Player, Character, GameDateCheckpoint, init_database_contents
 from shapely.geometry import Point
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
 
 
 def set_up_app_with_database(self):
@@ -11,6 +13,7 @@ def set_up_app_with_database(self):
     app = create_app(own_config_file_path="config/test_config.py", database=db)
     with app.app_context():
         db.create_all()
+        migrations.apply_migrations()
 
         init_database_contents()
         db.session.commit()
@@ -40,3 +43,21 @@ def create_character(name, being_in, player, save=True, sex=Character.SEX_MALE):
 def initialize_date():
     checkpoint = GameDateCheckpoint(game_date=2000, real_date=datetime.datetime.now().timestamp())
     db.session.add(checkpoint)
+
+
+class Explain(Executable, ClauseElement):
+    """
+    EXPLAIN of a query, compiled together with the bound parameters of the explained statement.
+    """
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def _compile_explain(element, compiler, **kwargs):
+    return "EXPLAIN " + compiler.process(element.statement, **kwargs)
+
+
+def get_query_plan(query):
+    return "\n".join(row[0] for row in db.session.execute(Explain(query.statement)))
@@ -1,13 +1,27 @@
 import {connect} from "react-redux";
-import {requestAllEvents, fromEventsState, getAllEvents} from "../../../modules/events";
+import {
+  requestNewestEvents,
+  requestEventsAfter,
+  requestEventsBefore,
+  fromEventsState,
+  getAllEvents,
+  hasOlderEvents,
+} from "../../../modules/events";
 import {parseHtmlToComponents} from "../../../util/parseDynamicName";
 import React from "react";
 import {ListGroup, ListGroupItem} from "react-bootstrap";
+import {i18nize} from "../../../i18n";
 
 
-export class EventsList extends React.Component {
+class EventsListRaw extends React.Component {
   componentDidMount() {
-    this.props.requestState();
+    const events = this.props.events;
+    if (events.size > 0) {
+      // events seen before are already known, so only the new ones are needed
+      this.props.requestNewEvents(events.last().get("id"));
+    } else {
+      this.props.requestState();
+    }
   }
 
   componentDidUpdate(prevProps) {
@@ -17,6 +31,7 @@ export class EventsList extends React.Component {
   }
 
   render() {
+    const {t} = this.props;
     let eventsList = [];
     const events = this.props.events;
     for (let i = events.size - 1; i >= 0; i--) {
@@ -26,6 +41,13 @@ export class EventsList extends React.Component {
         </ListGroupItem>
       );
     }
+    if (this.props.hasOlderEvents) {
+      eventsList.push(
+        <ListGroupItem key="older-events" onClick={() => this.props.requestOlderEvents(events.first().get("id"))}>
+          {t("events_load_older")}
+        </ListGroupItem>
+      );
+    }
 
     return (
       <ListGroup>
@@ -34,11 +56,14 @@ export class EventsList extends React.Component {
   }
 }
 
+export const EventsList = i18nize(EventsListRaw);
 
 const mapStateToProps = (state, ownProps) => {
+  const eventsState = fromEventsState(state, ownProps.characterId);
   return {
     characterId: ownProps.characterId,
-    events: getAllEvents(fromEventsState(state, ownProps.characterId)).map(event => {
+    hasOlderEvents: hasOlderEvents(eventsState),
+    events: getAllEvents(eventsState).map(event => {
       const eventAsComponent = parseHtmlToComponents(ownProps.characterId, event.get("text"));
       return event.set("textComponent", eventAsComponent);
     }),
@@ -46,7 +71,11 @@ const mapStateToProps = (state, ownProps) => {
 };
 
 const mapDispatchToProps = (dispatch, ownProps) => {
-  return {requestState: () => dispatch(requestAllEvents(ownProps.characterId))}
+  return {
+    requestState: () => dispatch(requestNewestEvents(ownProps.characterId)),
+    requestNewEvents: lastEventId => dispatch(requestEventsAfter(ownProps.characterId, lastEventId)),
+    requestOlderEvents: firstEventId => dispatch(requestEventsBefore(ownProps.characterId, firstEventId)),
+  }
 };
 
 const EventsListContainer = connect(
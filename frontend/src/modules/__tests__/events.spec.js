@@ -4,7 +4,16 @@ import {
   fromEventsState,
   updateEventsList,
   appendToEventsList,
-  decoratedEventsReducer, UPDATE_EVENTS_LIST, requestAllEvents
+  prependToEventsList,
+  hasOlderEvents,
+  decoratedEventsReducer,
+  UPDATE_EVENTS_LIST,
+  APPEND_TO_EVENTS_LIST,
+  PREPEND_TO_EVENTS_LIST,
+  EVENTS_PAGE_SIZE,
+  requestNewestEvents,
+  requestEventsAfter,
+  requestEventsBefore,
 } from "../events";
 import * as Immutable from "immutable";
 import {createMockStore} from "../../../tests/testUtils";
@@ -14,6 +23,7 @@ describe('(events) eventsReducer', () => {
   it('Should initialize with initial state.', () => {
     expect(eventsReducer(undefined, {})).toEqual(Immutable.fromJS({
       eventsList: [],
+      hasOlderEvents: false,
     }));
   });
 
@@ -31,7 +41,8 @@ describe('(events) eventsReducer', () => {
       eventsList: [{"id": 1, "text": "abc"}],
     });
     let state = eventsReducer(previousState, updateEventsList(0, []));
-    expect(state).toEqual(previousState.setIn(["eventsList"], Immutable.List()));
+    expect(getAllEvents(state)).toEqual(Immutable.List());
+    expect(hasOlderEvents(state)).toEqual(false);
   });
 
   it('Should replace the state if a new list is supplied.', () => {
@@ -39,8 +50,18 @@ describe('(events) eventsReducer', () => {
       eventsList: [{"id": 1, "text": "abc"}],
     });
     let state = eventsReducer(previousState, updateEventsList(0, [{id: 11, text: "ade"}]));
-    expect(state).toEqual(previousState.setIn(["eventsList"],
-      Immutable.fromJS([{id: 11, text: "ade"}])));
+    expect(getAllEvents(state)).toEqual(Immutable.fromJS([{id: 11, text: "ade"}]));
+  });
+
+  it('Should expect older events if a full page is supplied.', () => {
+    const fullPage = [...Array(EVENTS_PAGE_SIZE).keys()].map(i => ({id: 100 + i, text: "abc"}));
+    let state = eventsReducer(undefined, updateEventsList(0, fullPage));
+    expect(hasOlderEvents(state)).toEqual(true);
+
+    state = eventsReducer(state, prependToEventsList(0, [{id: 11, text: "ade"}]));
+    expect(getAllEvents(state).size).toEqual(EVENTS_PAGE_SIZE + 1);
+    expect(getAllEvents(state).first()).toEqual(Immutable.fromJS({id: 11, text: "ade"}));
+    expect(hasOlderEvents(state)).toEqual(false);
   });
 
   it('Should update the eventsList if a list is appended.', () => {
@@ -76,7 +97,7 @@ describe('(events) eventsReducer', () => {
     ]));
   });
 
-  it('Should request all events for a character.', () => {
+  it('Should request the newest events for a character.', () => {
     const charId = "DELELE";
     const eventsList = [
       {
@@ -87,8 +108,8 @@ describe('(events) eventsReducer', () => {
 
     const store = createMockStore({}, [eventsList]);
 
-    store.dispatch(requestAllEvents(charId));
-    store.socketCalledWith("character.get_all_events", charId);
+    store.dispatch(requestNewestEvents(charId));
+    store.socketCalledWith("character.get_events", charId);
 
     const actions = store.getActions();
     expect(actions).toHaveLength(1);
@@ -98,4 +119,50 @@ describe('(events) eventsReducer', () => {
       characterId: charId,
     });
   });
+
+  it('Should request only events newer than the last seen one.', () => {
+    const charId = "DELELE";
+    const eventsList = [
+      {
+        id: 124,
+        text: "New event text",
+      },
+    ];
+
+    const store = createMockStore({}, [eventsList]);
+
+    store.dispatch(requestEventsAfter(charId, 123));
+    store.socketCalledWith("character.get_events", charId, 123);
+
+    const actions = store.getActions();
+    expect(actions).toHaveLength(1);
+    expect(actions[0]).toEqual({
+      type: APPEND_TO_EVENTS_LIST,
+      eventsList: eventsList,
+      characterId: charId,
+    });
+  });
+
+  it('Should request events older than the first seen one.', () => {
+    const charId = "DELELE";
+    const eventsList = [
+      {
+        id: 122,
+        text: "Old event text",
+      },
+    ];
+
+    const store = createMockStore({}, [eventsList]);
+
+    store.dispatch(requestEventsBefore(charId, 123));
+    store.socketCalledWith("character.get_events", charId, null, 123);
+
+    const actions = store.getActions();
+    expect(actions).toHaveLength(1);
+    expect(actions[0]).toEqual({
+      type: PREPEND_TO_EVENTS_LIST,
+      eventsList: eventsList,
+      characterId: charId,
+    });
+  });
 });
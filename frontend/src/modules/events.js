@@ -3,21 +3,51 @@ import {characterReducerDecorator} from "../util/characterReducerDecorator";
 
 export const UPDATE_EVENTS_LIST = "exeris-front/events/UPDATE_EVENTS_LIST";
 export const APPEND_TO_EVENTS_LIST = "exeris-front/events/APPEND_TO_EVENTS_LIST";
+export const PREPEND_TO_EVENTS_LIST = "exeris-front/events/PREPEND_TO_EVENTS_LIST";
 
 export const setUpSocketioListeners = (dispatch, socket) => {
-  socket.on("character.new_event", (characterId, event) => {
-    dispatch(appendToEventsList(characterId, [event]));
+  // all events for the session which are created in the same transaction come in a single message
+  socket.on("character.new_events", eventsWithCharacterIds => {
+    const eventsByCharacterId = {};
+    eventsWithCharacterIds.forEach(([characterId, event]) => {
+      eventsByCharacterId[characterId] = (eventsByCharacterId[characterId] || []).concat([event]);
+    });
+    Object.keys(eventsByCharacterId).forEach(characterId => {
+      dispatch(appendToEventsList(characterId, eventsByCharacterId[characterId]));
+    });
   });
 };
 
-export const requestAllEvents = (characterId) => {
+// the same as the default page size of "character.get_events"
+export const EVENTS_PAGE_SIZE = 50;
+
+export const requestNewestEvents = (characterId) => {
   return (dispatch, getState, socket) => {
-    socket.request("character.get_all_events", characterId, eventsList => {
+    socket.request("character.get_events", characterId, eventsList => {
       dispatch(updateEventsList(characterId, eventsList));
     });
   }
 };
 
+export const requestEventsBefore = (characterId, firstEventId) => {
+  return (dispatch, getState, socket) => {
+    socket.request("character.get_events", characterId, null, firstEventId, olderEvents => {
+      dispatch(prependToEventsList(characterId, olderEvents));
+    });
+  }
+};
+
+export const requestEventsAfter = (characterId, lastEventId) => {
+  return (dispatch, getState, socket) => {
+    socket.request("character.get_events", characterId, lastEventId, newEvents => {
+      dispatch(appendToEventsList(characterId, newEvents));
+      if (newEvents.length === EVENTS_PAGE_SIZE) { // there can be more of them
+        dispatch(requestEventsAfter(characterId, newEvents[newEvents.length - 1].id));
+      }
+    });
+  }
+};
+
 export const updateEventsList = (characterId, eventsList) => {
   return {
     type: UPDATE_EVENTS_LIST,
@@ -34,13 +64,26 @@ export const appendToEventsList = (characterId, eventsList) => {
   };
 };
 
+export const prependToEventsList = (characterId, eventsList) => {
+  return {
+    type: PREPEND_TO_EVENTS_LIST,
+    eventsList: eventsList,
+    characterId: characterId,
+  };
+};
+
 
-export const eventsReducer = (state = Immutable.fromJS({eventsList: []}), action) => {
+export const eventsReducer = (state = Immutable.fromJS({eventsList: [], hasOlderEvents: false}), action) => {
   switch (action.type) {
     case UPDATE_EVENTS_LIST:
-      return state.set("eventsList", Immutable.fromJS(action.eventsList));
+      // a full page means there can be older events which were not loaded yet
+      return state.set("eventsList", Immutable.fromJS(action.eventsList))
+        .set("hasOlderEvents", action.eventsList.length === EVENTS_PAGE_SIZE);
     case APPEND_TO_EVENTS_LIST:
       return state.updateIn(["eventsList"], oldList => oldList.concat(Immutable.fromJS(action.eventsList)));
+    case PREPEND_TO_EVENTS_LIST:
+      return state.updateIn(["eventsList"], oldList => Immutable.fromJS(action.eventsList).concat(oldList))
+        .set("hasOlderEvents", action.eventsList.length === EVENTS_PAGE_SIZE);
     default:
       return state;
   }
@@ -50,4 +93,6 @@ export const decoratedEventsReducer = characterReducerDecorator(eventsReducer);
 
 export const getAllEvents = state => state.get("eventsList", []);
 
+export const hasOlderEvents = state => state.get("hasOlderEvents", false);
+
 export const fromEventsState = (state, characterId) => state.getIn(["events", characterId], Immutable.Map());
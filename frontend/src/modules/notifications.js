@@ -8,8 +8,8 @@ export const REMOVE_NOTIFICATION = "exeris-front/notifications/REMOVE_NOTIFICATI
 
 
 export const setUpSocketioListeners = (dispatch, socket) => {
-  socket.on("player.new_notification", notification => {
-    dispatch(addNotification(notification));
+  socket.on("player.new_notifications", notifications => {
+    notifications.forEach(notification => dispatch(addNotification(notification)));
   });
 
   socket.on("player.show_error", (characterId, errorMessage) => {
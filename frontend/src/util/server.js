@@ -1,5 +1,7 @@
 import io from "socket.io-client";
 
+// it must be shorter than SOCKETIO_SID_TTL on the server
+const HEARTBEAT_INTERVAL = 30 * 1000;
 
 const setupSocketio = () => {
   const socket = io.connect('//' + window.location.hostname + ':' + window.location.port, {
@@ -33,6 +35,13 @@ const setupSocketio = () => {
     socket.connect();
   };
 
+  // keeps the session registered on the server, otherwise it wouldn't get any new events
+  setInterval(() => {
+    if (socket.connected) {
+      socket.emit("heartbeat");
+    }
+  }, HEARTBEAT_INTERVAL);
+
   return socket;
 }
 